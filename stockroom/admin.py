@@ -1,9 +1,19 @@
+import re
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.db import models
 from django import forms
 from django.forms.models import inlineformset_factory
 
 from models import *
+from search import search_products
+
+# Most products an admin search matches
+ADMIN_SEARCH_LIMIT = 1000
+# Shorter searches, and single terms that look like a SKU, keep the
+# substring lookups the index can't answer
+ADMIN_SEARCH_MIN_LENGTH = 3
+SKU_LIKE = re.compile(r'^\S*[\d_./-]\S*$')
 
 class ProductCategoryAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('name',)}
@@ -41,6 +51,31 @@ class ProductRelationshipInline(admin.TabularInline):
     model = ProductRelationship
     fk_name = 'from_product'
     
+class ProductSearchChangeList(ChangeList):
+    """
+        Answers the changelist search box from the search index instead of
+        icontains lookups across stock items, except for short terms, SKUs
+        and words the index doesn't match.
+    """
+    def get_query_set(self, request):
+        query = self.query.strip()
+        if len(query) < ADMIN_SEARCH_MIN_LENGTH or SKU_LIKE.match(query):
+            return super(ProductSearchChangeList, self).get_query_set(request)
+        pks = search_products(query, limit=ADMIN_SEARCH_LIMIT)
+        if not pks:
+            # Nothing matched whole words, try parts of them
+            return super(ProductSearchChangeList, self).get_query_set(request)
+        if len(pks) >= ADMIN_SEARCH_LIMIT:
+            self.model_admin.message_user(request, 'Only the best %d matches are shown, '
+                'refine the search to see the others.' % ADMIN_SEARCH_LIMIT)
+
+        search_fields, self.search_fields = self.search_fields, ()
+        try:
+            qs = super(ProductSearchChangeList, self).get_query_set(request)
+        finally:
+            self.search_fields = search_fields
+        return qs.filter(pk__in=pks)
+
 class ProductAdmin(admin.ModelAdmin):
     inlines = [
         StockItemInline,
@@ -55,6 +90,12 @@ class ProductAdmin(admin.ModelAdmin):
     class Meta:
         model = Product
 
+    def queryset(self, request):
+        return super(ProductAdmin, self).queryset(request).with_commerce_summary()
+
+    def get_changelist(self, request, **kwargs):
+        return ProductSearchChangeList
+
 class StockItemAttributeValueAdmin(admin.ModelAdmin):
     list_display = ('attribute', 'value',)
     class Meta:
@@ -85,6 +126,24 @@ class PriceHistoryAdmin(admin.ModelAdmin):
     class Meta:
         model = PriceHistory
 
+class PriceRollupAdmin(admin.ModelAdmin):
+    list_display = ('stock_item', 'bucket', 'start', 'min_price', 'max_price', 'last_price')
+    list_filter = ('bucket',)
+    class Meta:
+        model = PriceRollup
+
+class StockItemSalesAdmin(admin.ModelAdmin):
+    list_display = ('stock_item', 'day', 'quantity')
+    date_hierarchy = 'day'
+    class Meta:
+        model = StockItemSales
+
+class CategorySalesAdmin(admin.ModelAdmin):
+    list_display = ('category', 'day', 'quantity')
+    date_hierarchy = 'day'
+    class Meta:
+        model = CategorySales
+
 class CartAdmin(admin.ModelAdmin):
     class Meta:
         model = Cart
@@ -94,15 +153,24 @@ class CartItemAdmin(admin.ModelAdmin):
     class Meta:
         model = CartItem
 
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ('stock_item', 'quantity', 'cart', 'expires_on')
+    class Meta:
+        model = StockReservation
+
 
 admin.site.register(ProductCategory, ProductCategoryAdmin)
 admin.site.register(Manufacturer, ManufacturerAdmin)
 admin.site.register(Brand, BrandAdmin)
 admin.site.register(Cart, CartAdmin)
 admin.site.register(CartItem, CartItemAdmin)
+admin.site.register(CategorySales, CategorySalesAdmin)
 admin.site.register(PriceHistory, PriceHistoryAdmin)
+admin.site.register(PriceRollup, PriceRollupAdmin)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(ProductImage, ProductImageAdmin)
 admin.site.register(StockItem, StockItemAdmin)
+admin.site.register(StockItemSales, StockItemSalesAdmin)
+admin.site.register(StockReservation, StockReservationAdmin)
 admin.site.register(StockItemAttribute, StockItemAttributeAdmin)
 admin.site.register(StockItemAttributeValue, StockItemAttributeValueAdmin)
\ No newline at end of file
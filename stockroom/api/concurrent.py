@@ -0,0 +1,90 @@
+"""
+Concurrent lookups for API reads.
+
+There is no async ORM to await here, so the independent, expensive lookups
+of one request run on a shared pool of STOCKROOM_API_READ_WORKERS threads
+instead, while the first lookup runs in the request thread. Every pool
+thread keeps its own database connection open from one call to the next.
+With no workers configured, or on an in-memory SQLite database that other
+threads can't see, the lookups simply run one after another.
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.db import connections, DatabaseError
+
+READ_WORKERS = getattr(settings, 'STOCKROOM_API_READ_WORKERS', 4)
+
+_pool = []
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    with _pool_lock:
+        if not _pool:
+            _pool.append(ThreadPool(READ_WORKERS))
+        return _pool[0]
+
+def shared_database():
+    """
+        Whether other threads can reach the data this thread sees.
+    """
+    for alias in connections:
+        connection = connections[alias]
+        if connection.vendor == 'sqlite' and connection.settings_dict['NAME'] in ('', ':memory:'):
+            return False
+    return True
+
+def _recording():
+    # The aliases whose queries this thread keeps, for the instrumentation
+    # or DEBUG, so the queries of pool threads can be kept with them
+    recording = []
+    for alias in connections:
+        connection = connections[alias]
+        if connection.use_debug_cursor or (connection.use_debug_cursor is None and settings.DEBUG):
+            recording.append(alias)
+    return recording
+
+def _run(call, recording):
+    saved = []
+    for alias in recording:
+        connection = connections[alias]
+        saved.append((connection, connection.use_debug_cursor, len(connection.queries)))
+        connection.use_debug_cursor = True
+    try:
+        result = call()
+    except DatabaseError:
+        # Reconnect on the next call rather than reuse a broken connection
+        for alias in connections:
+            connections[alias].close()
+        raise
+    finally:
+        queries = []
+        for connection, use_debug_cursor, start in saved:
+            queries.append((connection.alias, connection.queries[start:]))
+            del connection.queries[start:]
+            connection.use_debug_cursor = use_debug_cursor
+        # The connection stays open, but not inside a transaction: the next
+        # call gets a fresh snapshot. Pool threads never see request_finished
+        for alias in connections:
+            if connections[alias].connection is not None:
+                connections[alias].rollback_unless_managed()
+    return result, queries
+
+def gather(*calls):
+    """
+        Calls every given function and returns their results in order.
+        The first exception raised by any of them is raised again. Queries
+        run on the pool are added to this thread's, where it keeps them.
+    """
+    if READ_WORKERS < 1 or len(calls) < 2 or not shared_database():
+        return [call() for call in calls]
+    recording = _recording()
+    pending = [_get_pool().apply_async(_run, (call, recording)) for call in calls[1:]]
+    first = calls[0]()
+    results = [first]
+    for p in pending:
+        result, queries = p.get()
+        for alias, run in queries:
+            connections[alias].queries.extend(run)
+        results.append(result)
+    return results
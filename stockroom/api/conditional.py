@@ -0,0 +1,66 @@
+"""
+Validators for conditional GETs on catalog resources. Each resource's
+ETag and Last-Modified come from one aggregate query, memoized on the
+request so django.views.decorators.http.condition can ask for both.
+"""
+from hashlib import md5
+from django.db.models import Max, Count, Q
+from django.views.decorators.http import condition
+from stockroom.models import Product, ProductCategory
+
+def _latest(*values):
+    values = [v for v in values if v is not None]
+    return values and max(values) or None
+
+def _validators(request, key, compute):
+    cache = request.__dict__.setdefault('_stockroom_validators', {})
+    if key not in cache:
+        cache[key] = compute()
+    return cache[key]
+
+def _product_validators(product_pk):
+    summary = Product.objects.filter(pk=product_pk).aggregate(
+        Max('last_updates'), Max('stock__last_updates'), Max('images__last_updates'),
+        Max('category__last_updates'), Count('stock', distinct=True), Count('images', distinct=True),
+    )
+    if summary['last_updates__max'] is None:
+        return None, None
+    last_modified = _latest(summary['last_updates__max'], summary['stock__last_updates__max'],
+        summary['images__last_updates__max'], summary['category__last_updates__max'])
+    etag = md5('product:%s:%s:%s:%s' % (product_pk, last_modified.isoformat(),
+        summary['stock__count'], summary['images__count'])).hexdigest()
+    return etag, last_modified
+
+def _category_validators(slug):
+    # The category and the direct children listed with it
+    summary = ProductCategory.objects.filter(Q(slug=slug, active=True) | Q(parent__slug=slug, parent__active=True)).aggregate(
+        Max('last_updates'), Count('pk'),
+    )
+    if summary['last_updates__max'] is None:
+        return None, None
+    last_modified = summary['last_updates__max']
+    etag = md5((u'category:%s:%s:%s' % (slug, last_modified.isoformat(), summary['pk__count'])).encode('utf-8')).hexdigest()
+    return etag, last_modified
+
+def product_etag(request, product_pk=None, **kwargs):
+    if product_pk is None:
+        return None
+    return _validators(request, 'product', lambda: _product_validators(product_pk))[0]
+
+def product_last_modified(request, product_pk=None, **kwargs):
+    if product_pk is None:
+        return None
+    return _validators(request, 'product', lambda: _product_validators(product_pk))[1]
+
+def category_etag(request, slug=None, **kwargs):
+    if slug is None:
+        return None
+    return _validators(request, 'category', lambda: _category_validators(slug))[0]
+
+def category_last_modified(request, slug=None, **kwargs):
+    if slug is None:
+        return None
+    return _validators(request, 'category', lambda: _category_validators(slug))[1]
+
+product_condition = condition(etag_func=product_etag, last_modified_func=product_last_modified)
+category_condition = condition(etag_func=category_etag, last_modified_func=category_last_modified)
@@ -1,14 +1,25 @@
-from django.db.models import Count
+from django.db.models import Count, Q
 from django.http import HttpResponse
 from piston.handler import BaseHandler
-from piston.utils import validate, rc
+from piston.utils import validate, rc, FormValidationError
 from stockroom.models import ProductCategory, Product, StockItem, CartItem, Cart as CartModel
 from stockroom.cart import Cart
 from stockroom.forms import CartItemForm
-from stockroom.utils import structure_products, structure_gallery, build_thumbnail_list
+from stockroom.utils import structure_products, structure_product, structure_category, prefetch_products
+from stockroom.caching import read_through, product_key, category_key
+from stockroom.search import search_products, tokenize
+from stockroom.related import related_products
+from stockroom.sales import best_sellers
+from stockroom.api.concurrent import gather
+from stockroom.api.pagination import paginate, paginate_offsets, InvalidCursor, MAX_PAGE_SIZE
+from stockroom.instrumentation import instrumented
 
 import logging
 
+ATTRIBUTE_PREFIX = 'attr.'
+RELATED_LIMIT = 10
+BEST_SELLER_DAYS = 30
+
 class CsrfExemptBaseHandler(BaseHandler):
     """
         handles request that have had csrfmiddlewaretoken inserted 
@@ -21,85 +32,300 @@ class CsrfExemptBaseHandler(BaseHandler):
             del dct['csrfmiddlewaretoken']
         return super(CsrfExemptBaseHandler, self).flatten_dict(dct)
             
+def paginated(request, queryset, orderings, structure=None):
+    try:
+        objects, next_cursor, previous_cursor = paginate(request, queryset, orderings)
+    except InvalidCursor:
+        return rc.BAD_REQUEST
+    if structure is not None:
+        objects = [structure(o) for o in objects]
+    return {
+        'results' : objects,
+        'next' : next_cursor,
+        'previous' : previous_cursor,
+    }
+
+def attribute_filters(request):
+    """
+        Reads attribute filters like ?attr.size=M&attr.color=blue,red into
+        {'size': ['M'], 'color': ['blue', 'red']}.
+    """
+    filters = {}
+    for key in request.GET:
+        if key.startswith(ATTRIBUTE_PREFIX) and len(key) > len(ATTRIBUTE_PREFIX):
+            values = [v for value in request.GET.getlist(key) for v in value.split(',') if v]
+            if values:
+                filters[key[len(ATTRIBUTE_PREFIX):]] = values
+    return filters
+
+def product_payload(product_pk):
+    def dependencies():
+        # Moving the product changes its own generation, so these can't go
+        # stale without the payload going stale too
+        related = Product.objects.filter(pk=product_pk).values_list('category', 'brand', 'brand__manufacturer')[:1]
+        return [('product', int(product_pk))] + [dependency for row in related
+            for dependency in zip(('category', 'brand', 'manufacturer'), row)]
+    
+    def build():
+        return structure_products(prefetch_products(Product.objects.all()).get(pk=product_pk))
+    return read_through(product_key(product_pk), dependencies, build)
+
 class ProductCategoryHandler(BaseHandler):
     allowed_methods = ('GET',)
     model = ProductCategory
+    orderings = ('pk', 'path')
     
+    @instrumented('api.categories.read')
     def read(self, request, slug=None):
         if slug:
+            def dependencies():
+                # Adding or moving a child changes the parent's generation
+                shown = ProductCategory.objects.filter(Q(active=True, slug=slug) | Q(parent__active=True, parent__slug=slug))
+                return [('category', pk) for pk in shown.values_list('pk', flat=True)]
+            
+            def build():
+                category = ProductCategory.objects.get(active=True, slug=slug)
+                return {
+                    'details' : structure_category(category),
+                    'children' : [{child.slug : structure_category(child)} for child in category.children.all()],
+                }
+            
             try:
-                category = ProductCategory.objects.select_related().get(active=True, slug=slug)
-                children = []
-                for child in category.children.all():
-                    logging.debug(child)
-                    children.append({child.slug : child})
-                response = {'details' : category, 'children' : children, }
-                
+                response = read_through(category_key(slug), dependencies, build)
             except ProductCategory.DoesNotExist:
                 response = None
             return response
             
         else:
-            try:
-                categories = ProductCategory.objects.filter(active=True, parent=None)
-            except ProductCategory.DoesNotExist:
-                categories = None
-            return categories
+            categories = ProductCategory.objects.filter(active=True, parent=None)
+            return paginated(request, categories, self.orderings)
+
+class CategoryProductsHandler(BaseHandler):
+    allowed_methods = ('GET',)
+    
+    @instrumented('api.categories.products')
+    def read(self, request, slug):
+        """
+            Lists the active products anywhere under the category, only
+            those in stock with ?in_stock=1.
+        """
+        try:
+            category = ProductCategory.objects.get(active=True, slug=slug)
+        except ProductCategory.DoesNotExist:
+            return rc.NOT_FOUND
+        products = category.get_subtree_products().filter(is_active=True)
+        if request.GET.get('in_stock'):
+            products = products.filter(in_stock_variants__gt=0)
+        products = products.with_attributes(attribute_filters(request))
+        return paginated(request, prefetch_products(products), ProductHandler.orderings, structure_product)
+
+class CategoryTreeHandler(BaseHandler):
+    allowed_methods = ('GET',)
+    
+    @instrumented('api.categories.tree')
+    def read(self, request):
+        """
+            Returns every active category with an active path from the
+            root, root first and each followed by its subtree, with their
+            product counts. One query.
+        """
+        tree = []
+        listed = set()
+        for category in ProductCategory.objects.filter(active=True).order_by('path'):
+            if category.parent_id is None or category.parent_id in listed:
+                listed.add(category.pk)
+                tree.append(structure_category(category))
+        return {
+            'results' : tree,
+        }
 
 class ProductHandler(BaseHandler):
     allowed_methods = ('GET',)
     exclude = (),
     model = Product
+    orderings = ('pk', 'created_on', 'last_updates')
     
+    @instrumented('api.products.read')
     def read(self, request, product_pk=None):
         if product_pk:
             try:
-                product = Product.objects.select_related().get(pk=product_pk)   
-                stock = StockItem.objects.filter(product=product)
-                colors = []
-                for s in stock:
-                    colors.append(s.color)
-                response = {
-                    'product' : product,
-                    'stock' : stock,
-                    'colors' : colors,
-                }
+                response = product_payload(product_pk)
             except Product.DoesNotExist:
                 response = None
             return response
             
         else: 
-            try:
-                products = Product.objects.select_related().all()
-                response = structure_products(products)
-                
-            except Product.DoesNotExist:
-                response = None
+            products = Product.objects.all()
+            if request.GET.get('category'):
+                try:
+                    category = ProductCategory.objects.get(active=True, slug=request.GET['category'])
+                except ProductCategory.DoesNotExist:
+                    return rc.NOT_FOUND
+                products = products.filter(category__path__startswith=category.path)
+            filters = attribute_filters(request)
+            page = lambda: paginated(request, prefetch_products(products.with_attributes(filters)), self.orderings, structure_product)
+            if not request.GET.get('facets'):
+                return page()
+            response, facets = gather(page, lambda: products.facet_counts(filters))
+            if isinstance(response, dict):
+                response['facets'] = facets
             return response
 
+class ProductPageHandler(BaseHandler):
+    allowed_methods = ('GET',)
+    
+    @instrumented('api.products.page')
+    def read(self, request, product_pk):
+        """
+            Returns everything a product page shows: the product, the
+            categories down to it and its related products. The lookups
+            don't depend on each other and run concurrently on the
+            read pool, see api.concurrent.
+        """
+        def breadcrumbs():
+            categories = list(ProductCategory.objects.filter(product=product_pk))
+            if not categories:
+                return []
+            return [structure_category(c) for c in list(categories[0].get_ancestors()) + categories]
+        
+        def related():
+            pks = related_products([int(product_pk)], limit=RELATED_LIMIT)
+            products = dict((p.pk, p) for p in prefetch_products(Product.objects.filter(pk__in=pks)))
+            return [structure_product(products[pk]) for pk in pks if pk in products]
+        
+        try:
+            product, path, related = gather(lambda: product_payload(product_pk), breadcrumbs, related)
+        except Product.DoesNotExist:
+            return rc.NOT_FOUND
+        return {
+            'product' : product,
+            'breadcrumbs' : path,
+            'related' : related,
+        }
+
+class ProductSearchHandler(BaseHandler):
+    allowed_methods = ('GET',)
+    
+    @instrumented('api.products.search')
+    def read(self, request):
+        """
+            Returns the products matching every term of 'q', best match
+            first.
+        """
+        query = request.GET.get('q', '')
+        if not tokenize(query):
+            return rc.BAD_REQUEST
+        try:
+            pks, next_cursor, previous_cursor = paginate_offsets(request,
+                lambda offset, limit: search_products(query, offset, limit))
+        except InvalidCursor:
+            return rc.BAD_REQUEST
+        products = dict((p.pk, p) for p in prefetch_products(Product.objects.filter(pk__in=pks)))
+        return {
+            'results' : [structure_product(products[pk]) for pk in pks if pk in products],
+            'next' : next_cursor,
+            'previous' : previous_cursor,
+        }
+
+class RelatedProductsHandler(BaseHandler):
+    allowed_methods = ('GET',)
+    
+    @instrumented('api.products.related')
+    def read(self, request, product_pk):
+        """
+            Returns the active, in stock products related to product_pk
+            within 'hops' relationships, nearest first.
+        """
+        try:
+            hops = int(request.GET.get('hops', 1))
+            limit = min(int(request.GET.get('limit', RELATED_LIMIT)), MAX_PAGE_SIZE)
+        except ValueError:
+            return rc.BAD_REQUEST
+        pks = related_products([int(product_pk)], hops, limit)
+        products = dict((p.pk, p) for p in prefetch_products(Product.objects.filter(pk__in=pks)))
+        return {
+            'results' : [structure_product(products[pk]) for pk in pks if pk in products],
+        }
+
+class BestSellersHandler(BaseHandler):
+    allowed_methods = ('GET',)
+    
+    @instrumented('api.products.best_sellers')
+    def read(self, request):
+        """
+            Returns the products that sold the most over the last 'days',
+            optionally within the subtree of 'category', with their units.
+        """
+        try:
+            days = int(request.GET.get('days', BEST_SELLER_DAYS))
+            limit = min(int(request.GET.get('limit', RELATED_LIMIT)), MAX_PAGE_SIZE)
+        except ValueError:
+            return rc.BAD_REQUEST
+        if days < 1 or limit < 1:
+            return rc.BAD_REQUEST
+        category = None
+        if request.GET.get('category'):
+            try:
+                category = ProductCategory.objects.get(active=True, slug=request.GET['category'])
+            except ProductCategory.DoesNotExist:
+                return rc.NOT_FOUND
+        ranked = best_sellers(category, days, limit=limit)
+        products = dict((p.pk, p) for p in prefetch_products(Product.objects.filter(pk__in=[pk for pk, units in ranked])))
+        return {
+            'results' : [{'product': structure_product(products[pk]), 'units': units} for pk, units in ranked if pk in products],
+        }
+
 class StockHandler(BaseHandler):
-    allwed_methods = ('GET',)
+    allowed_methods = ('GET',)
     exclude = ()
     model = StockItem
     
-    def read(self, request, product_pk=None):
-        if pk:
-            try:
-                stock = StockItem.objects.select_related().filter(product=product_pk)
-            except StockItem.DoesNotExist:
-                stock = None
-            return stock
+    @instrumented('api.stock.read')
+    def read(self, request, product_pk):
+        return StockItem.objects.select_related().filter(product=product_pk)
 
 class CartHandler(CsrfExemptBaseHandler):
     allowed_methods = ('GET', 'PUT',)
     exclude = (),
     model = CartItem
+    
+    def structure_cart(self, cart):
+        cart_info = cart.summary()
+        cart_items = []
+        if cart_info is not None:
+            lines = CartItem.objects.filter(cart=cart_info).select_related('stock_item__product__thumbnail')
+            for i in lines:
+                product = i.stock_item.product
+                cart_items.append({
+                    'pk' : i.pk,
+                    'stock_item' : i.stock_item_id,
+                    'product' : {
+                        'id' : product.pk,
+                        'title' : product.title,
+                        'sku' : product.sku,
+                    },
+                    'package_title' : i.stock_item.package_title,
+                    'package_count' : i.stock_item.package_count,
+                    'quantity' : i.quantity,
+                    'unit_price' : i.stock_item.get_effective_price(),
+                    'thumbnail' : product.thumbnail and product.thumbnail.image_file.url,
+                })
         
+        return {
+            'checked_out' : cart_info is not None and cart_info.checked_out,
+            'created_on' : cart_info is not None and cart_info.created_on or None,
+            'items' : cart_items,
+            'totals' : cart.totals(),
+        }
+        
+    @instrumented('api.cart.read')
     def read(self, request, pk=None):
         cart = Cart(request)
         cart_info = cart.summary()
     
         if pk:
+            if cart_info is None:
+                return rc.NOT_FOUND
             try:
                 cart_item = CartItem.objects.get(pk=pk, cart=cart_info.pk)
             except CartItem.DoesNotExist:
@@ -112,70 +338,38 @@ class CartHandler(CsrfExemptBaseHandler):
             }
             
         else:
-            cart_items = []                
-            for i in cart:
-                item_gallery = ProductGallery.objects.get(product=i.stock_item.product, color=i.stock_item.color)                
-                cart_items.append({
-                    'product' : i.stock_item.product,
-                    'package_count' : i.stock_item.package_count,
-                    'color' : i.stock_item.color,
-                    'measurement': i.stock_item.measurement,
-                    'thumbnails' : build_thumbnail_list(item_gallery),
-                })
-        
-            response = {
-                'checked_out' : cart_info.checked_out,
-                'created_on' : cart_info.created_on,
-                'items' : cart_items,
-            }
+            response = self.structure_cart(cart)
             
         return response
     
-    
-    @validate(CartItemForm, 'PUT')
+    @instrumented('api.cart.update')
     def update(self, request):
-        try:
-            item = StockItem.objects.get(
-                color=request.form.cleaned_data['color'], 
-                measurement=request.form.cleaned_data['measurement'], 
-                product=request.form.cleaned_data['product'])
-        except StockItem.DoesNotExist:
+        """
+            Sets the quantity of one line (stock_item, quantity) or of many
+            at once, sent as a list of lines or as {'lines': [...]}. A
+            quantity of 0 removes the line.
+        """
+        data = request.data
+        if isinstance(data, dict) and 'lines' in data:
+            lines = data['lines']
+        elif isinstance(data, (list, tuple)):
+            lines = data
+        else:
+            lines = [data]
+        
+        quantities = {}
+        for line in lines:
+            form = CartItemForm(line)
+            if not form.is_valid():
+                raise FormValidationError(form)
+            quantities[form.cleaned_data['stock_item']] = form.cleaned_data['quantity']
+        
+        found = StockItem.objects.filter(pk__in=quantities.keys()).values_list('pk', flat=True)
+        if len(found) != len(quantities):
             return rc.NOT_FOUND
         
-        quantity = request.form.cleaned_data['quantity']
         cart = Cart(request)
-        cart.update(item, item.get_price(), quantity)
-        cart_info = cart.summary()
-        cart_items = []
-        for i in cart:
-            thumb = i.stock_item.product.get_thumb()
-            cart_items.append({
-                'product' : i.stock_item.product,
-                'package_count' : i.stock_item.package_count,
-                'quantity' : i.quantity,
-                'unit_price' : i.stock_item.get_price(),
-                'color' : i.stock_item.color,
-                'measurement': i.stock_item.measurement,
-                'thumbnail' : {
-                    '80x80' : thumb.url_80x80,
-                }
-            })
-                
-        thumb = item.product.get_thumb()        
-        response = {
-            'checked_out' : cart_info.checked_out,
-            'created_on' : cart_info.created_on,
-            'items' : cart_items,
-            'last_added' : {
-                'product' : item.product,
-                'package_count' : item.package_count,
-                'quantity' : quantity,
-                'unit_price' : item.get_price(),
-                'color' : item.color,
-                'measurement' : item.measurement,
-                'thumbnail' : {
-                    '80x80' : thumb.url_80x80,
-                }
-            }
-        }
+        shortfalls = cart.update_many(quantities.items())
+        response = self.structure_cart(cart)
+        response['shortfalls'] = shortfalls
         return response
@@ -0,0 +1,145 @@
+import base64
+import json
+from datetime import datetime
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+PAGE_SIZE = getattr(settings, 'STOCKROOM_API_PAGE_SIZE', 50)
+MAX_PAGE_SIZE = getattr(settings, 'STOCKROOM_API_MAX_PAGE_SIZE', 200)
+
+class InvalidCursor(Exception):
+    pass
+
+def _encode_value(value):
+    # Full precision isoformat; DjangoJSONEncoder drops microseconds
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+def encode_cursor(ordering, values, forward):
+    data = json.dumps([ordering, values, forward], default=_encode_value, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+        ordering, values, forward = json.loads(data)
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(ordering, basestring) or not isinstance(values, list) or not isinstance(forward, bool):
+        raise InvalidCursor(cursor)
+    return ordering, values, forward
+
+def _limit(request):
+    try:
+        limit = min(int(request.GET.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+        raise InvalidCursor(request.GET['limit'])
+    if limit < 1:
+        raise InvalidCursor(request.GET['limit'])
+    return limit
+
+def _keys(ordering):
+    field = ordering.lstrip('-')
+    if field == 'pk':
+        return ['pk']
+    # pk breaks ties so every row has a unique position
+    return [field, 'pk']
+
+def _coerce(model, keys, values):
+    """
+        Converts decoded cursor values to the types of the ordering fields,
+        so a tampered cursor is rejected instead of failing in the query.
+    """
+    coerced = []
+    for key, value in zip(keys, values):
+        field = key == 'pk' and model._meta.pk or model._meta.get_field(key)
+        if value is None or isinstance(value, (bool, list, dict)):
+            raise InvalidCursor(value)
+        try:
+            coerced.append(field.to_python(value))
+        except ValidationError:
+            raise InvalidCursor(value)
+    return coerced
+
+def _after(keys, values, descending):
+    """
+        Builds the filter for rows strictly after values in the ordering,
+        i.e. (a > x) OR (a = x AND b > y) for keys (a, b).
+    """
+    lookup = descending and 'lt' or 'gt'
+    condition = None
+    for i in range(len(keys) - 1, -1, -1):
+        q = Q(**{'%s__%s' % (keys[i], lookup): values[i]})
+        if condition is not None:
+            q = q | (Q(**{keys[i]: values[i]}) & condition)
+        condition = q
+    return condition
+
+def paginate(request, queryset, orderings, default_ordering='pk'):
+    """
+        Returns one page of queryset as (objects, next_cursor,
+        previous_cursor) using keyset pagination, so any page costs the same
+        as the first. The request may pass 'order' (one of orderings,
+        optionally prefixed with '-'), 'limit' and an opaque 'cursor' from a
+        previous response. Raises InvalidCursor for bad input.
+    """
+    limit = _limit(request)
+    cursor = request.GET.get('cursor')
+    if cursor:
+        ordering, values, forward = decode_cursor(cursor)
+    else:
+        ordering, values, forward = request.GET.get('order', default_ordering), None, True
+    if ordering.lstrip('-') not in orderings:
+        raise InvalidCursor(ordering)
+
+    keys = _keys(ordering)
+    descending = ordering.startswith('-')
+    if values is not None:
+        if len(values) != len(keys):
+            raise InvalidCursor(cursor)
+        values = _coerce(queryset.model, keys, values)
+        queryset = queryset.filter(_after(keys, values, descending != (not forward)))
+
+    direction = (descending != (not forward)) and '-' or ''
+    objects = list(queryset.order_by(*[direction + key for key in keys])[:limit + 1])
+    has_more = len(objects) > limit
+    objects = objects[:limit]
+    if not forward:
+        objects.reverse()
+
+    def position(obj):
+        return [getattr(obj, key) for key in keys]
+
+    next_cursor = previous_cursor = None
+    if objects:
+        if has_more or not forward:
+            next_cursor = encode_cursor(ordering, position(objects[-1]), True)
+        if values is not None and (forward or has_more):
+            previous_cursor = encode_cursor(ordering, position(objects[0]), False)
+    return objects, next_cursor, previous_cursor
+
+def paginate_offsets(request, fetch):
+    """
+        Pages through results without a stable key to resume from, such as
+        ranked search hits, so the cursor carries an offset instead.
+        fetch(offset, limit) returns a list. Returns (objects, next_cursor,
+        previous_cursor) like paginate.
+    """
+    limit = _limit(request)
+    offset = 0
+    cursor = request.GET.get('cursor')
+    if cursor:
+        ordering, values, forward = decode_cursor(cursor)
+        if ordering != 'offset' or len(values) != 1 or not isinstance(values[0], int) or values[0] < 0:
+            raise InvalidCursor(cursor)
+        offset = values[0]
+
+    objects = fetch(offset, limit + 1)
+    next_cursor = previous_cursor = None
+    if len(objects) > limit:
+        next_cursor = encode_cursor('offset', [offset + limit], True)
+    if offset:
+        previous_cursor = encode_cursor('offset', [max(offset - limit, 0)], True)
+    return objects[:limit], next_cursor, previous_cursor
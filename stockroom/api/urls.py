@@ -1,18 +1,35 @@
 from django.conf.urls.defaults import *
 from piston.resource import Resource
 
-from handlers import ProductCategoryHandler, ProductHandler, StockHandler, CartHandler
+from handlers import ProductCategoryHandler, CategoryProductsHandler, CategoryTreeHandler, ProductHandler, ProductSearchHandler, \
+    ProductPageHandler, RelatedProductsHandler, BestSellersHandler, StockHandler, CartHandler
+from conditional import product_condition, category_condition
+from views import export_products
 
 category_handler = Resource(ProductCategoryHandler)
+category_products_handler = Resource(CategoryProductsHandler)
+category_tree_handler = Resource(CategoryTreeHandler)
 product_handler = Resource(ProductHandler)
+search_handler = Resource(ProductSearchHandler)
+related_handler = Resource(RelatedProductsHandler)
+page_handler = Resource(ProductPageHandler)
+best_sellers_handler = Resource(BestSellersHandler)
 stock_handler = Resource(StockHandler)
 cart_handler = Resource(CartHandler)
 
 urlpatterns = patterns('',
-    url(r'^categories/$', category_handler),
-    url(r'^categories/(?P<slug>[-\w]+)/$', category_handler),
-    url(r'^products/$', product_handler),
-    url(r'^products/(?P<product_pk>\d+)/$', product_handler),
-    url(r'^cart/$', cart_handler),
-    url(r'^cart/(?P<pk>\d+)/$', cart_handler),
-)
\ No newline at end of file
+    url(r'^categories/$', category_handler, name='stockroom-api-categories'),
+    url(r'^categories/(?P<slug>[-\w]+)/$', category_condition(category_handler), name='stockroom-api-category'),
+    url(r'^categories/(?P<slug>[-\w]+)/products/$', category_products_handler, name='stockroom-api-category-products'),
+    url(r'^category-tree/$', category_tree_handler, name='stockroom-api-category-tree'),
+    url(r'^products/$', product_handler, name='stockroom-api-products'),
+    url(r'^products/export/$', export_products, name='stockroom-api-products-export'),
+    url(r'^products/best-sellers/$', best_sellers_handler, name='stockroom-api-products-best-sellers'),
+    url(r'^products/search/$', search_handler, name='stockroom-api-products-search'),
+    url(r'^products/(?P<product_pk>\d+)/$', product_condition(product_handler), name='stockroom-api-product'),
+    url(r'^products/(?P<product_pk>\d+)/page/$', page_handler, name='stockroom-api-product-page'),
+    url(r'^products/(?P<product_pk>\d+)/related/$', related_handler, name='stockroom-api-product-related'),
+    url(r'^products/(?P<product_pk>\d+)/stock/$', stock_handler, name='stockroom-api-product-stock'),
+    url(r'^cart/$', cart_handler, name='stockroom-api-cart'),
+    url(r'^cart/(?P<pk>\d+)/$', cart_handler, name='stockroom-api-cart-item'),
+)
@@ -0,0 +1,40 @@
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_GET
+from stockroom.models import ProductCategory
+from stockroom.export import export_queryset, iter_ndjson, iter_gzip
+
+@require_GET
+def export_products(request):
+    """
+        Streams the catalog as NDJSON. Accepts 'category' (a slug, exports
+        its whole subtree), 'active' and 'since' (an ISO datetime). The body
+        is gzipped as it is produced when the client accepts it; it is
+        never buffered, so middleware that reads response.content must not
+        run on this view.
+    """
+    category = None
+    if request.GET.get('category'):
+        try:
+            category = ProductCategory.objects.get(slug=request.GET['category'])
+        except ProductCategory.DoesNotExist:
+            raise Http404
+    since = None
+    if request.GET.get('since'):
+        try:
+            since = parse_datetime(request.GET['since'])
+        except ValueError:
+            pass
+        if since is None:
+            return HttpResponseBadRequest('since must be an ISO datetime')
+    active_only = request.GET.get('active') in ('1', 'true')
+
+    body = iter_ndjson(export_queryset(category, active_only, since))
+    compress = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if compress:
+        body = iter_gzip(body)
+    response = HttpResponse(body, content_type='application/x-ndjson')
+    if compress:
+        response['Content-Encoding'] = 'gzip'
+    response['Vary'] = 'Accept-Encoding'
+    return response
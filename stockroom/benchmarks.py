@@ -0,0 +1,383 @@
+"""
+Benchmarks for the API handlers and the session cart over a synthetic
+catalog. Every scenario reports its median wall time, the most queries
+any run made and the most memory any run took, so a stored run can serve
+as a baseline for later ones. Memory is the peak traced by tracemalloc
+where it exists and otherwise the growth of the current resident set.
+"""
+import json
+import random
+import resource
+import threading
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+from django.db import connection, connections, reset_queries
+from django.db.models import Max
+from django.test.client import RequestFactory
+from models import Manufacturer, Brand, ProductCategory, Product, ProductImage, ProductRelationship, StockItem, \
+    StockItemAttribute, StockItemAttributeValue, StockReservation, Cart as CartModel, CartItem
+from cart import Cart, CART_SUMMARY
+from caching import invalidate
+from search import rebuild_index
+from thumbnails import PRODUCT_THUMBNAILS, variant_name
+from api.pagination import encode_cursor
+from api import concurrent
+from api.urls import product_handler, page_handler, category_handler, search_handler, cart_handler
+from api.views import export_products
+
+CATALOG_DEFAULTS = {
+    'products' : 1000,
+    'variants' : 3,
+    'attributes' : 2,
+    'values' : 5,
+    'depth' : 3,
+    'branching' : 3,
+    'images' : 1,
+    'related' : 3,
+    'carts' : 100,
+    'lines' : 3,
+}
+# Timing differences below this many seconds are noise, never regressions
+MIN_SECONDS = 0.005
+# Memory growth below this many KB is noise
+MIN_MEMORY_KB = 1024
+WORDS = ('cotton', 'steel', 'classic', 'travel', 'organic', 'compact', 'deluxe', 'vintage', 'pocket', 'studio')
+
+def _next_pk(model):
+    return (model.objects.aggregate(pk=Max('pk'))['pk'] or 0) + 1
+
+def seed_catalog(seed=0, **options):
+    """
+        Fills the database with a synthetic catalog: a category tree of the
+        given depth and branching, products spread over its leaves with
+        variants, attribute values and images, and open carts. Rows are
+        written with bulk_create and given explicit pks. Returns a dict
+        describing what was created.
+    """
+    config = dict(CATALOG_DEFAULTS, **options)
+    rnd = random.Random(seed)
+
+    leaves = []
+    def grow(parent, level, prefix):
+        for i in range(config['branching']):
+            slug = '%s-%d' % (prefix, i)
+            category = ProductCategory(name='Category %s' % slug, slug=slug, parent=parent)
+            category.save()
+            if level < config['depth']:
+                grow(category, level + 1, slug)
+            else:
+                leaves.append(category)
+    grow(None, 1, 'bench')
+
+    manufacturer = Manufacturer.objects.create(name='Bench Manufacturing')
+    brands = [Brand.objects.create(name='Brand %d' % i, manufacturer=manufacturer) for i in range(10)]
+
+    values = []
+    for a in range(config['attributes']):
+        attribute = StockItemAttribute.objects.create(name='Attribute %d' % a, slug='bench-attr-%d' % a)
+        values.append([StockItemAttributeValue.objects.create(attribute=attribute, value='v%d' % v).pk
+            for v in range(config['values'])])
+
+    first_product, first_item, first_image = _next_pk(Product), _next_pk(StockItem), _next_pk(ProductImage)
+    products, items, images, links = [], [], [], []
+    through = StockItem.attributes.through
+    for n in range(config['products']):
+        pk = first_product + n
+        words = rnd.sample(WORDS, 3)
+        products.append(Product(pk=pk, title=' '.join(words).title(), description=' '.join(rnd.sample(WORDS, 5)),
+            sku='BENCH-%d' % pk, category_id=rnd.choice(leaves).pk, brand_id=rnd.choice(brands).pk))
+        for v in range(config['variants']):
+            item_pk = first_item + n * config['variants'] + v
+            items.append(StockItem(pk=item_pk, product_id=pk, sku='BENCH-%d-%d' % (pk, v), package_title='Pack of %d' % (v + 1),
+                inventory=rnd.randint(0, 50), price='%d.%02d' % (rnd.randint(1, 200), rnd.randint(0, 99))))
+            for choices in values:
+                links.append(through(stockitem_id=item_pk, stockitemattributevalue_id=rnd.choice(choices)))
+        for i in range(config['images']):
+            name = 'bench/%d-%d.jpg' % (pk, i)
+            variants = [{'size': '%sx%s' % size, 'width': size[0], 'height': size[1], 'path': variant_name(name, *size),
+                'url': '/media/' + variant_name(name, *size)} for size in PRODUCT_THUMBNAILS]
+            images.append(ProductImage(pk=first_image + n * config['images'] + i, product_id=pk, image_file=name,
+                variants=json.dumps(variants)))
+    relationships = []
+    for p in products:
+        for to_product in rnd.sample(products, min(config['related'], len(products))):
+            if to_product is not p:
+                relationships.append(ProductRelationship(from_product_id=p.pk, to_product_id=to_product.pk, description='bench'))
+    Product.objects.bulk_create(products)
+    ProductRelationship.objects.bulk_create(relationships)
+    # bulk_create sends no signals for the in-memory graph to follow
+    invalidate('related', ['graph'])
+    StockItem.objects.bulk_create(items)
+    through.objects.bulk_create(links)
+    ProductImage.objects.bulk_create(images)
+    Product.objects.refresh_stock_summary()
+    rebuild_index()
+
+    first_cart = _next_pk(CartModel)
+    carts = [CartModel(pk=first_cart + n) for n in range(config['carts'])]
+    CartModel.objects.bulk_create(carts)
+    lines = []
+    for cart in carts:
+        for item in rnd.sample(items, min(config['lines'], len(items))):
+            lines.append(CartItem(cart_id=cart.pk, stock_item_id=item.pk, quantity=rnd.randint(1, 3)))
+    CartItem.objects.bulk_create(lines)
+
+    return {
+        'config' : config,
+        'products' : [p.pk for p in products],
+        'items' : [i.pk for i in items],
+        'categories' : [c.slug for c in leaves],
+        'carts' : [c.pk for c in carts],
+        'attribute' : config['attributes'] and 'bench-attr-0' or None,
+    }
+
+def resident_memory_kb():
+    """
+        Returns the current resident set of the process. ru_maxrss, the
+        fallback where /proc is missing, only ever grows.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (IOError, OSError):
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _memory_start():
+    if tracemalloc is not None:
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+    return resident_memory_kb()
+
+def _memory_used_kb(start):
+    if tracemalloc is not None:
+        return (tracemalloc.get_traced_memory()[1] - start) // 1024
+    return max(0, resident_memory_kb() - start)
+
+def measure(run, setup=None, repeat=5):
+    """
+        Runs run(setup()) repeat times after a warm-up run and returns its
+        median wall time, the most queries and the most memory one run
+        took.
+    """
+    times, queries, memory = [], [], []
+    tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    try:
+        # One unmeasured run first so imports and cold database pages don't count
+        for i in range(repeat + 1):
+            state = None
+            if setup is not None:
+                state = setup()
+            reset_queries()
+            start = _memory_start()
+            started = time.time()
+            run(state)
+            if i:
+                times.append(time.time() - started)
+                queries.append(len(connection.queries))
+                memory.append(_memory_used_kb(start))
+    finally:
+        if tracing:
+            tracemalloc.stop()
+    times.sort()
+    return {
+        'seconds' : round(times[len(times) // 2], 6),
+        'queries' : max(queries),
+        'memory_kb' : max(memory),
+    }
+
+def _request(method='get', path='/', data=None, session=None):
+    factory = RequestFactory()
+    if method == 'put':
+        request = factory.put(path, json.dumps(data), content_type='application/json')
+    else:
+        request = factory.get(path, data or {})
+    request.session = session if session is not None else {}
+    return request
+
+def _consume(response):
+    for chunk in response:
+        pass
+
+def scenarios(catalog):
+    """
+        Returns {name: (run, setup)} for every endpoint and Cart method.
+    """
+    products, items = catalog['products'], catalog['items']
+    middle = products[len(products) // 2]
+    deep = encode_cursor('pk', [products[int(len(products) * 0.9)]], True)
+    word = Product.objects.get(pk=middle).title.split()[0]
+    root = ProductCategory.objects.get(slug='bench-0').pk
+    facets = {'facets': 1}
+    if catalog['attribute']:
+        facets['attr.%s' % catalog['attribute']] = 'v0'
+
+    def cold_product(state):
+        invalidate('product', [middle])
+        product_handler(_request(path='/products/%d/' % middle), product_pk=str(middle))
+
+    def cold_category(state):
+        invalidate('category', [root])
+        category_handler(_request(path='/categories/bench-0/'), slug='bench-0')
+
+    def cold_page(state):
+        invalidate('product', [middle])
+        page_handler(_request(path='/products/%d/page/' % middle), product_pk=str(middle))
+
+    # Cart scenarios hold and sell these; every run starts from the same
+    # inventory and no holds
+    touched = items[:20]
+    inventory = dict(StockItem.objects.filter(pk__in=touched).values_list('pk', 'inventory'))
+
+    def restore_stock():
+        StockReservation.objects.filter(stock_item__in=touched).delete()
+        sold = [pk for pk, units in StockItem.objects.filter(pk__in=touched).values_list('pk', 'inventory')
+            if units != inventory[pk]]
+        for pk in sold:
+            StockItem.objects.filter(pk=pk).update(inventory=inventory[pk])
+        if sold:
+            Product.objects.refresh_stock_summary(StockItem.objects.filter(pk__in=sold).values_list('product_id', flat=True))
+
+    def filled_cart():
+        restore_stock()
+        request = _request()
+        cart = Cart(request)
+        cart.update_many([(pk, 1) for pk in items[:5]])
+        return cart
+
+    def cart_with_session():
+        cart = filled_cart()
+        return cart.request.session
+
+    def cold_totals(cart):
+        cart.request.session.pop(CART_SUMMARY, None)
+        cart.totals()
+
+    return {
+        'api.products.list' : (lambda state: product_handler(_request(path='/products/')), None),
+        'api.products.list.deep' : (lambda state: product_handler(_request(path='/products/', data={'cursor': deep})), None),
+        'api.products.list.facets' : (lambda state: product_handler(_request(path='/products/', data=facets)), None),
+        'api.products.detail.cold' : (cold_product, None),
+        'api.products.detail.warm' : (lambda state: product_handler(_request(path='/products/%d/' % middle), product_pk=str(middle)), None),
+        'api.products.page.cold' : (cold_page, None),
+        'api.products.search' : (lambda state: search_handler(_request(path='/products/search/', data={'q': word})), None),
+        'api.products.export' : (lambda state: _consume(export_products(_request(path='/products/export/'))), None),
+        'api.categories.list' : (lambda state: category_handler(_request(path='/categories/')), None),
+        'api.categories.detail' : (lambda state: category_handler(_request(path='/categories/bench-0/'), slug='bench-0'), None),
+        'api.categories.detail.cold' : (cold_category, None),
+        'api.cart.read' : (lambda session: cart_handler(_request(path='/cart/', session=session)), cart_with_session),
+        'api.cart.update' : (lambda state: cart_handler(_request('put', '/cart/',
+            {'lines': [{'stock_item': pk, 'quantity': 2} for pk in items[:10]]})), restore_stock),
+        'cart.add' : (lambda cart: cart.add(StockItem.objects.get(pk=items[10]), None, 1), filled_cart),
+        'cart.update_many' : (lambda cart: cart.update_many([(pk, 2) for pk in items[:20]]), filled_cart),
+        'cart.get_quantity' : (lambda cart: cart.get_quantity(products[0]), filled_cart),
+        'cart.totals' : (cold_totals, filled_cart),
+        'cart.clear' : (lambda cart: cart.clear(), filled_cart),
+        'cart.checkout_cart' : (lambda cart: cart.checkout_cart(), filled_cart),
+    }
+
+def run_benchmarks(catalog, repeat=5, only=None):
+    """
+        Measures every scenario, or those whose name starts with only.
+        Returns {name: result}.
+    """
+    debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        results = {}
+        for name, (run, setup) in sorted(scenarios(catalog).items()):
+            if only and not name.startswith(only):
+                continue
+            results[name] = measure(run, setup, repeat)
+        return results
+    finally:
+        connection.use_debug_cursor = debug_cursor
+
+def compare(results, baseline, tolerance=0.5):
+    """
+        Returns a description of every scenario that is slower or uses more
+        memory than baseline by more than tolerance (a fraction), or makes
+        more queries at all.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['queries'] > base['queries']:
+            regressions.append('%s: %d queries, baseline %d' % (name, result['queries'], base['queries']))
+        if result['seconds'] > base['seconds'] * (1 + tolerance) and result['seconds'] - base['seconds'] > MIN_SECONDS:
+            regressions.append('%s: %.4fs, baseline %.4fs' % (name, result['seconds'], base['seconds']))
+        if result['memory_kb'] > base['memory_kb'] * (1 + tolerance) + MIN_MEMORY_KB:
+            regressions.append('%s: %d KB, baseline %d KB' % (name, result['memory_kb'], base['memory_kb']))
+    return regressions
+
+# Scenarios that gather independent lookups, see api.concurrent
+CONCURRENT_SCENARIOS = ('api.products.page.cold', 'api.products.list.facets')
+
+def measure_capacity(run, clients=8, seconds=2.0):
+    """
+        Calls run(None) from clients threads at once for seconds and returns
+        the requests served per second and the median and 95th percentile
+        latency. Every thread uses its own database connection.
+    """
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def client():
+        mine = []
+        try:
+            while time.time() < deadline:
+                started = time.time()
+                run(None)
+                mine.append(time.time() - started)
+        finally:
+            for alias in connections:
+                connections[alias].close()
+            with lock:
+                latencies.extend(mine)
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    if not latencies:
+        return {'requests_per_second': 0, 'p50_ms': None, 'p95_ms': None}
+    return {
+        'requests_per_second' : round(len(latencies) / float(seconds), 1),
+        'p50_ms' : round(latencies[len(latencies) // 2] * 1000, 3),
+        'p95_ms' : round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 3),
+    }
+
+def compare_read_workers(catalog, workers=4, clients=8, seconds=2.0, repeat=5):
+    """
+        Measures the scenarios in CONCURRENT_SCENARIOS with their lookups run
+        one after another and on workers threads: the latency of a single
+        request and the capacity under clients concurrent connections.
+        Needs a database other threads can reach.
+    """
+    saved = concurrent.READ_WORKERS
+    all_scenarios = scenarios(catalog)
+    results = {}
+    try:
+        for mode, count in (('sequential', 0), ('concurrent', workers)):
+            concurrent.READ_WORKERS = count
+            for name in CONCURRENT_SCENARIOS:
+                run, setup = all_scenarios[name]
+                results.setdefault(name, {})[mode] = {
+                    'latency_ms' : round(measure(run, setup, repeat)['seconds'] * 1000, 3),
+                    'capacity' : measure_capacity(run, clients, seconds),
+                }
+    finally:
+        concurrent.READ_WORKERS = saved
+    return results
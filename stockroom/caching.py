@@ -0,0 +1,102 @@
+"""
+Read-through cache for serialized catalog payloads.
+
+Every cached payload is stored with the generation of each object it was
+built from, e.g. the product, its category and its brand. Changing an
+object only increments its generation key, which makes every payload that
+recorded the old value stale; nothing is ever searched for or deleted.
+Generations start from a time based value so one that is evicted and
+recreated never matches an old payload.
+"""
+import time
+from django.conf import settings
+from django.core.cache import get_cache
+
+CACHE_ALIAS = getattr(settings, 'STOCKROOM_CACHE', 'default')
+CACHE_TIMEOUT = getattr(settings, 'STOCKROOM_CACHE_TIMEOUT', 60 * 60)
+# How long one worker may hold the right to rebuild a payload
+REBUILD_LOCK_TIMEOUT = getattr(settings, 'STOCKROOM_CACHE_LOCK_TIMEOUT', 10)
+REBUILD_WAIT = 0.05
+REBUILD_WAIT_STEPS = 10
+KEY_PREFIX = 'stockroom'
+
+def get_stockroom_cache():
+    return get_cache(CACHE_ALIAS)
+
+def generation_key(kind, pk):
+    return '%s:gen:%s:%s' % (KEY_PREFIX, kind, pk)
+
+def invalidate(kind, pks):
+    """
+        Marks every payload built from the given objects as stale.
+    """
+    cache = get_stockroom_cache()
+    for pk in set(pks):
+        if pk is None:
+            continue
+        try:
+            cache.incr(generation_key(kind, pk))
+        except ValueError:
+            # No generation yet means no payload can depend on one
+            pass
+
+def _generations(cache, keys):
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            value = int(time.time() * 1000)
+            if not cache.add(key, value, CACHE_TIMEOUT * 2):
+                value = cache.get(key, value)
+            generations[key] = value
+    return generations
+
+def current_generation(kind, pk):
+    """
+        Returns the generation of an object, starting one if it has none.
+    """
+    key = generation_key(kind, pk)
+    return _generations(get_stockroom_cache(), [key])[key]
+
+def read_through(key, dependencies, build):
+    """
+        Returns the payload cached under key, rebuilding it with build()
+        when it is missing or any generation it recorded has moved.
+        dependencies lists the (kind, pk) the payload depends on, or is a
+        function returning that list when it has to be looked up. Only one
+        worker rebuilds a key at a time, the others serve the stale copy or
+        briefly wait for the new one.
+    """
+    cache = get_stockroom_cache()
+    entry = cache.get(key)
+    if entry is not None and cache.get_many(entry['generations'].keys()) == entry['generations']:
+        return entry['payload']
+
+    lock = '%s:lock' % key
+    locked = cache.add(lock, 1, REBUILD_LOCK_TIMEOUT)
+    if not locked:
+        if entry is not None:
+            return entry['payload']
+        for step in range(REBUILD_WAIT_STEPS):
+            time.sleep(REBUILD_WAIT)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry['payload']
+
+    try:
+        # Read every generation before building so a change made while we
+        # build leaves the new entry stale rather than wrongly fresh
+        if callable(dependencies):
+            dependencies = dependencies()
+        generations = _generations(cache, [generation_key(kind, pk) for kind, pk in dependencies if pk is not None])
+        payload = build()
+        cache.set(key, {'generations': generations, 'payload': payload}, CACHE_TIMEOUT)
+    finally:
+        if locked:
+            cache.delete(lock)
+    return payload
+
+def product_key(pk):
+    return '%s:product:%s' % (KEY_PREFIX, pk)
+
+def category_key(slug):
+    return '%s:category:%s' % (KEY_PREFIX, slug)
@@ -1,6 +1,19 @@
 import datetime
-from models import Cart as CartModel, CartItem
+import time
+from decimal import Decimal
+from django.conf import settings
+from django.db import connections, IntegrityError
+from django.db.models import Sum
+from instrumentation import instrumented
+from related import related_products
+from models import Cart as CartModel, CartItem, StockItem, StockReservation, StockItemSales
 CART_ID = 'CART-ID'
+CART_SUMMARY = 'CART-SUMMARY'
+
+# Seconds a cached cart summary is trusted, so price changes show up eventually
+SUMMARY_TIMEOUT = getattr(settings, 'STOCKROOM_CART_SUMMARY_TIMEOUT', 300)
+# Whether checkouts update the sales rollups or leave it to stockroom_record_sales
+RECORD_SALES_AT_CHECKOUT = getattr(settings, 'STOCKROOM_RECORD_SALES_AT_CHECKOUT', True)
 
 class ItemAlreadyExists(Exception):
     pass
@@ -8,19 +21,39 @@ class ItemAlreadyExists(Exception):
 class ItemDoesNotExist(Exception):
     pass
 
+class CartDoesNotExist(Exception):
+    pass
+
 class Cart(object):
+    """
+        Session cart. Nothing is read from the database until the cart is
+        first used, and no Cart row is created until something is added.
+    """
     def __init__(self, request):
-        cart_id = request.session.get(CART_ID)
-        if cart_id:
-            try:
-                cart = CartModel.objects.get(id=cart_id, checked_out=False)
-            except CartModel.DoesNotExist:
-                cart = self.new(request)
-        else:
-            cart = self.new(request)
-        self.cart = cart
+        self.request = request
+        self._cart = None
+        self._loaded = False
+    
+    def _get_cart(self):
+        if not self._loaded:
+            cart_id = self.request.session.get(CART_ID)
+            if cart_id:
+                try:
+                    self._cart = CartModel.objects.get(id=cart_id, checked_out=False)
+                except CartModel.DoesNotExist:
+                    pass
+            self._loaded = True
+        return self._cart
+    cart = property(_get_cart)
+    
+    def _get_or_create_cart(self):
+        if self.cart is None:
+            self._cart = self.new(self.request)
+        return self._cart
         
     def __iter__(self):
+        if self.cart is None:
+            return
         for item in self.cart.cart_items.all():
             yield item
     
@@ -30,76 +63,220 @@ class Cart(object):
         request.session[CART_ID] = cart.id
         return cart
     
+    def _invalidate_summary(self):
+        self.request.session.pop(CART_SUMMARY, None)
+    
+    def _touch(self, cart):
+        # Abandoned carts are reaped by their last change, not their age
+        CartModel.objects.filter(pk=cart.pk).update(last_updates=datetime.datetime.now())
+    
+    @instrumented('cart.add')
     def add(self, stock_item, unit_price, quantity=1):
+        """
+            Sets the line for stock_item to quantity and holds that much
+            stock. The line only keeps the units that could be held; returns
+            the number of units that could not.
+        """
+        cart = self._get_or_create_cart()
+        self._invalidate_summary()
+        self._touch(cart)
+        missing = StockReservation.objects.hold(cart, stock_item, quantity)
+        quantity -= missing
         try:
-            cart_item = CartItem.objects.get(cart=self.cart, stock_item=stock_item)
-            cart_item.quantity = quantity
-            cart_item.save()
+            cart_item = CartItem.objects.get(cart=cart, stock_item=stock_item)
         except CartItem.DoesNotExist:
-            cart_item = CartItem()
-            cart_item.cart = self.cart
-            cart_item.stock_item = stock_item
-            cart_item.unit_price = unit_price
-            cart_item.quantity = quantity
-            cart_item.save()
+            if quantity:
+                cart_item = CartItem()
+                cart_item.cart = cart
+                cart_item.stock_item = stock_item
+                cart_item.unit_price = unit_price
+                cart_item.quantity = quantity
+                cart_item.save()
+        else:
+            if quantity:
+                cart_item.quantity = quantity
+                cart_item.save()
+            else:
+                cart_item.delete()
+        return missing
     
+    @instrumented('cart.remove')
     def remove(self, item):
+        if self.cart is None:
+            raise ItemDoesNotExist
+        self._invalidate_summary()
         try:
-            cart_item = CartItem.objects.get(pk=item.pk)
+            cart_item = CartItem.objects.get(pk=item.pk, cart=self.cart)
         except CartItem.DoesNotExist:
             raise ItemDoesNotExist
         else:
+            self._touch(self.cart)
+            StockReservation.objects.release(self.cart, [cart_item.stock_item_id])
             cart_item.delete()
     
+    @instrumented('cart.update')
     def update(self, stock_item, unit_price, quantity):
+        cart = self._get_or_create_cart()
+        self._invalidate_summary()
         try:
-            cart_item = CartItem.objects.get(cart=self.cart, stock_item=stock_item)
-            cart_item.cart = self.cart
-            cart_item.stock_item = stock_item
-            cart_item.unit_price = unit_price
-            cart_item.quantity = quantity
-            cart_item.save(force_update=True)
+            cart_item = CartItem.objects.get(cart=cart, stock_item=stock_item)
         except CartItem.DoesNotExist:
-            self.add(stock_item, unit_price, quantity)
+            return self.add(stock_item, unit_price, quantity)
+        self._touch(cart)
+        missing = StockReservation.objects.hold(cart, stock_item, quantity)
+        if quantity == missing:
+            cart_item.delete()
+            return missing
+        cart_item.cart = cart
+        cart_item.stock_item = stock_item
+        cart_item.unit_price = unit_price
+        cart_item.quantity = quantity - missing
+        cart_item.save(force_update=True)
+        return missing
+    
+    @instrumented('cart.update_many')
+    def update_many(self, lines):
+        """
+            Sets the quantity of several lines at once. lines is an iterable
+            of (stock_item, quantity); a quantity of 0 removes the line.
+            Existing lines are resolved in one query, new ones written with
+            one bulk_create and changed ones with one UPDATE per quantity.
+            Lines only keep the units that could be held; returns
+            {stock_item_pk: units that could not be held}.
+        """
+        quantities = dict((getattr(s, 'pk', s), quantity) for s, quantity in lines)
+        if not quantities:
+            return {}
+        cart = self._get_or_create_cart()
+        self._invalidate_summary()
+        self._touch(cart)
+        shortfalls = StockReservation.objects.hold_many(cart, quantities)
+        for stock_item_id, missing in shortfalls.items():
+            quantities[stock_item_id] -= missing
+        
+        existing = dict(CartItem.objects.filter(cart=cart, stock_item__in=quantities.keys()).values_list('stock_item', 'quantity'))
+        new = []
+        by_quantity = {}
+        for stock_item_id, quantity in quantities.items():
+            if stock_item_id not in existing:
+                if quantity:
+                    new.append(CartItem(cart=cart, stock_item_id=stock_item_id, quantity=quantity))
+            elif existing[stock_item_id] != quantity:
+                by_quantity.setdefault(quantity, []).append(stock_item_id)
+        
+        cart_items = CartItem.objects.filter(cart=cart)
+        for quantity, stock_item_ids in by_quantity.items():
+            if quantity:
+                cart_items.filter(stock_item__in=stock_item_ids).update(quantity=quantity)
+            else:
+                cart_items.filter(stock_item__in=stock_item_ids).delete()
+        CartItem.objects.bulk_create(new)
+        return shortfalls
+    
+    # Adding a line sets its quantity, exactly like updating it
+    add_many = update_many
     
+    @instrumented('cart.remove_many')
+    def remove_many(self, stock_items):
+        if self.cart is None:
+            return
+        self.update_many([(stock_item, 0) for stock_item in stock_items])
+    
+    @instrumented('cart.clear')
     def clear(self):
-        for cart_item in self.cart.cart_items.all():
-            cart_item.delete()
+        if self.cart is None:
+            return
+        self._invalidate_summary()
+        self._touch(self.cart)
+        StockReservation.objects.release(self.cart)
+        CartItem.objects.filter(cart=self.cart).delete()
     
+    @instrumented('cart.get_quantity')
     def get_quantity(self, product):
-        try:
-            cart_item = CartItem.objects.get(cart=self.cart, product=product)
-            return cart_item.quantity
-        
-        except models.CartItem.DoesNotExist:
+        if self.cart is None:
             return 0
+        quantity = CartItem.objects.filter(cart=self.cart, stock_item__product=product).aggregate(Sum('quantity'))
+        return quantity['quantity__sum'] or 0
     
     def total_quantity(self):
-        cart_quantity = 0
-        try:
-            cart_items = CartItem.objects.filter(cart=self.cart)
-        except CartItem.DoesNotExist:
-            return cart_quantity
-        
-        for item in cart_items:
-            cart_quantity = cart_quantity + item.quantity
-        
-        return cart_quantity
+        return self.totals()['item_count']
     
+    @instrumented('cart.related_products')
+    def related_products(self, hops=1, limit=5):
+        """
+            Returns the pks of active, in stock products related to what is
+            in the cart and not in it yet, best first.
+        """
+        if self.cart is None:
+            return []
+        products = set(CartItem.objects.filter(cart=self.cart).values_list('stock_item__product', flat=True))
+        return related_products(products, hops, limit)
+    
+    @instrumented('cart.checkout_cart')
     def checkout_cart(self):
-        self.cart.checked_out = True
-        self.cart.save()
-        return True
+        """
+            Takes the stock for every line and checks the cart out in one
+            transaction. Returns a dict of stock item pk to the units that
+            could not be supplied; the cart is only checked out when it is
+            empty. Raises CartDoesNotExist when there is no cart.
+        """
+        if self.cart is None:
+            raise CartDoesNotExist
+        self._invalidate_summary()
+        shortfalls = StockReservation.objects.commit(self.cart)
+        if not shortfalls:
+            self.cart.checked_out = True
+            if RECORD_SALES_AT_CHECKOUT:
+                try:
+                    StockItemSales.objects.record([self.cart.pk])
+                except IntegrityError:
+                    # A concurrent checkout created the same rollup row;
+                    # stockroom_record_sales picks the cart up later
+                    pass
+        return shortfalls
  
     def summary(self):
         return self.cart
     
     def subtotal(self):
-        try:
-            cart_items = CartItem.objects.filter(cart=self.cart)
-            subtotal = 0.0
-            for item in cart_items:
-                subtotal = subtotal + (item.quantity * float(item.stock_item.price))
-            return subtotal
-        except CartItem.DoesNotExist:
-            return 0.0
\ No newline at end of file
+        return self.totals()['subtotal']
+    
+    @instrumented('cart.totals')
+    def totals(self):
+        """
+            Returns the Decimal subtotal at effective prices, the number of
+            units and the number of lines in the cart. Served from the
+            session when possible, otherwise computed in one query.
+        """
+        cart_id = self.request.session.get(CART_ID)
+        cached = self.request.session.get(CART_SUMMARY)
+        if cached and cached['cart'] == cart_id and cached['expires'] > time.time():
+            return cached['totals']
+        
+        totals = {'subtotal': Decimal('0.00'), 'item_count': 0, 'line_count': 0}
+        if self.cart is None:
+            return totals
+        
+        connection = connections[CartItem.objects.db]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT SUM(ci.quantity * CASE WHEN s.on_sale = %%s AND s.sale_price IS NOT NULL '
+            'THEN s.sale_price ELSE s.price END), SUM(ci.quantity), COUNT(*) '
+            'FROM %s ci INNER JOIN %s s ON s.id = ci.stock_item_id WHERE ci.cart_id = %%s' % (
+                qn(CartItem._meta.db_table), qn(StockItem._meta.db_table)),
+            [True, self.cart.pk]
+        )
+        subtotal, item_count, line_count = cursor.fetchone()
+        if subtotal is not None:
+            # Some backends hand back floats for arithmetic on decimals
+            totals['subtotal'] = Decimal(str(subtotal)).quantize(Decimal('0.01'))
+        totals['item_count'] = int(item_count or 0)
+        totals['line_count'] = int(line_count or 0)
+        
+        self.request.session[CART_SUMMARY] = {
+            'cart': self.cart.pk,
+            'expires': time.time() + SUMMARY_TIMEOUT,
+            'totals': totals,
+        }
+        return totals
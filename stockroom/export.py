@@ -0,0 +1,52 @@
+"""
+Streams the catalog as newline delimited JSON, one structured product per
+line. Products are read in pk chunks with their relations prefetched, so
+memory stays flat however large the catalog is.
+"""
+import json
+import zlib
+from django.core.serializers.json import DjangoJSONEncoder
+from models import Product
+from utils import iter_structured_products, PRODUCT_CHUNK_SIZE
+
+def export_queryset(category=None, active_only=False, modified_since=None):
+    """
+        Returns the products to export, optionally limited to the subtree
+        of category, to active products and to products changed since a
+        datetime.
+    """
+    products = Product.objects.all()
+    if category is not None:
+        products = products.filter(category__path__startswith=category.path)
+    if active_only:
+        products = products.filter(is_active=True)
+    if modified_since is not None:
+        products = products.filter(last_updates__gte=modified_since)
+    return products
+
+def iter_ndjson(queryset, chunk_size=PRODUCT_CHUNK_SIZE):
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    for product in iter_structured_products(queryset, chunk_size):
+        yield encoder.encode(product) + '\n'
+
+def iter_gzip(chunks, level=6):
+    """
+        Gzips an iterable of strings as it goes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def write_ndjson(queryset, f, chunk_size=PRODUCT_CHUNK_SIZE):
+    """
+        Writes the products of queryset to the file f and returns how many
+        were written.
+    """
+    count = 0
+    for line in iter_ndjson(queryset, chunk_size):
+        f.write(line)
+        count += 1
+    return count
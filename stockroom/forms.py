@@ -3,7 +3,7 @@ from django.contrib.localflavor.us.forms import USStateField
 from models import CartItem
 
 class CartItemForm(forms.Form):
-    quantity = forms.IntegerField()
+    quantity = forms.IntegerField(min_value=0)
     stock_item = forms.IntegerField()
     
 class OrderForm(forms.Form):
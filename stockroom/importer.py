@@ -0,0 +1,399 @@
+"""
+Streaming catalog import.
+
+Rows are read one at a time from CSV or JSON lines and written in batches:
+lookups are one query per batch, new rows go through bulk_create and
+changed rows through one UPDATE per distinct change. Each batch runs in
+its own transaction inside deferred_stock_summary, so no per-row signals
+fire and every product touched by the batch is activated or deactivated
+and reindexed for search once at the end of it.
+
+One row describes one stock item:
+
+    sku             variant sku (optional, the upsert key when given)
+    product_sku     product sku (required, the product upsert key)
+    title           product title (required for new products)
+    description     product description
+    category        category names from the root down, separated by '/'
+    brand           brand name
+    manufacturer    manufacturer of the brand, used when creating it
+    package_title   identifies the variant when it has no sku
+    package_count, inventory, price (required), on_sale, sale_price
+    attributes      'size=M;color=Blue' in CSV, an object in JSON lines
+"""
+import csv
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from django.conf import settings
+from django.db.models import Q
+from django.template.defaultfilters import slugify
+from models import Manufacturer, Brand, ProductCategory, Product, StockItem, StockItemAttribute, \
+    StockItemAttributeValue, PriceHistory, deferred_stock_summary
+from search import index_products
+
+IMPORT_BATCH_SIZE = getattr(settings, 'STOCKROOM_IMPORT_BATCH_SIZE', 500)
+DEFAULT_PACKAGE_TITLE = 'Individual Item'
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 't')
+
+class RowError(Exception):
+    pass
+
+def read_csv(f):
+    for line, row in enumerate(csv.DictReader(f), 2):
+        yield line, dict((k, v.decode('utf-8')) for k, v in row.items() if k is not None and v is not None)
+
+def read_jsonl(f):
+    for line, raw in enumerate(f, 1):
+        if raw.strip():
+            yield line, raw
+
+def _text(row, key, required=False):
+    value = row.get(key)
+    if value is not None:
+        value = unicode(value).strip()
+    if required and not value:
+        raise RowError('%s is required' % key)
+    return value or None
+
+def _number(row, key, cast, default=None):
+    value = _text(row, key)
+    if value is None:
+        return default
+    try:
+        return cast(value)
+    except (ValueError, InvalidOperation):
+        raise RowError('%s is not a valid number: %r' % (key, value))
+
+def clean_row(raw):
+    """
+        Normalizes one CSV row (a dict) or JSON line (a string). Raises
+        RowError when the row can't be imported.
+    """
+    if isinstance(raw, basestring):
+        try:
+            raw = json.loads(raw)
+        except ValueError, e:
+            raise RowError('invalid JSON: %s' % e)
+        if not isinstance(raw, dict):
+            raise RowError('expected a JSON object')
+
+    attributes = raw.get('attributes') or {}
+    if isinstance(attributes, basestring):
+        try:
+            attributes = dict(pair.split('=', 1) for pair in attributes.split(';') if pair.strip())
+        except ValueError:
+            raise RowError('attributes must look like name=value;name=value')
+    attributes = [(unicode(k).strip(), unicode(v).strip()) for k, v in attributes.items() if unicode(k).strip()]
+
+    on_sale = raw.get('on_sale')
+    if not isinstance(on_sale, bool):
+        on_sale = unicode(on_sale or '').strip().lower() in TRUE_VALUES
+    price = _number(raw, 'price', Decimal)
+    if price is None:
+        raise RowError('price is required')
+    category = _text(raw, 'category')
+
+    return {
+        'sku' : _text(raw, 'sku'),
+        'product_sku' : _text(raw, 'product_sku', required=True),
+        'title' : _text(raw, 'title'),
+        'description' : _text(raw, 'description'),
+        'category' : category and tuple(c.strip() for c in category.split('/') if c.strip()) or None,
+        'brand' : _text(raw, 'brand'),
+        'manufacturer' : _text(raw, 'manufacturer'),
+        'package_title' : _text(raw, 'package_title') or DEFAULT_PACKAGE_TITLE,
+        'package_count' : _number(raw, 'package_count', int, 1),
+        'inventory' : _number(raw, 'inventory', int, 0),
+        'price' : price.quantize(Decimal('0.01')),
+        'on_sale' : on_sale,
+        'sale_price' : _number(raw, 'sale_price', Decimal),
+        'attributes' : 'attributes' in raw and attributes or None,
+        # Updates only touch the columns the row actually has
+        'given' : set(k for k, v in raw.items() if v is not None and v != ''),
+    }
+
+def _grouped_update(manager, changes):
+    """
+        Applies {pk: {field: value}} with one UPDATE per distinct change.
+        Foreign keys may be given by their attname, e.g. category_id.
+    """
+    # update() only knows foreign keys by their field name
+    names = dict((f.attname, f.name) for f in manager.model._meta.fields)
+    groups = {}
+    for pk, change in changes.items():
+        change = [(names.get(k, k), v) for k, v in change.items()]
+        groups.setdefault(tuple(sorted(change)), []).append(pk)
+    now = datetime.now()
+    for change, pks in groups.items():
+        manager.filter(pk__in=pks).update(last_updates=now, **dict(change))
+
+class CatalogImporter(object):
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, on_reject=None):
+        self.batch_size = batch_size
+        self.on_reject = on_reject
+        # Small lookup tables are remembered across batches
+        self.manufacturers = {}
+        self.brands = {}
+        self.categories = {}
+        self.attributes = {}
+        self.values = {}
+        self.stats = dict.fromkeys(('rows', 'rejected', 'products_created', 'products_updated',
+            'stock_created', 'stock_updated'), 0)
+
+    def reject(self, line, reason):
+        self.stats['rejected'] += 1
+        if self.on_reject is not None:
+            self.on_reject(line, reason)
+
+    def run(self, rows):
+        """
+            Imports an iterable of (line number, raw row) and returns the
+            stats. Only one batch of rows is held in memory.
+        """
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            cleaned = []
+            for line, raw in batch:
+                self.stats['rows'] += 1
+                try:
+                    row = clean_row(raw)
+                except RowError, e:
+                    self.reject(line, e)
+                    continue
+                row['line'] = line
+                cleaned.append(row)
+            if cleaned:
+                self.import_batch(cleaned)
+        return self.stats
+
+    def import_batch(self, rows):
+        with deferred_stock_summary() as pending:
+            self._ensure_manufacturers(rows)
+            self._ensure_brands(rows)
+            for row in rows:
+                row['category_id'] = row['category'] and self._ensure_category(row['category'])
+            products = self._upsert_products(rows)
+            rows = [row for row in rows if row['product_sku'] in products]
+            self._ensure_attribute_values(rows)
+            # Products that stock items were moved away from change as well
+            touched = set(products.values()) | self._upsert_stock(rows, products)
+            pending.update(touched)
+            index_products(touched)
+
+    def _ensure_named(self, model, cache, names, build):
+        missing = set(n for n in names if n and n not in cache)
+        if not missing:
+            return
+        cache.update(model.objects.filter(name__in=missing).values_list('name', 'pk'))
+        new = [n for n in missing if n not in cache]
+        if new:
+            model.objects.bulk_create([build(n) for n in new])
+            cache.update(model.objects.filter(name__in=new).values_list('name', 'pk'))
+
+    def _ensure_manufacturers(self, rows):
+        self._ensure_named(Manufacturer, self.manufacturers, [r['manufacturer'] for r in rows], lambda n: Manufacturer(name=n))
+
+    def _ensure_brands(self, rows):
+        makers = dict((r['brand'], r['manufacturer']) for r in rows if r['brand'])
+        self._ensure_named(Brand, self.brands, makers.keys(),
+            lambda n: Brand(name=n, manufacturer_id=self.manufacturers.get(makers[n])))
+
+    def _ensure_category(self, path):
+        # Categories are few and need their materialized path, so they are
+        # saved one by one and remembered
+        parent_id = None
+        for depth in range(1, len(path) + 1):
+            key = path[:depth]
+            if key not in self.categories:
+                existing = ProductCategory.objects.filter(name=key[-1], parent=parent_id).values_list('pk', flat=True)[:1]
+                if existing:
+                    self.categories[key] = existing[0]
+                else:
+                    slug = base = slugify('-'.join(key))[:45]
+                    n = 1
+                    while ProductCategory.objects.filter(slug=slug).exists():
+                        n += 1
+                        slug = '%s-%d' % (base, n)
+                    category = ProductCategory(name=key[-1], slug=slug, parent_id=parent_id)
+                    category.save()
+                    self.categories[key] = category.pk
+            parent_id = self.categories[key]
+        return parent_id
+
+    def _upsert_products(self, rows):
+        """
+            Creates or updates the products of the batch and returns
+            {product_sku: pk}. Rows for new products without a title are
+            rejected.
+        """
+        wanted = {}
+        for row in rows:
+            fields = wanted.setdefault(row['product_sku'], {})
+            for field in ('title', 'description'):
+                if row[field]:
+                    fields[field] = row[field]
+            if row['category_id']:
+                fields['category_id'] = row['category_id']
+            if row['brand']:
+                fields['brand_id'] = self.brands[row['brand']]
+
+        products = {}
+        changes = {}
+        moved = set()
+        columns = ('pk', 'sku', 'title', 'description', 'category', 'brand')
+        for pk, sku, title, description, category_id, brand_id in Product.objects.filter(sku__in=wanted.keys()).values_list(*columns):
+            products[sku] = pk
+            current = {'title': title, 'description': description, 'category_id': category_id, 'brand_id': brand_id}
+            change = dict((k, v) for k, v in wanted[sku].items() if current[k] != v)
+            if change:
+                changes[pk] = change
+            if 'category_id' in change:
+                moved.update([category_id, change['category_id']])
+        _grouped_update(Product.objects, changes)
+        ProductCategory.objects.refresh_counts(moved)
+        self.stats['products_updated'] += len(changes)
+
+        new = []
+        for sku, fields in wanted.items():
+            if sku in products:
+                continue
+            if 'title' not in fields:
+                for row in rows:
+                    if row['product_sku'] == sku:
+                        self.reject(row['line'], 'title is required for new product %s' % sku)
+                continue
+            new.append(Product(sku=sku, **fields))
+        if new:
+            Product.objects.bulk_create(new)
+            products.update(Product.objects.filter(sku__in=[p.sku for p in new]).values_list('sku', 'pk'))
+            self.stats['products_created'] += len(new)
+        return products
+
+    def _ensure_attribute_values(self, rows):
+        names = set(name for row in rows for name, value in row['attributes'] or ())
+        missing = [n for n in names if n not in self.attributes]
+        if missing:
+            # Names differing only in case or spacing share one attribute
+            slugs = {}
+            for name in sorted(missing):
+                slugs.setdefault(slugify(name), name)
+            found = dict(StockItemAttribute.objects.filter(slug__in=slugs.keys()).values_list('slug', 'pk'))
+            new = [StockItemAttribute(name=name, slug=slug) for slug, name in slugs.items() if slug not in found]
+            if new:
+                StockItemAttribute.objects.bulk_create(new)
+                found.update(StockItemAttribute.objects.filter(slug__in=[a.slug for a in new]).values_list('slug', 'pk'))
+            for name in missing:
+                self.attributes[name] = found[slugify(name)]
+
+        pairs = set((self.attributes[name], value) for row in rows for name, value in row['attributes'] or ())
+        missing = [p for p in pairs if p not in self.values]
+        if missing:
+            lookup = StockItemAttributeValue.objects.filter(
+                attribute__in=set(a for a, v in missing), value__in=set(v for a, v in missing))
+            for pk, attribute_id, value in lookup.values_list('pk', 'attribute', 'value'):
+                self.values.setdefault((attribute_id, value), pk)
+            new = [StockItemAttributeValue(attribute_id=a, value=v) for a, v in missing if (a, v) not in self.values]
+            if new:
+                StockItemAttributeValue.objects.bulk_create(new)
+                lookup = StockItemAttributeValue.objects.filter(
+                    attribute__in=set(v.attribute_id for v in new), value__in=set(v.value for v in new))
+                for pk, attribute_id, value in lookup.values_list('pk', 'attribute', 'value'):
+                    self.values.setdefault((attribute_id, value), pk)
+
+    def _stock_key(self, sku, product_id, package_title):
+        if sku:
+            return ('sku', sku)
+        return ('package', product_id, package_title)
+
+    def _upsert_stock(self, rows, products):
+        """
+            Creates or updates the stock items of the batch and returns the
+            pks of the products that any of them were moved away from.
+        """
+        wanted = {}
+        for row in rows:
+            row['product_id'] = products[row['product_sku']]
+            # The last row for a stock item wins
+            wanted[self._stock_key(row['sku'], row['product_id'], row['package_title'])] = row
+
+        skus = [key[1] for key in wanted if key[0] == 'sku']
+        unkeyed = set(key[1] for key in wanted if key[0] == 'package')
+        columns = ('pk', 'sku', 'product', 'package_title', 'package_count', 'inventory', 'price', 'on_sale', 'sale_price')
+        existing = {}
+        for values in StockItem.objects.filter(Q(sku__in=skus) | Q(product__in=unkeyed, sku__isnull=True)).values_list(*columns):
+            current = dict(zip(columns, values))
+            existing[self._stock_key(current['sku'], current['product'], current['package_title'])] = current
+
+        changes = {}
+        history = []
+        new = []
+        moved_from = set()
+        for key, row in wanted.items():
+            fields = {
+                'product_id': row['product_id'],
+                'package_title': row['package_title'],
+                'package_count': row['package_count'],
+                'inventory': row['inventory'],
+                'price': row['price'],
+                'on_sale': row['on_sale'],
+                'sale_price': row['sale_price'],
+            }
+            if key in existing:
+                current = dict(existing[key], product_id=existing[key]['product'])
+                change = dict((k, v) for k, v in fields.items()
+                    if current[k] != v and (k == 'product_id' or k in row['given']))
+                if change:
+                    changes[current['pk']] = change
+                if 'product_id' in change:
+                    moved_from.add(current['product_id'])
+                if 'price' in change:
+                    history.append(PriceHistory(stock_item_id=current['pk'], price=row['price'], on_sale=row['on_sale']))
+                row['stock_item_id'] = current['pk']
+            else:
+                new.append(StockItem(sku=row['sku'], **fields))
+        _grouped_update(StockItem.objects, changes)
+        PriceHistory.objects.record(history)
+        self.stats['stock_updated'] += len(changes)
+
+        if new:
+            StockItem.objects.bulk_create(new)
+            lookup = StockItem.objects.filter(
+                Q(sku__in=[s.sku for s in new if s.sku]) |
+                Q(product__in=set(s.product_id for s in new if not s.sku), sku__isnull=True)
+            ).order_by('pk')
+            created = dict((self._stock_key(sku, product_id, package_title), pk)
+                for pk, sku, product_id, package_title in lookup.values_list('pk', 'sku', 'product', 'package_title'))
+            for key, row in wanted.items():
+                if 'stock_item_id' not in row:
+                    row['stock_item_id'] = created[key]
+            self.stats['stock_created'] += len(new)
+
+        self._sync_attributes(wanted.values())
+        return moved_from
+
+    def _sync_attributes(self, rows):
+        field = StockItem._meta.get_field('attributes')
+        through = field.rel.through
+        item_column, value_column = field.m2m_field_name(), field.m2m_reverse_field_name()
+        wanted = dict((row['stock_item_id'], set(self.values[(self.attributes[n], v)] for n, v in row['attributes']))
+            for row in rows if row['attributes'] is not None)
+        if not wanted:
+            return
+
+        current = {}
+        lookup = through.objects.filter(**{'%s__in' % item_column: wanted.keys()})
+        for item_id, value_id in lookup.values_list(item_column, value_column):
+            current.setdefault(item_id, set()).add(value_id)
+        new = []
+        for item_id, values in wanted.items():
+            have = current.get(item_id, set())
+            if have - values:
+                through.objects.filter(**{item_column: item_id, '%s__in' % value_column: have - values}).delete()
+            for value_id in values - have:
+                new.append(through(**{'%s_id' % item_column: item_id, '%s_id' % value_column: value_id}))
+        through.objects.bulk_create(new)
@@ -0,0 +1,169 @@
+"""
+Opt-in query instrumentation. With STOCKROOM_INSTRUMENTATION on, the
+QueryInstrumentationMiddleware and the instrumented decorator on the API
+handlers and Cart methods record how many queries a request or call made,
+how long they took, which statements repeated and the slowest one. Every
+record is logged as one JSON line on the stockroom.instrumentation logger,
+checked against STOCKROOM_QUERY_BUDGETS and, for requests going through the
+middleware, summed up in the Server-Timing response header.
+"""
+import json
+import logging
+import re
+import time
+from functools import wraps
+from django.conf import settings
+from django.db import connections
+
+INSTRUMENTATION = getattr(settings, 'STOCKROOM_INSTRUMENTATION', False)
+# {name: max queries} or {name: {'queries': max queries, 'time': max db milliseconds}}
+QUERY_BUDGETS = getattr(settings, 'STOCKROOM_QUERY_BUDGETS', {})
+# 'log' a warning or 'raise' QueryBudgetExceeded when a budget is exceeded
+QUERY_BUDGET_ACTION = getattr(settings, 'STOCKROOM_QUERY_BUDGET_ACTION', 'log')
+# Longest statement text put in a record
+MAX_SQL_LENGTH = 500
+
+logger = logging.getLogger('stockroom.instrumentation')
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+_literals = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\bIN \((?:\?, )*\?\)', re.IGNORECASE), 'IN (...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+def fingerprint(sql):
+    """
+        Returns sql with its literals replaced by ?, so statements that only
+        differ in their parameters look the same.
+    """
+    for pattern, replacement in _literals:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+def _debug_cursor(connection):
+    return connection.use_debug_cursor or (connection.use_debug_cursor is None and settings.DEBUG)
+
+class QueryRecorder(object):
+    """
+        Records the queries run on every connection while it is entered;
+        record holds the result once it exits. Recorders can be nested.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        self.connections = []
+        for alias in connections:
+            connection = connections[alias]
+            self.connections.append((connection, connection.use_debug_cursor, len(connection.queries)))
+            connection.use_debug_cursor = True
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.started
+        queries = []
+        for connection, use_debug_cursor, start in self.connections:
+            queries.extend(connection.queries[start:])
+            connection.use_debug_cursor = use_debug_cursor
+            if not _debug_cursor(connection):
+                # Nothing would have kept these without us
+                del connection.queries[start:]
+        self.record = summarize(self.name, queries, elapsed)
+
+def summarize(name, queries, elapsed):
+    counts = {}
+    slowest = None
+    db_time = 0.0
+    for query in queries:
+        seconds = float(query['time'])
+        db_time += seconds
+        key = fingerprint(query['sql'])
+        counts[key] = counts.get(key, 0) + 1
+        if slowest is None or seconds > slowest[0]:
+            slowest = (seconds, query['sql'])
+    duplicates = sorted(((count, key) for key, count in counts.items() if count > 1), reverse=True)
+    return {
+        'name' : name,
+        'queries' : len(queries),
+        'db_ms' : round(db_time * 1000, 3),
+        'total_ms' : round(elapsed * 1000, 3),
+        'duplicates' : [{'fingerprint': key[:MAX_SQL_LENGTH], 'count': count} for count, key in duplicates],
+        'slowest' : slowest and {'sql': slowest[1][:MAX_SQL_LENGTH], 'ms': round(slowest[0] * 1000, 3)} or None,
+    }
+
+def over_budget(record):
+    """
+        Returns how record exceeds its budget, as a list of descriptions.
+    """
+    budget = QUERY_BUDGETS.get(record['name'])
+    if budget is None:
+        return []
+    if not isinstance(budget, dict):
+        budget = {'queries': budget}
+    exceeded = []
+    if 'queries' in budget and record['queries'] > budget['queries']:
+        exceeded.append('%d queries, budget %d' % (record['queries'], budget['queries']))
+    if 'time' in budget and record['db_ms'] > budget['time']:
+        exceeded.append('%.1fms in the database, budget %sms' % (record['db_ms'], budget['time']))
+    return exceeded
+
+def report(record, request=None):
+    """
+        Logs record, keeps it on request for the Server-Timing header and
+        enforces its budget.
+    """
+    exceeded = over_budget(record)
+    if exceeded:
+        record['over_budget'] = exceeded
+    logger.log(exceeded and logging.WARNING or logging.INFO, json.dumps(record, sort_keys=True))
+    if request is not None:
+        request.__dict__.setdefault('_stockroom_query_records', []).append(record)
+    if exceeded and QUERY_BUDGET_ACTION == 'raise':
+        raise QueryBudgetExceeded('%s: %s' % (record['name'], '; '.join(exceeded)))
+
+def _find_request(args):
+    # Handler methods get the request after self, Cart methods keep it on self
+    if len(args) > 1 and hasattr(args[1], 'META'):
+        return args[1]
+    request = args and getattr(args[0], 'request', None)
+    return hasattr(request, 'META') and request or None
+
+def instrumented(name):
+    """
+        Records the queries of every call of the decorated method under name
+        while STOCKROOM_INSTRUMENTATION is on.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION:
+                return func(*args, **kwargs)
+            recorder = QueryRecorder(name)
+            with recorder:
+                result = func(*args, **kwargs)
+            report(recorder.record, _find_request(args))
+            return result
+        return wrapper
+    return decorator
+
+def _token(name):
+    return re.sub(r'[^\w.-]', '_', name)
+
+def server_timing(request_record, records):
+    """
+        Returns a Server-Timing header value with the database and total time
+        of the request followed by the database time of each record.
+    """
+    metrics = [
+        'db;dur=%s;desc="%d queries"' % (request_record['db_ms'], request_record['queries']),
+        'total;dur=%s' % request_record['total_ms'],
+    ]
+    for record in records:
+        metrics.append('%s;dur=%s;desc="%d queries"' % (_token(record['name']), record['db_ms'], record['queries']))
+    return ', '.join(metrics)
@@ -0,0 +1,9 @@
+from django.db.models.signals import post_syncdb
+from stockroom import models as stockroom_models
+
+def create_search_index(sender, db=None, **kwargs):
+    # The FTS5 table isn't a model, so syncdb doesn't create it
+    from stockroom.search import get_backend
+    get_backend(db).create()
+
+post_syncdb.connect(create_search_index, sender=stockroom_models)
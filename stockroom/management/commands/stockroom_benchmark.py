@@ -0,0 +1,77 @@
+from optparse import make_option
+import json
+import sys
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connections
+from stockroom import caching
+from stockroom.models import Product
+from stockroom.api.concurrent import shared_database
+from stockroom.benchmarks import CATALOG_DEFAULTS, seed_catalog, run_benchmarks, compare, compare_read_workers
+
+class Command(NoArgsCommand):
+    help = ('Seeds a synthetic catalog in a throwaway test database, measures every API endpoint and Cart '
+        'method and optionally compares the results with a baseline. Exits non-zero on regressions.')
+    option_list = NoArgsCommand.option_list + tuple(
+        make_option('--%s' % name, type='int', dest=name, default=default,
+            help='Synthetic catalog size: %s (default %d).' % (name, default))
+        for name, default in sorted(CATALOG_DEFAULTS.items())
+    ) + (
+        make_option('--repeat', type='int', dest='repeat', default=5,
+            help='Runs per scenario; the median time is reported.'),
+        make_option('--only', dest='only', default=None,
+            help='Only run scenarios whose name starts with this.'),
+        make_option('--output', dest='output', default=None,
+            help='Write the results as JSON to this file (defaults to stdout).'),
+        make_option('--baseline', dest='baseline', default=None,
+            help='JSON results of an earlier run to compare with.'),
+        make_option('--tolerance', type='float', dest='tolerance', default=0.5,
+            help='Allowed slowdown or memory growth over the baseline, as a fraction.'),
+        make_option('--clients', type='int', dest='clients', default=0,
+            help='Also compare sequential and concurrent lookups with this many concurrent connections.'),
+        make_option('--workers', type='int', dest='workers', default=4,
+            help='Read workers for the concurrent side of --clients.'),
+        make_option('--seconds', type='float', dest='seconds', default=2.0,
+            help='How long each --clients capacity run lasts.'),
+    )
+
+    def handle_noargs(self, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+
+        connection = connections[Product.objects.db]
+        old_name = connection.settings_dict['NAME']
+        # Never touch the real database or a shared cache
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        cache_alias, caching.CACHE_ALIAS = caching.CACHE_ALIAS, 'django.core.cache.backends.locmem.LocMemCache'
+        try:
+            config = dict((name, options[name]) for name in CATALOG_DEFAULTS)
+            if options['clients'] and not shared_database():
+                raise CommandError('--clients needs a test database other threads can reach, '
+                    'e.g. a TEST_NAME file for SQLite.')
+            catalog = seed_catalog(**config)
+            results = run_benchmarks(catalog, options['repeat'], options['only'])
+            read_workers = None
+            if options['clients']:
+                read_workers = compare_read_workers(catalog, options['workers'], options['clients'],
+                    options['seconds'], options['repeat'])
+        finally:
+            caching.CACHE_ALIAS = cache_alias
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {'config': config, 'vendor': connection.vendor, 'results': results}
+        if read_workers is not None:
+            report['read_workers'] = read_workers
+        report = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report + '\n')
+        else:
+            self.stdout.write(report + '\n')
+
+        if baseline is not None:
+            regressions = compare(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against %s:\n  %s' % (options['baseline'], '\n  '.join(regressions)))
+            sys.stderr.write('No regressions against %s\n' % options['baseline'])
@@ -0,0 +1,24 @@
+from optparse import make_option
+from datetime import datetime, timedelta
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from stockroom.models import PriceRollup
+from stockroom.prices import prune_price_history, PRICE_HISTORY_RETENTION
+
+class Command(NoArgsCommand):
+    help = 'Deletes raw price history older than the retention window; daily and weekly rollups are kept.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=PRICE_HISTORY_RETENTION,
+            help='Days of raw price history to keep.'),
+        make_option('--rebuild-rollups', action='store_true', dest='rebuild', default=False,
+            help='Recompute the rollups from raw history first, e.g. for history recorded before rollups existed.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['rebuild']:
+            # The rollups are dropped and recomputed, readers never see them empty
+            with transaction.commit_on_success(using=PriceRollup.objects.db):
+                PriceRollup.objects.rebuild()
+        # Every batch is committed on its own to keep locks short
+        deleted = prune_price_history(datetime.now() - timedelta(days=options['days']))
+        self.stdout.write('Deleted %d price history rows\n' % deleted)
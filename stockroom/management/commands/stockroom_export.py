@@ -0,0 +1,53 @@
+from optparse import make_option
+import gzip
+import sys
+import time
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from stockroom.models import ProductCategory
+from stockroom.export import export_queryset, write_ndjson
+
+class Command(NoArgsCommand):
+    help = 'Writes the catalog as newline delimited JSON, one product per line.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', dest='output', default='-',
+            help='File to write to (defaults to stdout).'),
+        make_option('--category', dest='category', default=None,
+            help='Only export the subtree of the category with this slug.'),
+        make_option('--active', action='store_true', dest='active', default=False,
+            help='Only export active products.'),
+        make_option('--since', dest='since', default=None,
+            help='Only export products changed since this ISO datetime.'),
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+            help='Gzip the output.'),
+    )
+
+    def handle_noargs(self, **options):
+        category = since = None
+        if options['category']:
+            try:
+                category = ProductCategory.objects.get(slug=options['category'])
+            except ProductCategory.DoesNotExist:
+                raise CommandError('No category %s' % options['category'])
+        if options['since']:
+            try:
+                since = parse_datetime(options['since'])
+            except ValueError:
+                pass
+            if since is None:
+                raise CommandError('--since must be an ISO datetime')
+
+        if options['output'] == '-':
+            out = sys.stdout
+        else:
+            out = open(options['output'], 'wb')
+        f = options['gzip'] and gzip.GzipFile(fileobj=out, mode='wb') or out
+        started = time.time()
+        try:
+            count = write_ndjson(export_queryset(category, options['active'], since), f)
+        finally:
+            if f is not out:
+                f.close()
+            if out is not sys.stdout:
+                out.close()
+        sys.stderr.write('Exported %d products in %.1fs\n' % (count, time.time() - started))
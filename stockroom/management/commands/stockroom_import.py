@@ -0,0 +1,41 @@
+from optparse import make_option
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from stockroom.importer import CatalogImporter, IMPORT_BATCH_SIZE, read_csv, read_jsonl
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = 'Creates or updates products and stock items from a CSV or JSON lines file ("-" reads stdin).'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None, choices=READERS.keys(),
+            help='csv or jsonl (defaults to the file extension).'),
+        make_option('--batch-size', type='int', dest='batch_size', default=IMPORT_BATCH_SIZE,
+            help='Rows written per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give exactly one file to import.')
+        name = args[0]
+        format = options['format'] or (name.endswith('.csv') and 'csv') or (name.endswith('.jsonl') and 'jsonl')
+        if not format:
+            raise CommandError('Can\'t tell the format of %s, use --format.' % name)
+
+        def reject(line, reason):
+            self.stderr.write('Line %s rejected: %s\n' % (line, reason))
+
+        f = name == '-' and sys.stdin or open(name, 'rb')
+        started = time.time()
+        try:
+            stats = CatalogImporter(options['batch_size'], on_reject=reject).run(READERS[format](f))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        elapsed = max(time.time() - started, 0.001)
+        self.stdout.write('%d rows in %.1fs (%d rows/s), %d rejected\n' % (
+            stats['rows'], elapsed, stats['rows'] / elapsed, stats['rejected']))
+        self.stdout.write('Products: %d created, %d updated. Stock items: %d created, %d updated.\n' % (
+            stats['products_created'], stats['products_updated'], stats['stock_created'], stats['stock_updated']))
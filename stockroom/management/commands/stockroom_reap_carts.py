@@ -0,0 +1,54 @@
+from optparse import make_option
+import gzip
+import time
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from stockroom.models import Cart, CartItem, StockItemSales
+
+CART_MAX_AGE = getattr(settings, 'STOCKROOM_CART_MAX_AGE', 30)
+
+class Command(NoArgsCommand):
+    help = 'Deletes abandoned carts and their items in small pk-range batches.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=CART_MAX_AGE,
+            help='Days without a change after which an open cart is abandoned.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+            help='Cart pks covered by each transaction.'),
+        make_option('--sleep', type='float', dest='sleep', default=0,
+            help='Seconds to pause between batches.'),
+        make_option('--archive', dest='archive', default=None,
+            help='Also move checked out carts of the same age to this NDJSON file (gzipped if it ends in .gz).'),
+    )
+
+    def handle_noargs(self, **options):
+        before = datetime.now() - timedelta(days=options['days'])
+        started = time.time()
+        reaped = Cart.objects.reap(before, batch_size=options['batch_size'], pause=options['sleep'])
+        self.stdout.write('Deleted %d abandoned carts\n' % reaped)
+
+        if options['archive']:
+            # Carts are only archived once their sales are in the rollups
+            StockItemSales.objects.catch_up()
+            name = options['archive']
+            f = name.endswith('.gz') and gzip.open(name, 'ab') or open(name, 'ab')
+            encoder = DjangoJSONEncoder(separators=(',', ':'))
+
+            def archive(pks):
+                items = {}
+                for cart_id, stock_item_id, quantity in CartItem.objects.filter(cart__in=pks) \
+                        .values_list('cart', 'stock_item', 'quantity'):
+                    items.setdefault(cart_id, []).append({'stock_item': stock_item_id, 'quantity': quantity})
+                for pk, created_on in Cart.objects.filter(pk__in=pks).values_list('pk', 'created_on'):
+                    f.write(encoder.encode({'id': pk, 'created_on': created_on, 'items': items.get(pk, [])}) + '\n')
+                # Written before the transaction deletes the carts
+                f.flush()
+
+            try:
+                archived = Cart.objects.reap(before, checked_out=True, batch_size=options['batch_size'],
+                    pause=options['sleep'], on_batch=archive)
+            finally:
+                f.close()
+            self.stdout.write('Archived %d checked out carts to %s\n' % (archived, name))
+        self.stdout.write('Done in %.1fs\n' % (time.time() - started))
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from stockroom.models import ProductCategory
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the materialized path and the product counts of every product category.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        changed = ProductCategory.objects.rebuild()
+        self.stdout.write('Rebuilt %d categories\n' % changed)
+        counted = ProductCategory.objects.rebuild_counts()
+        self.stdout.write('Recounted the products of %d categories\n' % counted)
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from stockroom.search import get_backend, rebuild_index
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the product search index from scratch.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        get_backend().create()
+        self.stdout.write('Indexed %d products\n' % rebuild_index())
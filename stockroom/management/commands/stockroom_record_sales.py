@@ -0,0 +1,14 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from stockroom.models import StockItemSales
+
+class Command(NoArgsCommand):
+    help = 'Adds checked out carts the sales rollups do not include yet, e.g. with STOCKROOM_RECORD_SALES_AT_CHECKOUT off.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Carts recorded per transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        recorded = StockItemSales.objects.catch_up(batch_size=options['batch_size'])
+        self.stdout.write('Recorded the sales of %d carts\n' % recorded)
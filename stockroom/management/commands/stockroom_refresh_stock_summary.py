@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from stockroom.models import Product
+
+class Command(NoArgsCommand):
+    help = 'Recomputes the denormalized inventory, variant count, price and activation of every product.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        Product.objects.refresh_stock_summary()
+        self.stdout.write('Refreshed %d products\n' % Product.objects.count())
@@ -0,0 +1,9 @@
+from django.core.management.base import NoArgsCommand
+from stockroom.models import StockReservation
+
+class Command(NoArgsCommand):
+    help = 'Deletes expired cart reservations; they stop holding stock once they expire.'
+
+    def handle_noargs(self, **options):
+        released = StockReservation.objects.release_expired()
+        self.stdout.write('Released %d reservations\n' % released)
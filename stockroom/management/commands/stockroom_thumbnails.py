@@ -0,0 +1,24 @@
+from optparse import make_option
+import time
+from django.core.management.base import NoArgsCommand
+from stockroom.models import ProductImage
+from stockroom.thumbnails import backfill_thumbnails
+
+class Command(NoArgsCommand):
+    help = 'Renders the configured thumbnail sizes of product images on a pool of worker processes.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Re-render images that already have thumbnails.'),
+        make_option('--processes', type='int', dest='processes', default=None,
+            help='Number of worker processes (defaults to the number of CPUs).'),
+    )
+
+    def handle_noargs(self, **options):
+        images = ProductImage.objects.all()
+        if not options['all']:
+            images = images.filter(variants='')
+        started = time.time()
+        rendered, errors = backfill_thumbnails(images, processes=options['processes'])
+        for pk, error in errors:
+            self.stderr.write('Image %s: %s\n' % (pk, error))
+        self.stdout.write('Rendered %d images in %.1fs, %d failed\n' % (rendered, time.time() - started, len(errors)))
@@ -1,9 +1,736 @@
-from django.db import models
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import models, transaction, connections
+from django.db.models import F, Q, Sum, Count
+from django.db.models.query import QuerySet
+from django.utils.datastructures import SortedDict
+from caching import invalidate
 
-class CategoryChildrenManager(models.Manager):
-    def get_query_set(self):
-        return super(CategoryChildrenManager, self).get_query_set().filter(parent=self.id)
+CATEGORY_PATH_DIGITS = 8
+
+def category_path_segment(pk):
+    return '%0*d/' % (CATEGORY_PATH_DIGITS, pk)
+
+def category_path_ids(path):
+    """
+        Returns the pks along a materialized path, root first.
+    """
+    step = len(category_path_segment(0))
+    return [int(path[i:i + step - 1]) for i in range(0, len(path), step)]
+
+class ProductCategoryManager(models.Manager):
+    def rebuild(self):
+        """
+            Recomputes the materialized path and depth of every category from
+            the parent links. Returns the number of categories that changed.
+        """
+        nodes = list(self.values_list('pk', 'parent', 'path', 'depth'))
+        children = {}
+        for pk, parent_id, path, depth in nodes:
+            children.setdefault(parent_id, []).append(pk)
+
+        paths = {}
+        stack = [(pk, '') for pk in children.get(None, [])]
+        while stack:
+            pk, prefix = stack.pop()
+            path = prefix + category_path_segment(pk)
+            paths[pk] = path
+            stack.extend([(child, path) for child in children.get(pk, [])])
+
+        changed = 0
+        step = len(category_path_segment(0))
+        for pk, parent_id, path, depth in nodes:
+            new_path = paths.get(pk)
+            if new_path is None:
+                # Unreachable from a root, i.e. part of a parent loop
+                continue
+            new_depth = len(new_path) / step - 1
+            if new_path != path or new_depth != depth:
+                self.filter(pk=pk).update(path=new_path, depth=new_depth, last_updates=datetime.now())
+                invalidate('category', [pk])
+                changed += 1
+        return changed
+
+    def _shift_subtree_counts(self, deltas):
+        # deltas is {pk: (active products, in stock products)}; categories
+        # shifting by the same amounts share one UPDATE
+        groups = {}
+        for pk, delta in deltas.items():
+            if delta != (0, 0):
+                groups.setdefault(delta, []).append(pk)
+        for (products, in_stock), pks in groups.items():
+            self.filter(pk__in=pks).update(
+                subtree_product_count=F('subtree_product_count') + products,
+                subtree_in_stock_count=F('subtree_in_stock_count') + in_stock,
+                last_updates=datetime.now(),
+            )
+            invalidate('category', pks)
+
+    def refresh_counts(self, category_ids):
+        """
+            Recounts the active and the in stock products filed directly
+            under the given categories and moves the rolled-up counts of
+            each changed category and its ancestors by the difference.
+        """
+        from models import Product
+        ids = set(pk for pk in category_ids if pk is not None)
+        if not ids:
+            return
+        rows = list(self.select_for_update().filter(pk__in=ids).values_list('pk', 'path', 'product_count', 'in_stock_count'))
+        active = Product.objects.filter(category__in=ids, is_active=True)
+        products = dict(active.values_list('category').annotate(Count('pk')).order_by())
+        in_stock = dict(active.filter(in_stock_variants__gt=0).values_list('category').annotate(Count('pk')).order_by())
+
+        deltas = {}
+        for pk, path, old_products, old_in_stock in rows:
+            new_products, new_in_stock = products.get(pk, 0), in_stock.get(pk, 0)
+            if (new_products, new_in_stock) == (old_products, old_in_stock):
+                continue
+            self.filter(pk=pk).update(product_count=new_products, in_stock_count=new_in_stock)
+            for ancestor in category_path_ids(path):
+                products_delta, in_stock_delta = deltas.get(ancestor, (0, 0))
+                deltas[ancestor] = (products_delta + new_products - old_products, in_stock_delta + new_in_stock - old_in_stock)
+        self._shift_subtree_counts(deltas)
+
+    def reroot_subtree(self, pk, old_path, new_path):
+        """
+            Moves the paths and depths of the categories below category pk
+            from under old_path to under new_path with one UPDATE and
+            invalidates them.
+        """
+        descendants = list(self.filter(path__startswith=old_path).exclude(pk=pk).values_list('pk', flat=True))
+        if not descendants:
+            return
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        rest = 'SUBSTR(%s, %d)' % (qn('path'), len(old_path) + 1)
+        # MySQL reads || as OR
+        if connection.vendor == 'mysql':
+            path = 'CONCAT(%%s, %s)' % rest
+        else:
+            path = '%%s || %s' % rest
+        step = len(category_path_segment(0))
+        # Paths are digits and slashes, nothing LIKE treats specially
+        sql = 'UPDATE %s SET %s = %s, %s = %s + %%s, %s = %%s WHERE %s LIKE %%s AND %s <> %%s' % (
+            qn(self.model._meta.db_table), qn('path'), path, qn('depth'), qn('depth'), qn('last_updates'),
+            qn('path'), qn(self.model._meta.pk.column))
+        connection.cursor().execute(sql, [new_path, (len(new_path) - len(old_path)) / step, datetime.now(), old_path + '%', pk])
+        transaction.commit_unless_managed(using=self.db)
+        invalidate('category', descendants)
+
+    def move_subtree_counts(self, pk, old_path, new_path):
+        """
+            Moves the rolled-up counts of category pk from the ancestors
+            along old_path to those along new_path.
+        """
+        counts = self.filter(pk=pk).values_list('subtree_product_count', 'subtree_in_stock_count')
+        if not counts or counts[0] == (0, 0):
+            return
+        products, in_stock = counts[0]
+        deltas = dict((ancestor, (-products, -in_stock)) for ancestor in category_path_ids(old_path)[:-1])
+        for ancestor in category_path_ids(new_path)[:-1]:
+            products_delta, in_stock_delta = deltas.get(ancestor, (0, 0))
+            deltas[ancestor] = (products_delta + products, in_stock_delta + in_stock)
+        self._shift_subtree_counts(deltas)
+
+    def rebuild_counts(self):
+        """
+            Recomputes the direct and rolled-up product counts of every
+            category. Returns the number of categories that changed.
+        """
+        from models import Product
+        active = Product.objects.filter(is_active=True, category__isnull=False)
+        products = dict(active.values_list('category').annotate(Count('pk')).order_by())
+        in_stock = dict(active.filter(in_stock_variants__gt=0).values_list('category').annotate(Count('pk')).order_by())
+
+        nodes = list(self.values_list('pk', 'path', 'product_count', 'in_stock_count',
+            'subtree_product_count', 'subtree_in_stock_count'))
+        subtree = {}
+        for node in nodes:
+            for ancestor in category_path_ids(node[1]):
+                total_products, total_in_stock = subtree.get(ancestor, (0, 0))
+                subtree[ancestor] = (total_products + products.get(node[0], 0), total_in_stock + in_stock.get(node[0], 0))
+
+        changed = 0
+        for node in nodes:
+            pk = node[0]
+            counts = (products.get(pk, 0), in_stock.get(pk, 0)) + subtree.get(pk, (0, 0))
+            if counts != node[2:]:
+                self.filter(pk=pk).update(product_count=counts[0], in_stock_count=counts[1],
+                    subtree_product_count=counts[2], subtree_in_stock_count=counts[3], last_updates=datetime.now())
+                invalidate('category', [pk])
+                changed += 1
+        return changed
 
 class ActiveInventoryManager(models.Manager):
     def get_query_set(self):
         return super(ActiveInventoryManager, self).get_query_set().filter(for_sale=True)
+
+class ProductQuerySet(QuerySet):
+    def with_commerce_summary(self):
+        """
+            Annotates every product with the values behind Product.in_stock,
+            Product.has_image, Product.lowest_price and Product.on_sale using
+            correlated subqueries, so a listing costs a single query.
+        """
+        from models import StockItem, ProductImage
+        qn = self.query.get_compiler(self.db).quote_name_unless_alias
+        product = '%s.%s' % (qn(self.model._meta.db_table), qn(self.model._meta.pk.column))
+        stock = qn(StockItem._meta.db_table)
+        images = qn(ProductImage._meta.db_table)
+        effective_price = 'CASE WHEN s.on_sale = %s AND s.sale_price IS NOT NULL THEN s.sale_price ELSE s.price END'
+
+        select = SortedDict()
+        select_params = []
+        select['summary_in_stock'] = 'EXISTS (SELECT 1 FROM %s s WHERE s.product_id = %s AND s.inventory > 0 AND s.price > 0)' % (stock, product)
+        select['summary_has_image'] = 'EXISTS (SELECT 1 FROM %s i WHERE i.product_id = %s)' % (images, product)
+        select['summary_lowest_price'] = 'SELECT MIN(%s) FROM %s s WHERE s.product_id = %s AND %s > 0' % (effective_price, stock, product, effective_price)
+        select_params.extend([True, True])
+        select['summary_sale_price'] = 'SELECT MIN(s.sale_price) FROM %s s WHERE s.product_id = %s AND s.on_sale = %%s' % (stock, product)
+        select_params.append(True)
+        select['summary_regular_price'] = 'SELECT s.price FROM %s s WHERE s.product_id = %s AND s.on_sale = %%s ORDER BY s.sale_price LIMIT 1' % (stock, product)
+        select_params.append(True)
+
+        return self.extra(select=select, select_params=select_params)
+
+    def with_attributes(self, filters):
+        """
+            Limits to products with a stock item matching every filter, given
+            as {attribute slug: [accepted values]}.
+        """
+        from models import StockItem
+        if not filters:
+            return self
+        stock = StockItem.objects.all()
+        for slug, values in filters.items():
+            stock = stock.filter(attributes__attribute__slug=slug, attributes__value__in=values)
+        return self.filter(pk__in=stock.values('product'))
+
+    def facet_counts(self, filters=None):
+        """
+            Counts the products of this queryset with each attribute value
+            once filters are applied. Counts for a filtered attribute ignore
+            its own filter so the other values stay selectable, which costs
+            one grouped query plus one per filtered attribute. Returns
+            {slug: {'name': name, 'values': [{'value': value, 'count': n}]}}.
+        """
+        from models import StockItemAttributeValue
+        filters = filters or {}
+
+        def grouped(products, attributes):
+            values = attributes.filter(stockitem__product__in=products.values('pk'))
+            return values.values('attribute__slug', 'attribute__name', 'value') \
+                .annotate(count=Count('stockitem__product', distinct=True))
+
+        attributes = StockItemAttributeValue.objects.all()
+        rows = list(grouped(self.with_attributes(filters), attributes.exclude(attribute__slug__in=filters.keys())))
+        for slug in filters:
+            others = dict((k, v) for k, v in filters.items() if k != slug)
+            rows.extend(grouped(self.with_attributes(others), attributes.filter(attribute__slug=slug)))
+
+        facets = SortedDict()
+        for row in sorted(rows, key=lambda r: (r['attribute__name'], r['value'])):
+            facet = facets.setdefault(row['attribute__slug'], {'name': row['attribute__name'], 'values': []})
+            facet['values'].append({'value': row['value'], 'count': row['count']})
+        return facets
+
+class ProductManager(models.Manager):
+    def get_query_set(self):
+        return ProductQuerySet(self.model, using=self._db)
+
+    def with_commerce_summary(self):
+        return self.get_query_set().with_commerce_summary()
+
+    def with_attributes(self, filters):
+        return self.get_query_set().with_attributes(filters)
+
+    def facet_counts(self, filters=None):
+        return self.get_query_set().facet_counts(filters)
+
+    def apply_stock_delta(self, product_id, old_inventory, new_inventory, old_price, new_price):
+        """
+            Adjusts the denormalized stock summary of a product for one stock
+            item going from (old_inventory, old_price) to (new_inventory,
+            new_price) using atomic in-database increments.
+        """
+        self.apply_inventory_deltas([(product_id, old_inventory, new_inventory)])
+        product = self.filter(pk=product_id)
+
+        if old_price == new_price:
+            return
+        old_valid = old_price is not None and old_price > 0
+        new_valid = new_price is not None and new_price > 0
+        if new_valid and (not old_valid or new_price < old_price):
+            if product.filter(Q(min_price__isnull=True) | Q(min_price__gt=new_price)).update(min_price=new_price, last_updates=datetime.now()):
+                invalidate('product', [product_id])
+        elif old_valid and product.filter(min_price=old_price).exists():
+            # The cheapest item got dearer or went away, so rescan
+            self.refresh_stock_summary([product_id])
+
+    def apply_inventory_deltas(self, changes):
+        """
+            Batched inventory half of apply_stock_delta. changes is a list of
+            (product_id, old_inventory, new_inventory), one per stock item;
+            products sharing the same net change are updated together.
+        """
+        from models import ProductCategory
+        net = {}
+        for product_id, old_inventory, new_inventory in changes:
+            inventory, variants = net.get(product_id, (0, 0))
+            net[product_id] = (
+                inventory + new_inventory - old_inventory,
+                variants + int(new_inventory > 0) - int(old_inventory > 0),
+            )
+        groups = {}
+        for product_id, delta in net.items():
+            groups.setdefault(delta, []).append(product_id)
+
+        for (inventory, variants), product_ids in groups.items():
+            products = self.filter(pk__in=product_ids)
+            updates = {}
+            if inventory:
+                updates['total_inventory'] = F('total_inventory') + inventory
+            if variants:
+                updates['in_stock_variants'] = F('in_stock_variants') + variants
+            if updates:
+                products.update(last_updates=datetime.now(), **updates)
+                invalidate('product', product_ids)
+            # Products that come into or go out of stock change the counts
+            # of their category. is_active only follows those transitions,
+            # so a product deactivated by hand stays so while it has stock
+            if variants > 0:
+                listed = list(products.filter(in_stock_variants=variants).values_list('category', flat=True))
+                products.filter(in_stock_variants=variants, is_active=False).update(is_active=True)
+                ProductCategory.objects.refresh_counts(listed)
+            elif variants < 0:
+                listed = list(products.filter(in_stock_variants=0).values_list('category', flat=True))
+                products.filter(in_stock_variants=0, is_active=True).update(is_active=False)
+                ProductCategory.objects.refresh_counts(listed)
+
+    def refresh_stock_summary(self, product_ids=None, batch_size=500):
+        """
+            Recomputes the denormalized stock summary of the given products,
+            or of every product when product_ids is None, from their stock
+            items with one UPDATE per batch. is_active only changes for
+            products that went into or out of stock.
+        """
+        from models import StockItem, ProductCategory
+        if product_ids is None:
+            product_ids = self.values_list('pk', flat=True).order_by('pk').iterator()
+        product_ids = [pk for pk in product_ids if pk is not None]
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        product = '%s.%s' % (qn(self.model._meta.db_table), qn(self.model._meta.pk.column))
+        stock = 'FROM %s s WHERE s.product_id = %s' % (qn(StockItem._meta.db_table), product)
+        in_stock = 'EXISTS (SELECT 1 %s AND s.inventory > 0)' % stock
+        effective_price = 'CASE WHEN s.on_sale = %s AND s.sale_price IS NOT NULL THEN s.sale_price ELSE s.price END'
+        # is_active comes first: MySQL assigns left to right and it has to
+        # compare against the old in_stock_variants
+        assignments = (
+            ('is_active', 'CASE WHEN in_stock_variants > 0 AND NOT %s THEN %%s '
+                'WHEN in_stock_variants = 0 AND %s THEN %%s ELSE is_active END' % (in_stock, in_stock), [False, True]),
+            ('total_inventory', 'COALESCE((SELECT SUM(s.inventory) %s), 0)' % stock, []),
+            ('in_stock_variants', '(SELECT COUNT(*) %s AND s.inventory > 0)' % stock, []),
+            ('min_price', '(SELECT MIN(%s) %s AND %s > 0)' % (effective_price, stock, effective_price), [True, True]),
+            ('last_updates', '%s', [datetime.now()]),
+        )
+        sql = 'UPDATE %s SET %s WHERE %s IN ' % (qn(self.model._meta.db_table),
+            ', '.join('%s = %s' % (qn(column), expression) for column, expression, params in assignments),
+            qn(self.model._meta.pk.column))
+        params = [param for column, expression, values in assignments for param in values]
+
+        for start in range(0, len(product_ids), batch_size):
+            batch = list(set(product_ids[start:start + batch_size]))
+            listings = self.filter(pk__in=batch).values_list('pk', 'category', 'is_active', 'in_stock_variants')
+            before = dict((pk, (category_id, is_active, variants > 0)) for pk, category_id, is_active, variants in listings)
+            connection.cursor().execute(sql + '(%s)' % ', '.join(['%s'] * len(batch)), params + batch)
+            invalidate('product', batch)
+            changed = []
+            for pk, category_id, is_active, variants in listings.all():
+                if before.get(pk) != (category_id, is_active, variants > 0):
+                    changed.append(category_id)
+            ProductCategory.objects.refresh_counts(changed)
+
+class StockItemManager(models.Manager):
+    def reprice(self, queryset=None, amount=None, percent=None, on_sale=None, batch_size=500):
+        """
+            Reprices the stock items in queryset by an absolute amount or by
+            a percentage of their current price, and optionally sets their
+            on_sale flag. Items sharing a new price are written with one
+            UPDATE and the matching PriceHistory rows with one bulk_create
+            and a rollup pass.
+            Prices never drop below zero. Returns the number of items whose
+            price changed.
+        """
+        from models import PriceHistory, deferred_stock_summary
+        if amount is not None and percent is not None:
+            raise ValueError('Pass either amount or percent, not both')
+        if queryset is None:
+            queryset = self.get_query_set()
+        cent = Decimal('0.01')
+
+        with deferred_stock_summary(using=self.db) as pending:
+            rows = list(queryset.select_for_update().values_list('pk', 'product', 'price', 'on_sale'))
+            by_price = {}
+            history = []
+            for pk, product_id, price, current_on_sale in rows:
+                if amount is not None:
+                    new_price = price + Decimal(amount)
+                elif percent is not None:
+                    new_price = price * (1 + Decimal(percent) / 100)
+                else:
+                    new_price = price
+                new_price = max(new_price.quantize(cent, rounding=ROUND_HALF_UP), Decimal('0.00'))
+                if new_price != price:
+                    by_price.setdefault(new_price, []).append(pk)
+                    history.append(PriceHistory(
+                        stock_item_id=pk,
+                        price=new_price,
+                        on_sale=current_on_sale if on_sale is None else on_sale,
+                    ))
+                pending.add(product_id)
+
+            for new_price, pks in by_price.items():
+                for start in range(0, len(pks), batch_size):
+                    self.filter(pk__in=pks[start:start + batch_size]).update(price=new_price, last_updates=datetime.now())
+            if on_sale is not None:
+                pks = [row[0] for row in rows]
+                for start in range(0, len(pks), batch_size):
+                    self.filter(pk__in=pks[start:start + batch_size]).update(on_sale=on_sale, last_updates=datetime.now())
+            PriceHistory.objects.record(history)
+
+        return len(history)
+
+PRICE_BUCKETS = ('day', 'week')
+PRICE_ROLLUP_CHUNK_SIZE = 500
+
+def bucket_start(bucket, when):
+    """
+        Returns the first day of the day or week bucket when falls in.
+        Weeks start on Monday.
+    """
+    day = isinstance(when, datetime) and when.date() or when
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    return day
+
+class PriceHistoryManager(models.Manager):
+    def record(self, histories):
+        """
+            Writes new PriceHistory rows with one bulk_create and folds them
+            into the price rollups.
+        """
+        from models import PriceRollup
+        histories = list(histories)
+        if not histories:
+            return
+        self.bulk_create(histories)
+        # bulk_create has set created_on through auto_now_add
+        PriceRollup.objects.roll_up([(h.stock_item_id, h.price, h.created_on) for h in histories])
+
+class PriceRollupManager(models.Manager):
+    def roll_up(self, entries):
+        """
+            Folds (stock_item_id, price, when) entries into the min, max and
+            last price of every day and week bucket they fall in. Rollups
+            sharing the same new values are written with one UPDATE.
+        """
+        buckets = {}
+        for stock_item_id, price, when in sorted(entries, key=lambda e: e[2]):
+            for bucket in PRICE_BUCKETS:
+                key = (stock_item_id, bucket, bucket_start(bucket, when))
+                if key in buckets:
+                    low, high, last, last_on, changes = buckets[key]
+                    buckets[key] = (min(low, price), max(high, price), price, when, changes + 1)
+                else:
+                    buckets[key] = (price, price, price, when, 1)
+
+        stock_items = sorted(set(key[0] for key in buckets))
+        for start in range(0, len(stock_items), PRICE_ROLLUP_CHUNK_SIZE):
+            chunk = stock_items[start:start + PRICE_ROLLUP_CHUNK_SIZE]
+            keys = [key for key in buckets if key[0] in set(chunk)]
+            rows = self.select_for_update().filter(stock_item__in=chunk, start__in=set(key[2] for key in keys))
+            existing = dict(((r.stock_item_id, r.bucket, r.start), r) for r in rows)
+            new = []
+            updates = {}
+            for key in keys:
+                low, high, last, last_on, changes = buckets[key]
+                row = existing.get(key)
+                if row is None:
+                    new.append(self.model(stock_item_id=key[0], bucket=key[1], start=key[2], min_price=low,
+                        max_price=high, last_price=last, last_on=last_on, changes=changes))
+                    continue
+                if last_on < row.last_on:
+                    last, last_on = row.last_price, row.last_on
+                change = (min(row.min_price, low), max(row.max_price, high), last, last_on, changes)
+                updates.setdefault(change, []).append(row.pk)
+            for (low, high, last, last_on, changes), pks in updates.items():
+                self.filter(pk__in=pks).update(min_price=low, max_price=high, last_price=last,
+                    last_on=last_on, changes=F('changes') + changes)
+            self.bulk_create(new)
+
+    def rebuild(self, batch_size=PRICE_ROLLUP_CHUNK_SIZE * 2):
+        """
+            Recomputes every rollup from the PriceHistory rows still kept.
+        """
+        from models import PriceHistory
+        self.all().delete()
+        history = PriceHistory.objects.order_by('pk').values_list('pk', 'stock_item', 'price', 'created_on')
+        last_pk = 0
+        while True:
+            rows = list(history.filter(pk__gt=last_pk)[:batch_size])
+            if not rows:
+                break
+            self.roll_up([row[1:] for row in rows])
+            last_pk = rows[-1][0]
+
+SALES_ROLLUP_CHUNK_SIZE = 500
+
+def _add_quantities(queryset, field, quantities):
+    """
+        Adds {(pk, day): quantity} to the daily rows of queryset, keyed by
+        field and day. Rows gaining the same quantity share one UPDATE.
+    """
+    pks = sorted(set(key[0] for key in quantities))
+    existing = {}
+    for start in range(0, len(pks), SALES_ROLLUP_CHUNK_SIZE):
+        chunk = pks[start:start + SALES_ROLLUP_CHUNK_SIZE]
+        rows = queryset.select_for_update().filter(**{'%s__in' % field: chunk,
+            'day__in': set(key[1] for key in quantities)}).values_list(field, 'day', 'pk')
+        existing.update(((pk, day), row_pk) for pk, day, row_pk in rows)
+    new = []
+    updates = {}
+    for key, quantity in quantities.items():
+        if key in existing:
+            updates.setdefault(quantity, []).append(existing[key])
+        else:
+            new.append(queryset.model(day=key[1], quantity=quantity, **{'%s_id' % field: key[0]}))
+    for quantity, row_pks in updates.items():
+        for start in range(0, len(row_pks), SALES_ROLLUP_CHUNK_SIZE):
+            queryset.filter(pk__in=row_pks[start:start + SALES_ROLLUP_CHUNK_SIZE]).update(quantity=F('quantity') + quantity)
+    queryset.bulk_create(new)
+
+class SalesRollupManager(models.Manager):
+    def record(self, carts):
+        """
+            Adds the lines of the given checked out carts (pks) that are not
+            recorded yet to the daily stock item and category rollups and
+            marks them recorded, in one transaction. Returns the number of
+            carts recorded.
+        """
+        from models import Cart, CartItem, CategorySales
+        with transaction.commit_on_success(using=self.db):
+            # Locked so concurrent recorders never count a cart twice
+            pks = list(Cart.objects.select_for_update().filter(pk__in=list(carts), checked_out=True,
+                sales_recorded=False).values_list('pk', flat=True))
+            if not pks:
+                return 0
+            items, categories = {}, {}
+            lines = CartItem.objects.filter(cart__in=pks).values_list('cart__checked_out_on', 'cart__created_on',
+                'stock_item', 'stock_item__product__category', 'quantity')
+            for checked_out_on, created_on, stock_item_id, category_id, quantity in lines:
+                # Carts checked out before checked_out_on existed count on their first day
+                day = (checked_out_on or created_on).date()
+                items[(stock_item_id, day)] = items.get((stock_item_id, day), 0) + quantity
+                if category_id is not None:
+                    categories[(category_id, day)] = categories.get((category_id, day), 0) + quantity
+            _add_quantities(self.all(), 'stock_item', items)
+            _add_quantities(CategorySales.objects.all(), 'category', categories)
+            Cart.objects.filter(pk__in=pks).update(sales_recorded=True)
+            return len(pks)
+
+    def catch_up(self, batch_size=500):
+        """
+            Records every checked out cart the rollups don't include yet, in
+            pk order and batch_size carts per transaction. Returns the number
+            of carts recorded.
+        """
+        from models import Cart
+        carts = Cart.objects.filter(checked_out=True, sales_recorded=False).order_by('pk').values_list('pk', flat=True)
+        recorded = 0
+        last_pk = 0
+        while True:
+            pks = list(carts.filter(pk__gt=last_pk)[:batch_size])
+            if not pks:
+                break
+            recorded += self.record(pks)
+            last_pk = pks[-1]
+        return recorded
+
+class CartManager(models.Manager):
+    def reap(self, before, checked_out=False, batch_size=1000, pause=0, on_batch=None):
+        """
+            Deletes carts last changed before the given datetime, and their
+            items, walking the pk range in slices of batch_size so every slice is
+            one short transaction. Carts still holding stock are skipped until
+            their holds are released. on_batch(pks) is called inside each
+            transaction before the carts are deleted, e.g. to archive them,
+            and pause seconds are slept between slices. Returns the number of
+            carts deleted.
+        """
+        from models import CartItem, StockReservation
+        carts = self.filter(last_updates__lt=before, checked_out=checked_out)
+        if checked_out:
+            # Sales not in the rollups yet would be lost
+            carts = carts.filter(sales_recorded=True)
+        bounds = carts.aggregate(low=models.Min('pk'), high=models.Max('pk'))
+        if bounds['low'] is None:
+            return 0
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        # Plain DELETEs; nothing listens for these deletions, so there is
+        # no need to load the rows like QuerySet.delete does
+        deletes = ['DELETE FROM %s WHERE %s IN ' % (qn(model._meta.db_table), qn(column)) for model, column in (
+            (CartItem, CartItem._meta.get_field('cart').column),
+            (StockReservation, StockReservation._meta.get_field('cart').column),
+            (self.model, self.model._meta.pk.column),
+        )]
+
+        deleted = 0
+        for low in range(bounds['low'], bounds['high'] + 1, batch_size):
+            with transaction.commit_on_success(using=self.db):
+                pks = list(carts.filter(pk__gte=low, pk__lt=low + batch_size)
+                    .exclude(reservations__quantity__gt=0).values_list('pk', flat=True))
+                if not pks:
+                    continue
+                if on_batch is not None:
+                    on_batch(pks)
+                placeholders = '(%s)' % ', '.join(['%s'] * len(pks))
+                cursor = connection.cursor()
+                for sql in deletes:
+                    cursor.execute(sql + placeholders, pks)
+                transaction.commit_unless_managed(using=self.db)
+                deleted += len(pks)
+            if pause:
+                time.sleep(pause)
+        return deleted
+
+class ReservationConflict(Exception):
+    pass
+
+class StockReservationManager(models.Manager):
+    """
+        Holds stock for cart lines. A hold is a reservation row; the units a
+        stock item can still hand out are its inventory less the holds of
+        other carts that haven't expired. Holders of a stock item queue up
+        on its row lock, so concurrent workers never hold more than there
+        is. StockItem.inventory only drops when a cart is checked out.
+    """
+    def _active(self, stock_item_ids, now):
+        holds = self.filter(stock_item__in=stock_item_ids, expires_on__gt=now)
+        return holds.values_list('stock_item').annotate(Sum('quantity')).order_by()
+
+    def _set_holds(self, cart, wanted):
+        """
+            Sets the holds of a cart to as much of wanted, {stock_item_id:
+            units}, as is available and returns {stock_item_id: units that
+            could not be held}. Must run in a transaction.
+        """
+        from models import StockItem, RESERVATION_TIMEOUT
+        if not wanted:
+            return {}
+        now = datetime.now()
+        inventory = dict(StockItem.objects.select_for_update().filter(pk__in=wanted.keys()).order_by('pk').values_list('pk', 'inventory'))
+        others = dict(self._active(wanted.keys(), now).exclude(cart=cart))
+        granted = {}
+        shortfalls = {}
+        for pk, quantity in wanted.items():
+            granted[pk] = min(quantity, max(inventory.get(pk, 0) - others.get(pk, 0), 0))
+            if granted[pk] < quantity:
+                shortfalls[pk] = quantity - granted[pk]
+
+        holds = self.filter(cart=cart)
+        existing = set(holds.filter(stock_item__in=wanted.keys()).values_list('stock_item', flat=True))
+        expires_on = now + timedelta(seconds=RESERVATION_TIMEOUT)
+        by_quantity = {}
+        new = []
+        for pk, quantity in granted.items():
+            if pk in existing:
+                by_quantity.setdefault(quantity, []).append(pk)
+            elif quantity:
+                new.append(self.model(cart=cart, stock_item_id=pk, quantity=quantity, expires_on=expires_on))
+        for quantity, pks in by_quantity.items():
+            if quantity:
+                holds.filter(stock_item__in=pks).update(quantity=quantity, expires_on=expires_on)
+            else:
+                holds.filter(stock_item__in=pks).delete()
+        self.bulk_create(new)
+
+        taken = [pk for pk, quantity in granted.items() if quantity]
+        if taken:
+            held = dict(self._active(taken, now))
+            if any(held.get(pk, 0) > inventory[pk] for pk in taken):
+                # Only possible on backends that ignore row locks
+                raise ReservationConflict('Stock changed while it was being reserved')
+        return shortfalls
+
+    def hold_many(self, cart, quantities):
+        """
+            Makes the hold for each stock item in cart the given number of
+            units, or as many as are available. quantities maps stock items
+            (or their pks) to units. Returns {stock_item_id: units that
+            could not be held}.
+        """
+        wanted = dict((getattr(s, 'pk', s), quantity) for s, quantity in quantities.items())
+        with transaction.commit_on_success(using=self.db):
+            return self._set_holds(cart, wanted)
+
+    def hold(self, cart, stock_item, quantity):
+        """
+            Single line version of hold_many. Returns the number of units
+            that could not be held (0 on success).
+        """
+        return sum(self.hold_many(cart, {stock_item: quantity}).values())
+
+    def release(self, cart, stock_items=None):
+        """
+            Drops the holds of the cart on the given stock items, or all of
+            them.
+        """
+        holds = self.filter(cart=cart)
+        if stock_items is not None:
+            holds = holds.filter(stock_item__in=[getattr(s, 'pk', s) for s in stock_items])
+        holds.delete()
+
+    def release_expired(self, now=None):
+        """
+            Deletes expired holds and returns how many there were. They stop
+            counting against inventory once they expire, so this only
+            keeps the table small.
+        """
+        expired = list(self.filter(expires_on__lte=now or datetime.now()).values_list('pk', flat=True))
+        self.filter(pk__in=expired).delete()
+        return len(expired)
+
+    def commit(self, cart):
+        """
+            Converts the holds of a cart into a sale: every line is held in
+            full (holds may have expired), the units are taken out of
+            inventory, the holds are dropped and the cart is marked checked
+            out. Returns a dict of stock item pk to missing units; when it
+            is not empty nothing is changed.
+        """
+        from models import Cart, CartItem, StockItem, Product
+        with transaction.commit_on_success(using=self.db):
+            wanted = dict(CartItem.objects.filter(cart=cart).values_list('stock_item', 'quantity'))
+            shortfalls = self._set_holds(cart, wanted)
+            if shortfalls:
+                transaction.rollback(using=self.db)
+                return shortfalls
+            by_quantity = {}
+            changes = []
+            for pk, product_id, inventory in StockItem.objects.filter(pk__in=wanted.keys()).values_list('pk', 'product', 'inventory'):
+                by_quantity.setdefault(wanted[pk], []).append(pk)
+                changes.append((product_id, inventory, inventory - wanted[pk]))
+            for quantity, pks in by_quantity.items():
+                stock = StockItem.objects.filter(pk__in=pks, inventory__gte=quantity)
+                if stock.update(inventory=F('inventory') - quantity, last_updates=datetime.now()) != len(pks):
+                    raise ReservationConflict('Stock changed while it was being sold')
+            Product.objects.apply_inventory_deltas(changes)
+            self.filter(cart=cart).delete()
+            now = datetime.now()
+            Cart.objects.filter(pk=cart.pk).update(checked_out=True, checked_out_on=now, last_updates=now)
+            return shortfalls
@@ -1,10 +1,42 @@
 from datetime import datetime
+from django.core.urlresolvers import resolve, Resolver404
 from cart import Cart
+import instrumentation
+from instrumentation import QueryRecorder, report, server_timing
 import logging
 
 class StockroomMiddleware(object):
     def process_request(self, request):
         if not hasattr(request, 'cart'):
+            # Cart is lazy: no session or database access until it is used
             cart = Cart(request)
             request.cart = cart
-        
\ No newline at end of file
+        
+
+class QueryInstrumentationMiddleware(object):
+    """
+        Records the queries of every request while STOCKROOM_INSTRUMENTATION
+        is on. Requests are named after their url pattern, so budgets can be
+        set per endpoint, and the response gets a Server-Timing header.
+    """
+    def process_request(self, request):
+        if instrumentation.INSTRUMENTATION:
+            try:
+                name = resolve(request.path_info).url_name or request.path_info
+            except Resolver404:
+                name = request.path_info
+            recorder = QueryRecorder(name)
+            recorder.__enter__()
+            request._stockroom_query_recorder = recorder
+    
+    def process_response(self, request, response):
+        recorder = request.__dict__.pop('_stockroom_query_recorder', None)
+        if recorder is None:
+            return response
+        recorder.__exit__(None, None, None)
+        records = request.__dict__.pop('_stockroom_query_records', [])
+        recorder.record['method'] = request.method
+        recorder.record['status'] = response.status_code
+        report(recorder.record)
+        response['Server-Timing'] = server_timing(recorder.record, records)
+        return response
@@ -3,11 +3,34 @@ from django.db import models
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext as _
 from datetime import datetime
-from managers import CategoryChildrenManager, ActiveInventoryManager
+import json
+import logging
+from decimal import Decimal
+from caching import invalidate
+from managers import ProductCategoryManager, ActiveInventoryManager, ProductManager, StockItemManager, StockReservationManager, \
+    PriceHistoryManager, CartManager, PriceRollupManager, SalesRollupManager, category_path_segment, PRICE_BUCKETS
 from units import STOCKROOM_UNITS
 
 # Set default values
 ATTRIBUTE_VALUE_UNITS = getattr(settings, 'STOCKROOM_UNITS', STOCKROOM_UNITS)
+RESERVATION_TIMEOUT = getattr(settings, 'STOCKROOM_RESERVATION_TIMEOUT', 15 * 60)
+GENERATE_THUMBNAILS = getattr(settings, 'STOCKROOM_GENERATE_THUMBNAILS', True)
+
+logger = logging.getLogger('stockroom.thumbnails')
+
+def _to_price(value):
+    # Raw subquery values come back as floats on some backends
+    if value is None or isinstance(value, Decimal):
+        return value
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+# Marks a tracked field that was deferred when the instance was loaded
+UNTRACKED = object()
+
+def effective_price(price, on_sale, sale_price):
+    if on_sale and sale_price is not None:
+        return sale_price
+    return price
 
 class Manufacturer(models.Model):
     name = models.CharField(max_length=120)
@@ -31,21 +54,49 @@ class Product(models.Model):
     brand = models.ForeignKey('Brand', null=True, blank=True)
     title = models.CharField(max_length=120)
     description = models.TextField(blank=True, null=True)
-    sku = models.CharField(max_length=30, null=True, blank=True, help_text='An internal unique identifier for this product')
+    sku = models.CharField(max_length=30, null=True, blank=True, db_index=True, help_text='An internal unique identifier for this product')
     relationships = models.ManyToManyField('self', through='ProductRelationship', symmetrical=False, related_name='related_to')    
-    created_on = models.DateTimeField(auto_now_add=True)
-    last_updates = models.DateTimeField(auto_now=True)
+    created_on = models.DateTimeField(auto_now_add=True, db_index=True)
+    last_updates = models.DateTimeField(auto_now=True, db_index=True)
     thumbnail = models.ForeignKey('ProductImage', null=True, blank=True, related_name='product_thumbnails')
+    # Denormalized from the product's stock items, see update_stock_summary
+    total_inventory = models.IntegerField(default=0, editable=False)
+    in_stock_variants = models.PositiveIntegerField(default=0, editable=False)
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, editable=False)
+    objects = ProductManager()
+    
+    def __init__(self, *args, **kwargs):
+        super(Product, self).__init__(*args, **kwargs)
+        self._original_listing = self._listing()
     
     def __unicode__(self):
         return _(self.title)
     
-    def attach_thumbnail(self, product_image, *args, **kwargs):
+    def _listing(self):
+        # What the category product counts depend on
+        return (self.category_id, self.is_active, self.in_stock_variants > 0)
+    
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            # The stock summary moves in the database through F() deltas, so
+            # an instance loaded earlier must not write its copy back
+            current = Product.objects.filter(pk=self.pk).values_list('total_inventory', 'in_stock_variants', 'min_price', 'is_active')
+            if current:
+                self.total_inventory, self.in_stock_variants, self.min_price, is_active = current[0]
+                if self.is_active == self._original_listing[1]:
+                    self.is_active = is_active
+                self._original_listing = (self._original_listing[0], is_active, self.in_stock_variants > 0)
+        super(Product, self).save(*args, **kwargs)
+    
+    def attach_thumbnail(self, product_image):
         self.thumbnail = product_image
-        super(Product, self).save(*args, **kwargs) 
+        Product.objects.filter(pk=self.pk).update(thumbnail=product_image, last_updates=datetime.now())
+        invalidate('product', [self.pk])
 
     
     def in_stock(obj):
+        if hasattr(obj, 'summary_in_stock'):
+            return bool(obj.summary_in_stock)
         stock = StockItem.objects.filter(product=obj, inventory__gt=0, price__gt=0)
         if stock:
             return True
@@ -54,6 +105,8 @@ class Product(models.Model):
     in_stock.short_description = 'In Stock'
     
     def has_image(obj):
+        if hasattr(obj, 'summary_has_image'):
+            return bool(obj.summary_has_image)
         images = ProductImage.objects.filter(product=obj)
         if images:
             return True
@@ -62,6 +115,8 @@ class Product(models.Model):
     has_image.short_description = 'Has Image'
     
     def lowest_price(self):
+        if hasattr(self, 'summary_lowest_price'):
+            return _to_price(self.summary_lowest_price)
         try:
             stock_items = StockItem.objects.filter(product=self).order_by('price')
             
@@ -81,6 +136,13 @@ class Product(models.Model):
             return False
     
     def on_sale(self):
+        if hasattr(self, 'summary_regular_price'):
+            if self.summary_regular_price is None:
+                return False
+            return {
+                'regular_price': _to_price(self.summary_regular_price),
+                'sale_price': _to_price(self.summary_sale_price),
+            }
         try:
             sale_item = StockItem.objects.filter(product=self, on_sale=True).order_by('sale_price')
         except StockItem.DoesNotExist:
@@ -99,16 +161,52 @@ class ProductImage(models.Model):
     attributes = models.ManyToManyField('StockItemAttributeValue', blank=True, null=True)
     image_file = models.ImageField(upload_to='stockroom/products/%Y/%m/%d')
     caption = models.TextField(blank=True, null=True)
+    # JSON list of the rendered thumbnail sizes, see stockroom.thumbnails
+    variants = models.TextField(blank=True, editable=False, default='')
+    last_updates = models.DateTimeField(auto_now=True)
     
     class Meta:
         verbose_name = 'image'
         verbose_name_plural = 'images'
     
+    def __init__(self, *args, **kwargs):
+        super(ProductImage, self).__init__(*args, **kwargs)
+        self._original_image_name = self.__dict__.get('image_file') and self.image_file.name
+    
     def __unicode__(self):
         return _(self.image_file.url)
     
+    def get_variants(self):
+        return self.variants and json.loads(self.variants) or []
+    
+    def set_variants(self, variants):
+        self.variants = json.dumps(variants)
+    
+    def get_thumbnail_sizes(self):
+        sizes = {}
+        for v in self.get_variants():
+            sizes[v['size']] = {
+                'width' : v['width'],
+                'height' : v['height'],
+                'url' : v['url'],
+            }
+        return sizes
+    
     def save(self, *args, **kwargs):
+        adding = self.pk is None
         super(ProductImage, self).save(*args, **kwargs)
+        # Only new uploads render here; images left without variants are
+        # for the stockroom_thumbnails command
+        if GENERATE_THUMBNAILS and (adding or self.image_file.name != self._original_image_name):
+            from thumbnails import generate_thumbnails
+            try:
+                generate_thumbnails(self)
+            except Exception:
+                logger.exception('Could not render the thumbnails of image %s', self.pk)
+                self.variants = ''
+                ProductImage.objects.filter(pk=self.pk).update(variants='')
+            invalidate('product', [self.product_id])
+        self._original_image_name = self.image_file.name
         if self.product.thumbnail is None:
             self.product.attach_thumbnail(self)
 
@@ -117,28 +215,50 @@ class ProductCategory(models.Model):
     name = models.CharField(max_length=120)
     slug = models.SlugField(blank=True, unique=True)
     parent = models.ForeignKey('self', blank=True, null=True, related_name='children')
-    objects = models.Manager()
-    children = CategoryChildrenManager()
+    path = models.CharField(max_length=255, blank=True, editable=False, db_index=True)
+    depth = models.PositiveIntegerField(default=0, editable=False)
+    last_updates = models.DateTimeField(auto_now=True)
+    # Active and in stock products filed directly under the category and
+    # anywhere in its subtree, see ProductCategoryManager.refresh_counts
+    product_count = models.PositiveIntegerField(default=0, editable=False)
+    in_stock_count = models.PositiveIntegerField(default=0, editable=False)
+    subtree_product_count = models.PositiveIntegerField(default=0, editable=False)
+    subtree_in_stock_count = models.PositiveIntegerField(default=0, editable=False)
+    objects = ProductCategoryManager()
     
     class Meta:
         verbose_name = 'category'
         verbose_name_plural = 'categories'
 
+    def __init__(self, *args, **kwargs):
+        super(ProductCategory, self).__init__(*args, **kwargs)
+        self._original_parent_id = self.parent_id
+        self._original_name = self.name
+
     def __unicode__(self):
         return _(self.name)
 
-    def _recurse_for_parents(self, category_object):
-        parent_list = []
-        if category_object.parent_id:
-            parent = category_object.parent
-            parent_list.append(parent.name)
-            more = self._recurse_for_parents(parent)
-            parent_list.extend(more)
+    def get_ancestors(self):
+        """
+            Returns the categories above this one, root first, in one query.
+        """
+        step = len(category_path_segment(0))
+        ancestor_ids = [int(self.path[i:i + step - 1]) for i in range(0, len(self.path) - step, step)]
+        if not ancestor_ids:
+            return ProductCategory.objects.none()
+        return ProductCategory.objects.filter(pk__in=ancestor_ids).order_by('depth')
 
-        if category_object == self and parent_list:
-            parent_list.reverse()
+    def get_descendants(self, include_self=False):
+        descendants = ProductCategory.objects.filter(path__startswith=self.path)
+        if not include_self:
+            descendants = descendants.exclude(pk=self.pk)
+        return descendants
 
-        return parent_list
+    def get_subtree_products(self):
+        return Product.objects.filter(category__path__startswith=self.path)
+
+    def _recurse_for_parents(self, category_object):
+        return [parent.name for parent in category_object.get_ancestors()]
 
     def get_separator(self):
         return ':'
@@ -148,9 +268,12 @@ class ProductCategory(models.Model):
         return self.get_separator().join(parent_list)
 
     def _pre_save(self):
-        parent_list = self._recurse_for_parents(self)
-        if self.name in parent_list:
-            raise "You can't save a category in itself"
+        if self.pk is not None and self.parent_id == self.pk:
+            raise ValueError("You can't save a category in itself")
+        if self.path and self.parent_id and self.parent_id != self._original_parent_id:
+            parent_path = ProductCategory.objects.filter(pk=self.parent_id).values_list('path', flat=True)[0]
+            if parent_path.startswith(self.path):
+                raise ValueError("You can't save a category in itself")
 
     def __repr__(self):
         parent_list = self._recurse_for_parents(self)
@@ -159,9 +282,36 @@ class ProductCategory(models.Model):
         # http://docs.python.org/reference/datamodel.html#object.__repr__
         return self.get_separator().join(parent_list).encode("ascii", "replace")
 
-    # def save(self, force_insert=False, force_update=False):
-    #     self.slug = slugify(self.name)
-    #     super(ProductCategory, self).save()
+    def save(self, *args, **kwargs):
+        self._pre_save()
+        old_path = self.path
+        if old_path and self.parent_id == self._original_parent_id:
+            super(ProductCategory, self).save(*args, **kwargs)
+            return
+
+        if self.parent_id:
+            parent_path = ProductCategory.objects.filter(pk=self.parent_id).values_list('path', flat=True)[0]
+        else:
+            parent_path = ''
+        if self.pk is not None:
+            self._set_path(parent_path)
+            super(ProductCategory, self).save(*args, **kwargs)
+        else:
+            super(ProductCategory, self).save(*args, **kwargs)
+            self._set_path(parent_path)
+            ProductCategory.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth)
+
+        if old_path and old_path != self.path:
+            ProductCategory.objects.reroot_subtree(self.pk, old_path, self.path)
+            ProductCategory.objects.move_subtree_counts(self.pk, old_path, self.path)
+            # The breadcrumbs of every product below changed with the paths
+            reindex_products(Product.objects.filter(category__path__startswith=self.path).values_list('pk', flat=True))
+        self._original_parent_id = self.parent_id
+        self._original_name = self.name
+
+    def _set_path(self, parent_path):
+        self.path = parent_path + category_path_segment(self.pk)
+        self.depth = len(self.path) / len(category_path_segment(0)) - 1
                 
 
 class ProductRelationship(models.Model):
@@ -190,7 +340,7 @@ class StockItemAttribute(models.Model):
 
 class StockItemAttributeValue(models.Model):
     attribute = models.ForeignKey('StockItemAttribute')
-    value = models.CharField(max_length=255)
+    value = models.CharField(max_length=255, db_index=True)
     unit = models.CharField(max_length=8, choices=ATTRIBUTE_VALUE_UNITS, null=True, blank=True)
     
     class Meta:
@@ -208,6 +358,7 @@ class StockItemAttributeValue(models.Model):
         
 class StockItem(models.Model):
     product = models.ForeignKey('Product', related_name='stock')
+    sku = models.CharField(max_length=30, null=True, blank=True, db_index=True, help_text='An internal unique identifier for this variant')
     attributes = models.ManyToManyField('StockItemAttributeValue', blank=True, null=True)
     package_title = models.CharField(max_length=60, blank=True, null=True, help_text='(ex. 3-pack of T-shirts)', default='Individual Item')
     package_count = models.IntegerField(default=1)
@@ -225,31 +376,47 @@ class StockItem(models.Model):
         blank=True,
         null=True
     )
+    last_updates = models.DateTimeField(auto_now=True)
+    
+    objects = StockItemManager()
+
+    # Fields whose loaded values are remembered for change detection
+    tracked_fields = ('product_id', 'inventory', 'price', 'on_sale', 'sale_price', 'sku', 'package_title')
     
     class Meta:
         verbose_name = 'inventory'
         verbose_name_plural = 'inventory'
     
+    def __init__(self, *args, **kwargs):
+        super(StockItem, self).__init__(*args, **kwargs)
+        self._track_original_state()
+    
     def __unicode__(self):
         return _("%s of %s" % (self.package_title, self.product))
     
+    def _track_original_state(self):
+        # Read from __dict__ so deferred fields aren't loaded here
+        self._original_state = dict((f, self.__dict__.get(f, UNTRACKED)) for f in self.tracked_fields)
+    
     def get_price(self, on_sale=False):
         if on_sale:
             return self.sale_price
         return self.price
     
+    def get_effective_price(self):
+        return effective_price(self.price, self.on_sale, self.sale_price)
+    
     def save(self, *args, **kw):
         if self.pk is not None:
-            original = StockItem.objects.get(pk=self.pk)
-            if original.price != self.price:
-                PriceHistory.objects.create(
+            original_price = self._original_state['price']
+            if original_price is UNTRACKED:
+                original_price = StockItem.objects.filter(pk=self.pk).values_list('price', flat=True)[0]
+            if original_price != self.price:
+                PriceHistory.objects.record([PriceHistory(
                     stock_item=self,
                     price=self.price,
                     on_sale=self.on_sale,
-                )
-            
-            # Set product to active as long as they're something in stock
-            # Probably inefficient as hell
+                )])
 
         super(StockItem, self).save(*args, **kw)
     
@@ -258,6 +425,7 @@ class PriceHistory(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2, help_text='All prices in USD')
     on_sale = models.BooleanField(default=False)
     created_on = models.DateTimeField(auto_now_add=True)
+    objects = PriceHistoryManager()
     
     class Meta:
         ordering = ['-created_on']
@@ -266,10 +434,41 @@ class PriceHistory(models.Model):
     
     def __unicode__(self):
         return str(self.price)
+
+class PriceRollup(models.Model):
+    """
+        Lowest, highest and last price of a stock item over one day or week,
+        kept up to date as PriceHistory rows are recorded and kept after the
+        raw rows are pruned.
+    """
+    stock_item = models.ForeignKey('StockItem', related_name='price_rollups')
+    bucket = models.CharField(max_length=5, choices=[(b, b) for b in PRICE_BUCKETS])
+    start = models.DateField()
+    min_price = models.DecimalField(max_digits=10, decimal_places=2)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2)
+    last_price = models.DecimalField(max_digits=10, decimal_places=2)
+    last_on = models.DateTimeField()
+    changes = models.PositiveIntegerField(default=0)
+    objects = PriceRollupManager()
+    
+    class Meta:
+        ordering = ['start']
+        unique_together = ('stock_item', 'bucket', 'start')
+        verbose_name = 'price rollup'
+        verbose_name_plural = 'price rollups'
+    
+    def __unicode__(self):
+        return '%s %s %s' % (self.stock_item_id, self.bucket, self.start)
         
 class Cart(models.Model):
-    created_on = models.DateTimeField(auto_now_add=True)
+    created_on = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Moved by every change to the lines, see CartManager.reap
+    last_updates = models.DateTimeField(auto_now=True, db_index=True)
     checked_out = models.BooleanField(default=False)
+    checked_out_on = models.DateTimeField(null=True, blank=True, editable=False)
+    # Whether the sales rollups include this cart, see SalesRollupManager.record
+    sales_recorded = models.BooleanField(default=False, db_index=True, editable=False)
+    objects = CartManager()
     
     class Meta:
         verbose_name = 'cart'
@@ -295,29 +494,292 @@ class CartItem(models.Model):
     def subtotal(self):
         return self.quantity * self.stock_item.get_price()
 
+class StockReservation(models.Model):
+    cart = models.ForeignKey('Cart', related_name='reservations')
+    stock_item = models.ForeignKey('StockItem', related_name='reservations')
+    quantity = models.PositiveIntegerField(default=0)
+    expires_on = models.DateTimeField(db_index=True)
+    objects = StockReservationManager()
+    
+    class Meta:
+        unique_together = ('cart', 'stock_item')
+        verbose_name = 'stock reservation'
+        verbose_name_plural = 'stock reservations'
+    
+    def __unicode__(self):
+        return _("%s held of %s" % (self.quantity, self.stock_item))
 
-# Listen to signals
-from django.db.models.signals import post_save
+class StockItemSales(models.Model):
+    """
+        Units of a stock item sold on one day.
+    """
+    stock_item = models.ForeignKey('StockItem', related_name='daily_sales')
+    day = models.DateField(db_index=True)
+    quantity = models.PositiveIntegerField(default=0)
+    objects = SalesRollupManager()
+    
+    class Meta:
+        unique_together = ('stock_item', 'day')
+        verbose_name = 'stock item sales'
+        verbose_name_plural = 'stock item sales'
+    
+    def __unicode__(self):
+        return '%s %s' % (self.stock_item_id, self.day)
 
-def activate_product(sender, **kwargs):
-    product = kwargs['instance'].product
+class CategorySales(models.Model):
+    """
+        Units sold on one day of the products filed directly under a
+        category.
+    """
+    category = models.ForeignKey('ProductCategory', related_name='daily_sales')
+    day = models.DateField(db_index=True)
+    quantity = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('category', 'day')
+        verbose_name = 'category sales'
+        verbose_name_plural = 'category sales'
+    
+    def __unicode__(self):
+        return '%s %s' % (self.category_id, self.day)
 
-    try:
-        product_stock = StockItem.objects.filter(product=product, inventory__gt=0)
-    except StockItem.DoesNotExist:
-        product_stock = None
+class ProductSearchToken(models.Model):
+    """
+        Token index behind product search on databases without SQLite FTS5.
+        weight is the summed field weight of every occurrence of the token.
+    """
+    product = models.ForeignKey('Product', related_name='search_tokens')
+    token = models.CharField(max_length=64, db_index=True)
+    weight = models.PositiveIntegerField(default=1)
     
-    if product_stock == None and product.is_active == True:
-        product.is_active = False
-        product.save()
-            
-    if product_stock and product.is_active == False:
-        product.is_active = True
-        product.save()
+    class Meta:
+        unique_together = ('product', 'token')
     
-    if product.is_active:
-        return True
+    def __unicode__(self):
+        return self.token
+
+
+# Listen to signals
+import threading
+from contextlib import contextmanager
+from django.db import transaction
+from django.core.signals import request_finished
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+
+_deferred_summary = threading.local()
+
+@contextmanager
+def deferred_stock_summary(using=None):
+    """
+        Runs the block in a transaction with per-row stock summary updates
+        suspended. Every product touched is recomputed once at the end.
+        Yields the set of pending product ids so code that bypasses signals
+        (e.g. QuerySet.update) can add to it.
+    """
+    pending = getattr(_deferred_summary, 'products', None)
+    if pending is not None:
+        yield pending
+        return
+
+    _deferred_summary.products = pending = set()
+    _deferred_summary.search = search = set()
+    _deferred_summary.categories = categories = set()
+    try:
+        with transaction.commit_on_success(using=using):
+            yield pending
+            Product.objects.refresh_stock_summary(pending)
+            ProductCategory.objects.refresh_counts(categories)
+            if search:
+                from search import index_products
+                index_products(search)
+    except:
+        from related import graph
+        graph.discard_pending()
+        raise
+    else:
+        from related import graph
+        graph.apply_pending()
+    finally:
+        _deferred_summary.products = _deferred_summary.search = _deferred_summary.categories = None
+
+def update_stock_summary(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    original = instance._original_state
+    pending = getattr(_deferred_summary, 'products', None)
+
+    if created:
+        original = dict(original, product_id=instance.product_id)
+    if pending is not None:
+        pending.update([instance.product_id, original['product_id']])
+    elif UNTRACKED in original.values() or original['product_id'] != instance.product_id:
+        Product.objects.refresh_stock_summary([instance.product_id, original['product_id']])
+    elif created:
+        Product.objects.apply_stock_delta(instance.product_id, 0, instance.inventory, None, instance.get_effective_price())
+    else:
+        Product.objects.apply_stock_delta(
+            instance.product_id,
+            original['inventory'], instance.inventory,
+            effective_price(original['price'], original['on_sale'], original['sale_price']),
+            instance.get_effective_price(),
+        )
+    instance._track_original_state()
+
+def remove_stock_summary(sender, instance, **kwargs):
+    original = instance._original_state
+    pending = getattr(_deferred_summary, 'products', None)
+
+    if pending is not None:
+        pending.add(original['product_id'])
+    elif UNTRACKED in original.values():
+        Product.objects.refresh_stock_summary([original['product_id']])
+    else:
+        Product.objects.apply_stock_delta(
+            original['product_id'],
+            original['inventory'], 0,
+            effective_price(original['price'], original['on_sale'], original['sale_price']), None,
+        )
+
+def touch_product(sender, instance, **kwargs):
+    # Changes that don't otherwise move Product.last_updates
+    if not kwargs.get('action', 'post_').startswith('post_'):
+        return
+    if 'action' in kwargs and isinstance(instance, StockItemAttributeValue):
+        products = Product.objects.filter(stock__in=kwargs.get('pk_set') or [])
+    elif isinstance(instance, StockItemAttributeValue):
+        # Deletes are seen before the links to the value cascade away
+        products = Product.objects.filter(stock__attributes=instance)
+    elif isinstance(instance, StockItemAttribute):
+        products = Product.objects.filter(stock__attributes__attribute=instance)
+    elif isinstance(instance, Brand):
+        products = Product.objects.filter(brand=instance)
+    elif isinstance(instance, Manufacturer):
+        products = Product.objects.filter(brand__manufacturer=instance)
+    else:
+        products = Product.objects.filter(pk=instance.product_id)
+    products.update(last_updates=datetime.now())
+
+def update_search_index(sender, instance, created=False, raw=False, **kwargs):
+    if raw or not kwargs.get('action', 'post_').startswith('post_'):
+        return
+    if isinstance(instance, Product):
+        products = [instance.pk]
+    elif isinstance(instance, StockItem):
+        original = instance._original_state
+        if kwargs.get('signal') is post_save and not created and \
+                all(original[f] == getattr(instance, f) for f in ('product_id', 'sku', 'package_title')):
+            # Only stock and prices changed, neither is searchable
+            return
+        products = [instance.product_id, original['product_id']]
+    elif isinstance(instance, StockItemAttributeValue):
+        if 'action' in kwargs:
+            products = StockItem.objects.filter(pk__in=kwargs.get('pk_set') or []).values_list('product', flat=True)
+        else:
+            products = Product.objects.filter(stock__attributes=instance).values_list('pk', flat=True)
+    elif isinstance(instance, ProductCategory):
+        # New categories have no products yet and moved ones reindex their
+        # subtree from save(), once the paths below are rewritten
+        if not instance.path or (kwargs.get('signal') is post_save and
+                (instance.parent_id != instance._original_parent_id or instance.name == instance._original_name)):
+            return
+        products = Product.objects.filter(category__path__startswith=instance.path).values_list('pk', flat=True)
+    elif isinstance(instance, Brand):
+        products = Product.objects.filter(brand=instance).values_list('pk', flat=True)
+    elif isinstance(instance, Manufacturer):
+        products = Product.objects.filter(brand__manufacturer=instance).values_list('pk', flat=True)
     else:
-        return False
+        return
+    reindex_products(products)
+
+def reindex_products(products):
+    products = [pk for pk in products if pk is not None and pk is not UNTRACKED]
+    pending = getattr(_deferred_summary, 'search', None)
+    if pending is not None:
+        pending.update(products)
+    elif products:
+        from search import index_products
+        index_products(products)
+
+def invalidate_cached_payloads(sender, instance, **kwargs):
+    if not kwargs.get('action', 'post_').startswith('post_'):
+        return
+    if isinstance(instance, Product):
+        invalidate('product', [instance.pk])
+    elif isinstance(instance, (StockItem, ProductImage)):
+        # A stock item moved between products refreshes both summaries,
+        # which invalidates the old product as well
+        invalidate('product', [instance.product_id])
+    elif isinstance(instance, StockItemAttributeValue):
+        if 'action' in kwargs:
+            products = StockItem.objects.filter(pk__in=kwargs.get('pk_set') or []).values_list('product', flat=True)
+        else:
+            # Deletes are seen before the links to the value cascade away
+            products = Product.objects.filter(stock__attributes=instance).values_list('pk', flat=True)
+        invalidate('product', products)
+    elif isinstance(instance, StockItemAttribute):
+        invalidate('product', Product.objects.filter(stock__attributes__attribute=instance).values_list('pk', flat=True))
+    elif isinstance(instance, ProductCategory):
+        # The parent lists this category among its children
+        invalidate('category', [instance.pk, instance.parent_id, instance._original_parent_id])
+    elif isinstance(instance, Brand):
+        invalidate('brand', [instance.pk])
+    elif isinstance(instance, Manufacturer):
+        invalidate('manufacturer', [instance.pk])
+
+def update_category_counts(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    listing = instance._listing()
+    if kwargs['signal'] is post_delete:
+        changed = [instance.category_id]
+    elif listing != instance._original_listing:
+        changed = [instance.category_id, instance._original_listing[0]]
+    else:
+        return
+    instance._original_listing = listing
+    pending = getattr(_deferred_summary, 'categories', None)
+    if pending is not None:
+        pending.update(changed)
+    else:
+        ProductCategory.objects.refresh_counts(changed)
+
+def update_related_graph(sender, instance, signal, using=None, **kwargs):
+    from related import graph
+    if signal is post_delete:
+        graph.changed(instance.pk, None, using)
+    else:
+        graph.changed(instance.pk, (instance.from_product_id, instance.to_product_id), using)
+
+def expire_related_changes(sender, **kwargs):
+    # TransactionMiddleware has committed or rolled back by now
+    from related import graph
+    graph.expire_pending()
 
-post_save.connect(activate_product, sender=StockItem)
\ No newline at end of file
+# Runs before update_stock_summary resets the tracked original state
+for model in (Product, StockItem, StockItemAttributeValue, ProductCategory, Brand, Manufacturer):
+    post_save.connect(update_search_index, sender=model)
+post_delete.connect(update_search_index, sender=Product)
+post_delete.connect(update_search_index, sender=StockItem)
+m2m_changed.connect(update_search_index, sender=StockItem.attributes.through)
+post_save.connect(update_stock_summary, sender=StockItem)
+post_delete.connect(remove_stock_summary, sender=StockItem)
+post_delete.connect(touch_product, sender=StockItem)
+post_delete.connect(touch_product, sender=ProductImage)
+m2m_changed.connect(touch_product, sender=StockItem.attributes.through)
+# Product payloads, and so their ETag and Last-Modified, show these as well
+for model in (Brand, Manufacturer, StockItemAttribute, StockItemAttributeValue):
+    post_save.connect(touch_product, sender=model)
+pre_delete.connect(touch_product, sender=StockItemAttribute)
+pre_delete.connect(touch_product, sender=StockItemAttributeValue)
+for model in (Product, StockItem, ProductImage, ProductCategory, Brand, Manufacturer):
+    post_save.connect(invalidate_cached_payloads, sender=model)
+    post_delete.connect(invalidate_cached_payloads, sender=model)
+m2m_changed.connect(invalidate_cached_payloads, sender=StockItem.attributes.through)
+for model in (StockItemAttribute, StockItemAttributeValue):
+    post_save.connect(invalidate_cached_payloads, sender=model)
+    pre_delete.connect(invalidate_cached_payloads, sender=model)
+post_save.connect(update_related_graph, sender=ProductRelationship)
+post_save.connect(update_category_counts, sender=Product)
+post_delete.connect(update_category_counts, sender=Product)
+post_delete.connect(update_related_graph, sender=ProductRelationship)
+request_finished.connect(expire_related_changes)
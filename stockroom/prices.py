@@ -0,0 +1,92 @@
+"""
+Price history queries. Short ranges read the raw PriceHistory rows, long
+ones the daily and weekly rollups, so neither scans the whole history and
+both keep working after old raw rows are pruned.
+"""
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from models import StockItem, PriceHistory, PriceRollup
+from managers import bucket_start
+
+# Ranges up to this many days are served from raw rows, up to
+# WEEKLY_SERIES_DAYS from daily rollups and beyond that from weekly ones
+RAW_SERIES_DAYS = getattr(settings, 'STOCKROOM_PRICE_RAW_SERIES_DAYS', 7)
+WEEKLY_SERIES_DAYS = getattr(settings, 'STOCKROOM_PRICE_WEEKLY_SERIES_DAYS', 180)
+# Days of raw PriceHistory rows kept by stockroom_compact_price_history
+PRICE_HISTORY_RETENTION = getattr(settings, 'STOCKROOM_PRICE_HISTORY_RETENTION', 90)
+
+def price_series(stock_item, start, end, bucket=None):
+    """
+        Returns the prices of stock_item between the start and end datetimes
+        as a list of {'start', 'min', 'max', 'last'}, one per change for the
+        'raw' bucket or one per 'day' or 'week'. Without a bucket one is
+        picked from the length of the range.
+    """
+    pk = getattr(stock_item, 'pk', stock_item)
+    if bucket is None:
+        days = (end - start).days
+        bucket = days <= RAW_SERIES_DAYS and 'raw' or days <= WEEKLY_SERIES_DAYS and 'day' or 'week'
+
+    if bucket == 'raw':
+        rows = PriceHistory.objects.filter(stock_item=pk, created_on__gte=start, created_on__lt=end) \
+            .order_by('created_on').values_list('created_on', 'price')
+        return [{'start': on, 'min': price, 'max': price, 'last': price} for on, price in rows]
+
+    # Every bucket that overlaps the range
+    first, final = bucket_start(bucket, start), (end - timedelta(microseconds=1)).date()
+    rows = PriceRollup.objects.filter(stock_item=pk, bucket=bucket, start__gte=first, start__lte=final) \
+        .order_by('start').values_list('start', 'min_price', 'max_price', 'last_price')
+    return [{'start': s, 'min': low, 'max': high, 'last': last} for s, low, high, last in rows]
+
+def lowest_price_since(stock_item, since, now=None):
+    """
+        Returns the lowest price stock_item has had from since until now:
+        the price in effect at since, every change after it and the current
+        price. Once the raw rows of the first day have been pruned, the
+        whole of that day counts.
+    """
+    pk = getattr(stock_item, 'pk', stock_item)
+    now = now or datetime.now()
+    day = since.date()
+    day_start = datetime.combine(day, time.min)
+    raw = PriceHistory.objects.filter(stock_item=pk)
+    rollups = PriceRollup.objects.filter(stock_item=pk, bucket='day')
+
+    candidates = list(StockItem.objects.filter(pk=pk).values_list('price', flat=True))
+    if since < now - timedelta(days=PRICE_HISTORY_RETENTION):
+        candidates.append(rollups.filter(start__gte=day).aggregate(low=Min('min_price'))['low'])
+        opening = []
+    else:
+        # Changes after since: raw rows for the rest of its day, rollups after
+        candidates.append(raw.filter(created_on__gte=since, created_on__lt=day_start + timedelta(days=1))
+            .aggregate(low=Min('price'))['low'])
+        candidates.append(rollups.filter(start__gt=day).aggregate(low=Min('min_price'))['low'])
+        opening = list(raw.filter(created_on__gte=day_start, created_on__lt=since)
+            .order_by('-created_on').values_list('price', flat=True)[:1])
+    if not opening:
+        opening = rollups.filter(start__lt=day).order_by('-start').values_list('last_price', flat=True)[:1]
+    candidates.extend(opening)
+
+    candidates = [c for c in candidates if c is not None]
+    if not candidates:
+        return None
+    return min(candidates)
+
+def prune_price_history(before, batch_size=1000):
+    """
+        Deletes raw PriceHistory rows created before the given datetime in
+        pk batches, one transaction each, and returns how many were
+        deleted. Their rollups stay.
+    """
+    rows = PriceHistory.objects.filter(created_on__lt=before).order_by('pk').values_list('pk', flat=True)
+    deleted = 0
+    while True:
+        with transaction.commit_on_success(using=PriceHistory.objects.db):
+            pks = list(rows[:batch_size])
+            if not pks:
+                break
+            PriceHistory.objects.filter(pk__in=pks).delete()
+        deleted += len(pks)
+    return deleted
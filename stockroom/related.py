@@ -0,0 +1,213 @@
+"""
+Related products.
+
+ProductRelationship rows form a directed graph. Every process keeps the
+whole graph in memory as an adjacency index, loaded from the table in one
+query and kept up to date from the relationship signals. A generation in
+the stockroom cache tells a process when another one changed the graph, in
+which case it loads it again. Changes made inside a transaction are held
+back until it commits, see RelatedGraph.changed. Recommendations walk the index up to a number
+of hops and only then ask the database which of the products found are
+active and in stock.
+"""
+import threading
+import time
+from django.conf import settings
+from django.db import transaction
+from models import Product, ProductRelationship
+from caching import get_stockroom_cache, generation_key, current_generation, invalidate
+
+# Hops a recommendation may walk at most
+RELATED_MAX_HOPS = getattr(settings, 'STOCKROOM_RELATED_MAX_HOPS', 3)
+# Seconds before a process reloads its graph even without a change
+RELATED_GRAPH_TIMEOUT = getattr(settings, 'STOCKROOM_RELATED_GRAPH_TIMEOUT', 5 * 60)
+
+def load_relationships(products):
+    """
+        Returns {pk: [{'product', 'description'}]} with the outgoing
+        relationships of every given product or pk, in one query.
+    """
+    pks = [getattr(p, 'pk', p) for p in products]
+    relationships = dict((pk, []) for pk in pks)
+    rows = ProductRelationship.objects.filter(from_product__in=pks).order_by('pk') \
+        .values_list('from_product', 'to_product', 'description')
+    for from_pk, to_pk, description in rows:
+        relationships[from_pk].append({'product': to_pk, 'description': description})
+    return relationships
+
+class RelatedGraph(object):
+    """
+        In-memory adjacency index over ProductRelationship:
+        {from_pk: {to_pk: number of relationships}}.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Changes of this thread's open transaction, {pk: edge}
+        self.pending = threading.local()
+        self.clear()
+
+    def clear(self):
+        self.adjacency = None
+        self.edges = None
+        self.generation = None
+        self.loaded_on = 0
+
+    def load(self, generation):
+        adjacency, edges = {}, {}
+        for pk, from_pk, to_pk in ProductRelationship.objects.values_list('pk', 'from_product', 'to_product').iterator():
+            edges[pk] = (from_pk, to_pk)
+            neighbours = adjacency.setdefault(from_pk, {})
+            neighbours[to_pk] = neighbours.get(to_pk, 0) + 1
+        self.adjacency, self.edges = adjacency, edges
+        self.generation, self.loaded_on = generation, time.time()
+
+    def current(self):
+        """
+            Returns the adjacency index, loading it first when it is missing,
+            old or another process has changed the graph.
+        """
+        if getattr(self.pending, 'changes', None) and not transaction.is_managed():
+            # The transaction that made them is over, committed or not
+            self.expire_pending()
+        generation = current_generation('related', 'graph')
+        with self.lock:
+            if self.adjacency is None or generation != self.generation or \
+                    self.loaded_on < time.time() - RELATED_GRAPH_TIMEOUT:
+                self.load(generation)
+            return self.adjacency
+
+    def _unlink(self, from_pk, to_pk):
+        # Neighbour dicts are replaced, never changed, so walks running in
+        # other threads keep a consistent view
+        neighbours = dict(self.adjacency.get(from_pk, {}))
+        if neighbours.get(to_pk, 0) > 1:
+            neighbours[to_pk] -= 1
+        else:
+            neighbours.pop(to_pk, None)
+        self.adjacency[from_pk] = neighbours
+
+    def _link(self, from_pk, to_pk):
+        neighbours = dict(self.adjacency.get(from_pk, {}))
+        neighbours[to_pk] = neighbours.get(to_pk, 0) + 1
+        self.adjacency[from_pk] = neighbours
+
+    def changed(self, pk, edge, using=None):
+        """
+            Applies a saved relationship, edge being its (from_pk, to_pk), or
+            a deleted one, edge being None. Inside a transaction the change
+            is only queued: neither this process nor others may see a graph
+            that could still be rolled back.
+        """
+        if transaction.is_managed(using=using):
+            changes = getattr(self.pending, 'changes', None)
+            if changes is None:
+                changes = self.pending.changes = {}
+            changes[pk] = edge
+        else:
+            self.apply({pk: edge})
+
+    def apply(self, changes):
+        """
+            Applies {pk: edge} as changed does, with one generation bump.
+        """
+        try:
+            generation = get_stockroom_cache().incr(generation_key('related', 'graph'))
+        except ValueError:
+            generation = None
+        with self.lock:
+            if self.adjacency is None:
+                return
+            if generation is None or generation != self.generation + 1:
+                # Someone else changed the graph as well, start over
+                self.clear()
+                return
+            for pk, edge in changes.items():
+                if pk in self.edges:
+                    self._unlink(*self.edges.pop(pk))
+                if edge is not None:
+                    self.edges[pk] = edge
+                    self._link(*edge)
+            self.generation = generation
+
+    def apply_pending(self):
+        """
+            Applies the queued changes once their transaction committed.
+        """
+        changes = getattr(self.pending, 'changes', None)
+        self.pending.changes = None
+        if changes:
+            self.apply(changes)
+
+    def discard_pending(self):
+        self.pending.changes = None
+
+    def expire_pending(self):
+        """
+            Makes every process load the graph again when the queued changes
+            may or may not have committed.
+        """
+        changes = getattr(self.pending, 'changes', None)
+        self.pending.changes = None
+        if changes:
+            invalidate('related', ['graph'])
+
+graph = RelatedGraph()
+
+def _walk(adjacency, sources, hops):
+    """
+        Returns the products reachable from sources within hops, nearest
+        first and, at the same distance, reached by the most relationships
+        first.
+    """
+    seen = set(sources)
+    ranked = []
+    frontier = list(sources)
+    for distance in range(hops):
+        reached = {}
+        for pk in frontier:
+            for to_pk, count in adjacency.get(pk, {}).items():
+                if to_pk not in seen:
+                    reached[to_pk] = reached.get(to_pk, 0) + count
+        if not reached:
+            break
+        frontier = sorted(reached, key=lambda pk: (-reached[pk], pk))
+        seen.update(frontier)
+        ranked.extend(frontier)
+    return ranked
+
+def _available(pks):
+    return set(Product.objects.filter(pk__in=pks, is_active=True, in_stock_variants__gt=0).values_list('pk', flat=True))
+
+def _clamp(hops):
+    return max(1, min(hops, RELATED_MAX_HOPS))
+
+def related_products(products, hops=1, limit=10, exclude=()):
+    """
+        Returns the pks of up to limit active, in stock products related to
+        any of the given products or pks within hops, best first. The given
+        products and exclude are never returned.
+    """
+    sources = [getattr(p, 'pk', p) for p in products]
+    excluded = set(getattr(p, 'pk', p) for p in exclude)
+    candidates = [pk for pk in _walk(graph.current(), sources, _clamp(hops)) if pk not in excluded]
+    related = []
+    # Most candidates are usually available, so one query normally does
+    step = max(limit * 2, 20)
+    for start in range(0, len(candidates), step):
+        chunk = candidates[start:start + step]
+        available = _available(chunk)
+        related.extend(pk for pk in chunk if pk in available)
+        if len(related) >= limit:
+            break
+    return related[:limit]
+
+def related_for_each(products, hops=1, limit=10):
+    """
+        Returns {pk: [related pks]} for a page of products, like calling
+        related_products for each one but with one availability query.
+    """
+    adjacency = graph.current()
+    pks = [getattr(p, 'pk', p) for p in products]
+    walks = dict((pk, _walk(adjacency, [pk], _clamp(hops))) for pk in pks)
+    available = _available(set(pk for ranked in walks.values() for pk in ranked))
+    return dict((pk, [r for r in ranked if r in available][:limit]) for pk, ranked in walks.items())
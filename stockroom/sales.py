@@ -0,0 +1,48 @@
+"""
+Best sellers from the daily sales rollups. Queries read one StockItemSales
+or CategorySales row per sold item or category and day of the window, count
+them up in a Counter and take the top entries with a heap, so no request
+looks at cart lines or sorts everything that sold.
+"""
+from datetime import date, timedelta
+from counter import Counter
+from models import StockItemSales, CategorySales, category_path_segment
+
+def _window(days, end):
+    end = end or date.today()
+    return end - timedelta(days=days - 1), end
+
+def best_sellers(category=None, days=30, end=None, limit=10, per='product'):
+    """
+        Returns [(pk, units)] for the best selling products, or stock items
+        with per='stock_item', over the days ending with end (today by
+        default). With a category only it and its subcategories count.
+    """
+    start, end = _window(days, end)
+    rows = StockItemSales.objects.filter(day__gte=start, day__lte=end)
+    if category is not None:
+        rows = rows.filter(stock_item__product__category__path__startswith=category.path)
+    key = per == 'stock_item' and 'stock_item' or 'stock_item__product'
+    units = Counter()
+    for pk, quantity in rows.values_list(key, 'quantity').iterator():
+        units[pk] += quantity
+    return units.most_common(limit)
+
+def best_selling_categories(parent=None, days=30, end=None, limit=10):
+    """
+        Returns [(pk, units)] for the children of parent, or the top level
+        categories, that sold the most over the days ending with end,
+        counting the sales of their whole subtree.
+    """
+    start, end = _window(days, end)
+    rows = CategorySales.objects.filter(day__gte=start, day__lte=end)
+    offset = 0
+    if parent is not None:
+        rows = rows.filter(category__path__startswith=parent.path).exclude(category=parent)
+        offset = len(parent.path)
+    step = len(category_path_segment(0))
+    units = Counter()
+    for path, quantity in rows.values_list('category__path', 'quantity').iterator():
+        # The child of parent the category is filed under
+        units[int(path[offset:offset + step - 1])] += quantity
+    return units.most_common(limit)
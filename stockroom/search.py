@@ -0,0 +1,196 @@
+"""
+Ranked product search.
+
+Every product has one document (title, skus, brand, category path,
+package titles and attribute values, description) kept in an index that is
+updated as products and their relations change. On SQLite with FTS5 the
+index is an FTS5 table ranked with bm25; elsewhere it is the
+ProductSearchToken table, ranked by the summed field weights of the
+matching tokens. Every search term has to match.
+"""
+import re
+import sqlite3
+from django.conf import settings
+from django.db import connections
+from django.db.models import Sum, Count
+from models import Product, ProductCategory, ProductSearchToken
+
+# 'fts5' or 'tokens', chosen from the database when unset
+SEARCH_BACKEND = getattr(settings, 'STOCKROOM_SEARCH_BACKEND', None)
+SEARCH_INDEX_CHUNK_SIZE = getattr(settings, 'STOCKROOM_SEARCH_INDEX_CHUNK_SIZE', 500)
+FTS_TABLE = 'stockroom_product_fts'
+# Document fields and their weight in ranking
+FIELDS = (
+    ('title', 10),
+    ('sku', 10),
+    ('brand', 4),
+    ('category', 3),
+    ('variants', 3),
+    ('description', 1),
+)
+
+def tokenize(text):
+    # Matches how the FTS5 unicode61 tokenizer splits words
+    return re.findall(r'[^\W_]+', (text or u'').lower(), re.UNICODE)
+
+_fts5 = []
+
+def fts5_available():
+    if not _fts5:
+        try:
+            sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE t USING fts5(a)')
+            _fts5.append(True)
+        except sqlite3.Error:
+            _fts5.append(False)
+    return _fts5[0]
+
+def build_documents(pks):
+    """
+        Returns {pk: {field: text}} for the products with the given pks.
+    """
+    products = list(Product.objects.filter(pk__in=pks).select_related('brand__manufacturer', 'category')
+        .prefetch_related('stock__attributes'))
+    ancestors = set()
+    for p in products:
+        if p.category_id:
+            ancestors.update(int(segment) for segment in p.category.path.split('/') if segment)
+    names = dict(ProductCategory.objects.filter(pk__in=ancestors).values_list('pk', 'name'))
+
+    documents = {}
+    for p in products:
+        skus, variants = [p.sku], []
+        for s in p.stock.all():
+            skus.append(s.sku)
+            variants.append(s.package_title)
+            variants.extend(a.value for a in s.attributes.all())
+        brand = []
+        if p.brand_id:
+            brand.append(p.brand.name)
+            if p.brand.manufacturer_id:
+                brand.append(p.brand.manufacturer.name)
+        category = []
+        if p.category_id:
+            category = [names.get(int(segment), u'') for segment in p.category.path.split('/') if segment]
+        documents[p.pk] = {
+            'title' : p.title,
+            'sku' : u' '.join(s for s in skus if s),
+            'brand' : u' '.join(brand),
+            'category' : u' '.join(category),
+            'variants' : u' '.join(v for v in variants if v),
+            'description' : p.description or u'',
+        }
+    return documents
+
+class TokenBackend(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def create(self):
+        # ProductSearchToken is created by syncdb
+        pass
+
+    def index(self, documents):
+        rows = []
+        for pk, document in documents.items():
+            weights = {}
+            for field, weight in FIELDS:
+                for token in tokenize(document[field]):
+                    token = token[:64]
+                    weights[token] = weights.get(token, 0) + weight
+            rows.extend(ProductSearchToken(product_id=pk, token=t, weight=w) for t, w in weights.items())
+        ProductSearchToken.objects.bulk_create(rows)
+
+    def remove(self, pks):
+        ProductSearchToken.objects.filter(product__in=list(pks)).delete()
+
+    def clear(self):
+        ProductSearchToken.objects.all().delete()
+
+    def search(self, tokens, offset, limit):
+        tokens = set(t[:64] for t in tokens)
+        matches = ProductSearchToken.objects.filter(token__in=tokens).values('product') \
+            .annotate(score=Sum('weight'), matched=Count('token')).filter(matched=len(tokens)) \
+            .order_by('-score', 'product')
+        return [m['product'] for m in matches[offset:offset + limit]]
+
+class Fts5Backend(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.table = connection.ops.quote_name(FTS_TABLE)
+
+    def create(self):
+        self.connection.cursor().execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s)' % (
+            self.table, ', '.join(field for field, weight in FIELDS)))
+
+    def index(self, documents):
+        self.connection.cursor().executemany(
+            'INSERT INTO %s (rowid, %s) VALUES (%%s, %s)' % (
+                self.table, ', '.join(field for field, weight in FIELDS), ', '.join(['%s'] * len(FIELDS))),
+            [[pk] + [document[field] for field, weight in FIELDS] for pk, document in documents.items()])
+
+    def remove(self, pks):
+        pks = list(pks)
+        if pks:
+            self.connection.cursor().execute('DELETE FROM %s WHERE rowid IN (%s)' % (
+                self.table, ', '.join(['%s'] * len(pks))), pks)
+
+    def clear(self):
+        self.connection.cursor().execute('DELETE FROM %s' % self.table)
+
+    def search(self, tokens, offset, limit):
+        # Quoted terms are matched literally and all of them must match
+        query = ' '.join('"%s"' % t for t in tokens)
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT rowid FROM %s WHERE %s MATCH %%s ORDER BY bm25(%s, %s), rowid LIMIT %%s OFFSET %%s' % (
+            self.table, self.table, self.table, ', '.join(str(float(weight)) for field, weight in FIELDS)),
+            [query, limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+BACKENDS = {
+    'tokens' : TokenBackend,
+    'fts5' : Fts5Backend,
+}
+
+def get_backend(using=None):
+    connection = connections[using or Product.objects.db]
+    name = SEARCH_BACKEND
+    if name is None:
+        name = connection.vendor == 'sqlite' and fts5_available() and 'fts5' or 'tokens'
+    return BACKENDS[name](connection)
+
+def index_products(pks):
+    """
+        Rebuilds the documents of the given products, dropping those that
+        no longer exist.
+    """
+    pks = list(set(pks))
+    backend = get_backend()
+    for start in range(0, len(pks), SEARCH_INDEX_CHUNK_SIZE):
+        chunk = pks[start:start + SEARCH_INDEX_CHUNK_SIZE]
+        backend.remove(chunk)
+        backend.index(build_documents(chunk))
+
+def rebuild_index():
+    backend = get_backend()
+    backend.clear()
+    count = 0
+    pks = Product.objects.order_by('pk').values_list('pk', flat=True)
+    last_pk = 0
+    while True:
+        chunk = list(pks.filter(pk__gt=last_pk)[:SEARCH_INDEX_CHUNK_SIZE])
+        if not chunk:
+            break
+        backend.index(build_documents(chunk))
+        count += len(chunk)
+        last_pk = chunk[-1]
+    return count
+
+def search_products(query, offset=0, limit=20):
+    """
+        Returns the pks of the products matching every term of query, best
+        match first.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    return get_backend().search(tokens, offset, limit)
@@ -0,0 +1,2 @@
+-- Price charts and lowest price checks read one stock item over a date range
+CREATE INDEX stockroom_pricehistory_item_created ON stockroom_pricehistory (stock_item_id, created_on);
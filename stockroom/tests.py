@@ -21,3 +21,1383 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+from decimal import Decimal
+from stockroom.models import Product, StockItem
+
+class CommerceSummaryTest(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(title='Shirt')
+        StockItem.objects.create(product=self.product, price=Decimal('20.00'), inventory=3)
+        StockItem.objects.create(product=self.product, price=Decimal('30.00'), on_sale=True, sale_price=Decimal('15.00'))
+        StockItem.objects.create(product=self.product, price=Decimal('0.00'), inventory=1)
+        self.empty = Product.objects.create(title='Hat')
+
+    def test_annotations_match_per_row_methods(self):
+        products = dict((p.pk, p) for p in Product.objects.with_commerce_summary())
+        for pk in (self.product.pk, self.empty.pk):
+            annotated, plain = products[pk], Product.objects.get(pk=pk)
+            self.assertEqual(annotated.in_stock(), plain.in_stock())
+            self.assertEqual(annotated.has_image(), plain.has_image())
+            self.assertEqual(annotated.on_sale(), plain.on_sale())
+        self.assertEqual(products[self.product.pk].lowest_price(), Decimal('15.00'))
+        self.assertEqual(products[self.empty.pk].lowest_price(), None)
+
+    def test_listing_is_one_query(self):
+        with self.assertNumQueries(1):
+            for p in Product.objects.with_commerce_summary():
+                p.in_stock(), p.has_image(), p.lowest_price(), p.on_sale()
+
+from stockroom.models import ProductCategory
+
+class CategoryTreeTest(TestCase):
+    def setUp(self):
+        self.root = ProductCategory.objects.create(name='Clothing', slug='clothing')
+        self.shirts = ProductCategory.objects.create(name='Shirts', slug='shirts', parent=self.root)
+        self.tees = ProductCategory.objects.create(name='Tees', slug='tees', parent=self.shirts)
+        self.shoes = ProductCategory.objects.create(name='Shoes', slug='shoes')
+
+    def test_ancestors_and_descendants(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(list(self.tees.get_ancestors()), [self.root, self.shirts])
+        self.assertEqual(set(self.root.get_descendants()), set([self.shirts, self.tees]))
+        self.assertEqual(self.tees.depth, 2)
+        self.assertEqual(repr(self.tees), 'Clothing:Shirts:Tees')
+
+    def test_move_rewrites_subtree(self):
+        self.shirts.parent = self.shoes
+        self.shirts.save()
+        tees = ProductCategory.objects.get(pk=self.tees.pk)
+        self.assertEqual(list(tees.get_ancestors()), [self.shoes, self.shirts])
+        self.assertEqual(list(self.root.get_descendants()), [])
+
+    def test_move_rewrites_deeper_subtree(self):
+        polos = ProductCategory.objects.create(name='Polos', slug='polos', parent=self.shirts)
+        self.root.parent = self.shoes
+        self.root.save()
+        moved = ProductCategory.objects.filter(pk__in=[self.shirts.pk, self.tees.pk, polos.pk]).order_by('pk')
+        self.assertEqual([c.depth for c in moved], [2, 3, 3])
+        self.assertEqual([list(c.get_ancestors()) for c in moved],
+            [[self.shoes, self.root], [self.shoes, self.root, self.shirts], [self.shoes, self.root, self.shirts]])
+        # One read of the pks to invalidate and one UPDATE, however deep
+        root = ProductCategory.objects.get(pk=self.root.pk)
+        with self.assertNumQueries(2):
+            ProductCategory.objects.reroot_subtree(root.pk, root.path, root.path)
+
+    def test_cannot_move_into_own_subtree(self):
+        self.root.parent = self.tees
+        self.assertRaises(ValueError, self.root.save)
+
+    def test_rebuild(self):
+        ProductCategory.objects.update(path='', depth=0)
+        self.assertEqual(ProductCategory.objects.rebuild(), 4)
+        tees = ProductCategory.objects.get(pk=self.tees.pk)
+        self.assertEqual(tees.depth, 2)
+        self.assertEqual(list(tees.get_ancestors()), [self.root, self.shirts])
+
+from cStringIO import StringIO
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from stockroom.models import ProductImage, deferred_stock_summary
+from stockroom.thumbnails import Image
+
+_buf = StringIO()
+Image.new('RGB', (400, 300), 'red').save(_buf, 'PNG')
+PNG = _buf.getvalue()
+
+class StockSummaryTest(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(title='Sock')
+
+    def summary(self):
+        return Product.objects.values_list('total_inventory', 'in_stock_variants', 'min_price', 'is_active').get(pk=self.product.pk)
+
+    def test_incremental_updates(self):
+        small = StockItem.objects.create(product=self.product, price=Decimal('5.00'), inventory=2)
+        large = StockItem.objects.create(product=self.product, price=Decimal('8.00'), inventory=0)
+        self.assertEqual(self.summary(), (2, 1, Decimal('5.00'), True))
+
+        large.inventory = 4
+        large.save()
+        small.price = Decimal('9.00')
+        small.save()
+        self.assertEqual(self.summary(), (6, 2, Decimal('8.00'), True))
+
+        large.on_sale, large.sale_price = True, Decimal('6.50')
+        large.save()
+        self.assertEqual(self.summary(), (6, 2, Decimal('6.50'), True))
+
+        small.delete()
+        large.inventory = 0
+        large.save()
+        self.assertEqual(self.summary(), (0, 0, Decimal('6.50'), False))
+
+    def test_deferred_mode_recomputes_once(self):
+        with deferred_stock_summary() as pending:
+            for i in range(5):
+                StockItem.objects.create(product=self.product, price=Decimal('%d.00' % (i + 1)), inventory=1)
+            self.assertEqual(self.summary(), (0, 0, None, False))
+            StockItem.objects.filter(product=self.product).update(inventory=3)
+            pending.add(self.product.pk)
+        self.assertEqual(self.summary(), (15, 5, Decimal('1.00'), True))
+
+    def test_stale_instances_keep_the_summary(self):
+        StockItem.objects.create(product=self.product, price=Decimal('5.00'), inventory=4)
+        # self.product was loaded before the stock arrived
+        self.product.title = 'Wool sock'
+        self.product.save()
+        self.assertEqual(self.summary(), (4, 1, Decimal('5.00'), True))
+        image = ProductImage(product=self.product, caption='Pair')
+        image.image_file.save('sock.png', ContentFile(PNG))
+        try:
+            self.assertEqual(self.summary(), (4, 1, Decimal('5.00'), True))
+            self.assertEqual(Product.objects.get(pk=self.product.pk).thumbnail_id, image.pk)
+        finally:
+            default_storage.delete(image.image_file.name)
+            for variant in image.get_variants():
+                default_storage.delete(variant['path'])
+
+    def test_manual_deactivation_survives_saves(self):
+        StockItem.objects.create(product=self.product, price=Decimal('5.00'), inventory=4)
+        product = Product.objects.get(pk=self.product.pk)
+        product.is_active = False
+        product.save()
+        self.assertEqual(self.summary(), (4, 1, Decimal('5.00'), False))
+        # More stock and recounts leave the merchant's choice alone
+        StockItem.objects.create(product=self.product, price=Decimal('7.00'), inventory=1)
+        with self.assertNumQueries(3):
+            Product.objects.refresh_stock_summary([self.product.pk])
+        self.assertEqual(self.summary(), (5, 2, Decimal('5.00'), False))
+        # Running out and restocking lists it again
+        StockItem.objects.filter(product=self.product).update(inventory=0)
+        Product.objects.refresh_stock_summary([self.product.pk])
+        self.assertEqual(self.summary(), (0, 0, Decimal('5.00'), False))
+        StockItem.objects.create(product=self.product, price=Decimal('6.00'), inventory=2)
+        self.assertEqual(self.summary(), (2, 1, Decimal('5.00'), True))
+
+from stockroom.models import PriceHistory
+
+class RepriceTest(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(title='Mug')
+        self.cheap = StockItem.objects.create(product=self.product, price=Decimal('10.00'), inventory=1)
+        self.dear = StockItem.objects.create(product=self.product, price=Decimal('19.99'), inventory=1)
+
+    def test_save_detects_price_change_without_select(self):
+        item = StockItem.objects.get(pk=self.cheap.pk)
+        item.price = Decimal('9.00')
+        with self.assertNumQueries(6):
+            # History INSERT, rollup SELECT and INSERT, Django's existence
+            # check, UPDATE, min price UPDATE
+            item.save()
+        self.assertEqual(PriceHistory.objects.filter(stock_item=item).count(), 1)
+
+    def test_percentage_reprice(self):
+        # The stock summary refresh reads the listing state of the products
+        # around its one UPDATE, to recount their categories only when it
+        # changes
+        with self.assertNumQueries(10):
+            changed = StockItem.objects.reprice(StockItem.objects.all(), percent=10, on_sale=True)
+        self.assertEqual(changed, 2)
+        self.assertEqual(
+            sorted(StockItem.objects.values_list('price', 'on_sale')),
+            [(Decimal('11.00'), True), (Decimal('21.99'), True)],
+        )
+        self.assertEqual(sorted(PriceHistory.objects.values_list('price', flat=True)), [Decimal('11.00'), Decimal('21.99')])
+        self.assertEqual(Product.objects.get(pk=self.product.pk).min_price, Decimal('11.00'))
+
+from django.test.client import RequestFactory
+from stockroom.cart import Cart, CART_ID, ItemDoesNotExist, CartDoesNotExist
+from stockroom.models import Cart as CartModel, CartItem
+
+class LazyCartTest(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        self.request.session = {}
+        product = Product.objects.create(title='Pen')
+        self.item = StockItem.objects.create(product=product, price=Decimal('2.50'), inventory=5)
+
+    def test_reads_do_not_create_a_cart(self):
+        cart = Cart(self.request)
+        with self.assertNumQueries(0):
+            self.assertEqual(cart.total_quantity(), 0)
+            self.assertEqual(list(cart), [])
+            self.assertEqual(cart.summary(), None)
+        self.assertEqual(CartModel.objects.count(), 0)
+
+    def test_first_add_persists_the_cart(self):
+        Cart(self.request).add(self.item, self.item.price, 2)
+        self.assertEqual(CartModel.objects.count(), 1)
+        self.assertEqual(Cart(self.request).total_quantity(), 2)
+        self.assertEqual(self.request.session[CART_ID], CartModel.objects.get().pk)
+
+class CartTotalsTest(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        self.request.session = {}
+        product = Product.objects.create(title='Lamp')
+        self.regular = StockItem.objects.create(product=product, price=Decimal('10.10'), inventory=5)
+        self.sale = StockItem.objects.create(product=product, price=Decimal('30.00'), on_sale=True, sale_price=Decimal('20.20'), inventory=5)
+        cart = Cart(self.request)
+        cart.add(self.regular, self.regular.price, 3)
+        cart.add(self.sale, self.sale.sale_price, 1)
+
+    def test_totals_are_decimal_and_cached(self):
+        cart = Cart(self.request)
+        with self.assertNumQueries(2):
+            totals = cart.totals()
+        self.assertEqual(totals, {'subtotal': Decimal('50.50'), 'item_count': 4, 'line_count': 2})
+        with self.assertNumQueries(0):
+            Cart(self.request).subtotal()
+            Cart(self.request).total_quantity()
+
+    def test_mutations_invalidate_the_cache(self):
+        cart = Cart(self.request)
+        cart.totals()
+        cart.update(self.regular, self.regular.price, 1)
+        self.assertEqual(cart.subtotal(), Decimal('30.30'))
+        cart.clear()
+        self.assertEqual(cart.total_quantity(), 0)
+
+from datetime import datetime, timedelta
+from django.db.models import Sum
+from django.test import TransactionTestCase
+from stockroom.models import StockReservation
+
+class ReservationTest(TransactionTestCase):
+    def setUp(self):
+        product = Product.objects.create(title='Ticket')
+        self.item = StockItem.objects.create(product=product, price=Decimal('40.00'), inventory=5)
+
+    def cart(self):
+        request = RequestFactory().get('/')
+        request.session = {}
+        return Cart(request)
+
+    def inventory(self):
+        return StockItem.objects.get(pk=self.item.pk).inventory
+
+    def held(self):
+        return StockReservation.objects.aggregate(Sum('quantity'))['quantity__sum'] or 0
+
+    def test_holds_follow_the_cart(self):
+        cart = self.cart()
+        self.assertEqual(cart.add(self.item, self.item.price, 3), 0)
+        self.assertEqual((self.inventory(), self.held()), (5, 3))
+        cart.update(self.item, self.item.price, 1)
+        self.assertEqual(self.held(), 1)
+        cart.remove(CartItem.objects.get())
+        self.assertEqual(StockReservation.objects.count(), 0)
+
+    def test_no_overselling(self):
+        first, second = self.cart(), self.cart()
+        first.add(self.item, self.item.price, 3)
+        self.assertEqual(second.add(self.item, self.item.price, 3), 1)
+        # The line keeps what could be held
+        self.assertEqual(CartItem.objects.get(cart=second.cart).quantity, 2)
+        self.assertEqual(second.update(self.item, self.item.price, 4), 2)
+        self.assertEqual(CartItem.objects.get(cart=second.cart).quantity, 2)
+        self.assertEqual((self.inventory(), self.held()), (5, 5))
+        # Units in carts don't take the product out of listings
+        self.assertTrue(Product.objects.get(pk=self.item.product_id).is_active)
+        self.assertEqual(self.cart().add(self.item, self.item.price, 1), 1)
+        self.assertEqual(CartItem.objects.count(), 2)
+
+    def test_expired_holds_stop_counting(self):
+        first, second = self.cart(), self.cart()
+        first.add(self.item, self.item.price, 3)
+        StockReservation.objects.update(expires_on=datetime.now() - timedelta(seconds=1))
+        self.assertEqual(second.add(self.item, self.item.price, 4), 0)
+        self.assertEqual(StockReservation.objects.release_expired(), 1)
+
+    def test_checkout_reports_shortfalls_after_expiry(self):
+        first, second = self.cart(), self.cart()
+        first.add(self.item, self.item.price, 3)
+        self.assertEqual(StockReservation.objects.release_expired(datetime.now() + timedelta(days=1)), 1)
+        second.add(self.item, self.item.price, 4)
+        self.assertEqual(first.checkout_cart(), {self.item.pk: 2})
+        self.assertFalse(CartModel.objects.get(pk=first.cart.pk).checked_out)
+        self.assertEqual((self.inventory(), self.held()), (5, 4))
+
+    def test_checkout_commits_the_holds(self):
+        cart = self.cart()
+        cart.add(self.item, self.item.price, 5)
+        self.assertEqual(cart.checkout_cart(), {})
+        self.assertTrue(CartModel.objects.get(pk=cart.cart.pk).checked_out)
+        self.assertEqual(self.inventory(), 0)
+        self.assertEqual(StockReservation.objects.count(), 0)
+        self.assertFalse(Product.objects.get(pk=self.item.product_id).is_active)
+
+    def test_checkout_without_a_cart(self):
+        self.assertRaises(CartDoesNotExist, self.cart().checkout_cart)
+
+    def test_remove_is_scoped_to_the_cart(self):
+        first, second = self.cart(), self.cart()
+        first.add(self.item, self.item.price, 2)
+        second.add(self.item, self.item.price, 1)
+        line = CartItem.objects.get(cart=first.cart)
+        self.assertRaises(ItemDoesNotExist, second.remove, line)
+        self.assertTrue(CartItem.objects.filter(pk=line.pk).exists())
+        self.assertEqual(self.held(), 3)
+
+import json
+from django.db import connection
+
+class BatchCartTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        self.request.session = {}
+        product = Product.objects.create(title='Bundle')
+        self.items = [StockItem.objects.create(product=product, price=Decimal('1.00'), inventory=10) for i in range(6)]
+
+    def test_update_many(self):
+        cart = Cart(self.request)
+        cart.add(self.items[0], None, 1)
+        lines = [(item, 2) for item in self.items] + [(self.items[0], 0)]
+        self.assertEqual(cart.update_many(lines), {})
+        self.assertEqual(sorted(CartItem.objects.values_list('stock_item', flat=True)), [i.pk for i in self.items[1:]])
+        self.assertEqual(cart.total_quantity(), 10)
+        holds = dict(StockReservation.objects.values_list('stock_item', 'quantity'))
+        self.assertEqual(holds, dict((i.pk, 2) for i in self.items[1:]))
+
+        cart.remove_many(self.items[1:3])
+        cart.clear()
+        self.assertEqual(CartItem.objects.count(), 0)
+        self.assertEqual(StockReservation.objects.count(), 0)
+
+    def count_queries(self, func, *args):
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            func(*args)
+        finally:
+            connection.use_debug_cursor = None
+        return len(connection.queries) - start
+
+    def test_query_count_does_not_grow_with_lines(self):
+        few = self.count_queries(Cart(self.request).update_many, [(item, 2) for item in self.items[:2]])
+        Cart(self.request).clear()
+        many = self.count_queries(Cart(self.request).update_many, [(item, 2) for item in self.items])
+        self.assertEqual(few, many)
+
+    def test_batched_put(self):
+        lines = [{'stock_item': item.pk, 'quantity': 3} for item in self.items[:4]]
+        response = self.client.put('/cart/', json.dumps({'lines': lines}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(len(data['items']), 4)
+        self.assertEqual(data['totals']['item_count'], 12)
+
+        response = self.client.put('/cart/', json.dumps([{'stock_item': 0, 'quantity': 1}]), content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+from stockroom.models import Brand, Manufacturer, StockItemAttribute, StockItemAttributeValue
+from stockroom.utils import structure_products, iter_structured_products
+
+class StructureProductsTest(TestCase):
+    def setUp(self):
+        brand = Brand.objects.create(name='Acme', manufacturer=Manufacturer.objects.create(name='Acme Corp'))
+        category = ProductCategory.objects.create(name='Tools', slug='tools')
+        size = StockItemAttribute.objects.create(name='Size', slug='size')
+        self.medium = StockItemAttributeValue.objects.create(attribute=size, value='M')
+        for n in range(5):
+            product = Product.objects.create(title='Tool %d' % n, brand=brand, category=category)
+            for price in ('3.00', '4.00'):
+                item = StockItem.objects.create(product=product, price=Decimal(price), inventory=1)
+                item.attributes.add(self.medium)
+
+    def test_fixed_number_of_queries(self):
+        # products, images, stock, attribute values and attributes
+        with self.assertNumQueries(5):
+            products = list(iter_structured_products(Product.objects.all(), chunk_size=10))
+        self.assertEqual(len(products), 5)
+        self.assertEqual(products[0]['brand']['manufacturer']['name'], 'Acme Corp')
+        self.assertEqual(products[0]['price'], Decimal('3.00'))
+        self.assertEqual(products[0]['inventory']['stock'][0]['attributes'][0]['value'], 'M')
+
+    def test_chunks(self):
+        with self.assertNumQueries(5 * 3):
+            products = list(iter_structured_products(Product.objects.all(), chunk_size=2))
+        self.assertEqual([p['title'] for p in products], ['Tool %d' % n for n in range(5)])
+
+from stockroom.api.pagination import encode_cursor
+
+class PaginationTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        for n in range(7):
+            Product.objects.create(title='Item %d' % n)
+        # Ties on created_on must still page cleanly
+        Product.objects.filter(title__in=['Item 2', 'Item 3', 'Item 4']).update(created_on=datetime(2011, 1, 1, 12, 0, 0, 500))
+
+    def walk(self, order):
+        seen = []
+        response = json.loads(self.client.get('/products/', {'order': order, 'limit': 3}).content)
+        pages = [response]
+        while response['next']:
+            response = json.loads(self.client.get('/products/', {'cursor': response['next'], 'limit': 3}).content)
+            pages.append(response)
+        return pages
+
+    def titles(self, page):
+        return [p['title'] for p in page['results']]
+
+    def test_forward_and_back(self):
+        for order in ('pk', '-pk', 'created_on', '-last_updates'):
+            pages = self.walk(order)
+            titles = sum([self.titles(p) for p in pages], [])
+            self.assertEqual(sorted(titles), sorted(set(titles)))
+            self.assertEqual(len(titles), 7)
+            self.assertEqual(pages[0]['previous'], None)
+            back = json.loads(self.client.get('/products/', {'cursor': pages[-1]['previous'], 'limit': 3}).content)
+            self.assertEqual(self.titles(back), self.titles(pages[-2]))
+
+    def test_bad_cursor(self):
+        self.assertEqual(self.client.get('/products/', {'cursor': 'nonsense'}).status_code, 400)
+        self.assertEqual(self.client.get('/products/', {'order': 'title'}).status_code, 400)
+
+    def test_tampered_cursor(self):
+        for ordering, values, forward in (('pk', ['one'], True), ('-pk', [None], True), ('created_on', [3, 1], True),
+                ('created_on', ['2011-01-01', {}], True), ('last_updates', ['soon', 1], False), ('pk', [1], 'yes')):
+            cursor = encode_cursor(ordering, values, forward)
+            self.assertEqual(self.client.get('/products/', {'cursor': cursor}).status_code, 400)
+
+    def test_categories(self):
+        for n in range(3):
+            ProductCategory.objects.create(name='Cat %d' % n, slug='cat-%d' % n)
+        page = json.loads(self.client.get('/categories/', {'limit': 2, 'order': 'path'}).content)
+        self.assertEqual(len(page['results']), 2)
+        page = json.loads(self.client.get('/categories/', {'cursor': page['next']}).content)
+        self.assertEqual([c['slug'] for c in page['results']], ['cat-2'])
+
+from stockroom.models import ProductImage
+from stockroom.caching import get_stockroom_cache
+
+class ConditionalGetTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        get_stockroom_cache().clear()
+        self.category = ProductCategory.objects.create(name='Bags', slug='bags')
+        self.product = Product.objects.create(title='Tote', category=self.category)
+        self.item = StockItem.objects.create(product=self.product, price=Decimal('12.00'), inventory=2)
+        self.url = '/products/%d/' % self.product.pk
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_stock_changes_change_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        StockItem.objects.create(product=self.product, price=Decimal('14.00'), inventory=1)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        StockItem.objects.filter(pk=self.item.pk).delete()
+        self.assertNotEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)['ETag'], response['ETag'])
+
+    def test_brand_and_attribute_changes_change_the_etag(self):
+        brand = Brand.objects.create(name='Acme')
+        value = StockItemAttributeValue.objects.create(value='L',
+            attribute=StockItemAttribute.objects.create(name='Size', slug='size'))
+        self.item.attributes.add(value)
+        Product.objects.filter(pk=self.product.pk).update(brand=brand)
+        def rename():
+            brand.name = 'Globex'
+            brand.save()
+        def relabel():
+            value.value = 'XL'
+            value.save()
+        for change in (rename, relabel, value.delete):
+            # Last-Modified has one second resolution
+            earlier = datetime.now() - timedelta(seconds=2)
+            Product.objects.filter(pk=self.product.pk).update(last_updates=earlier)
+            StockItem.objects.filter(pk=self.item.pk).update(last_updates=earlier)
+            ProductCategory.objects.filter(pk=self.category.pk).update(last_updates=earlier)
+            response = self.client.get(self.url)
+            change()
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+            self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 200)
+
+    def test_category(self):
+        url = '/categories/bags/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        ProductCategory.objects.create(name='Backpacks', slug='backpacks', parent=self.category)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+from stockroom import caching
+from stockroom.api.handlers import ProductHandler, ProductCategoryHandler, CategoryTreeHandler
+
+class PayloadCacheTest(TestCase):
+    def setUp(self):
+        get_stockroom_cache().clear()
+        self.brand = Brand.objects.create(name='Moka')
+        self.category = ProductCategory.objects.create(name='Coffee', slug='coffee')
+        self.product = Product.objects.create(title='Pot', brand=self.brand, category=self.category)
+        self.item = StockItem.objects.create(product=self.product, price=Decimal('30.00'), inventory=4)
+        self.request = RequestFactory().get('/')
+
+    def read(self):
+        return ProductHandler().read(self.request, product_pk=str(self.product.pk))
+
+    def test_hits_need_no_queries(self):
+        self.read()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.read()['title'], 'Pot')
+
+    def test_related_changes_invalidate(self):
+        self.read()
+        self.item.price = Decimal('25.00')
+        self.item.save()
+        self.assertEqual(self.read()['price'], Decimal('25.00'))
+        self.brand.name = 'Bialetti'
+        self.brand.save()
+        self.assertEqual(self.read()['brand']['name'], 'Bialetti')
+        # Checkouts write with QuerySet.update and bypass signals
+        request = RequestFactory().get('/')
+        request.session = {}
+        cart = Cart(request)
+        cart.add(self.item, self.item.price, 3)
+        cart.checkout_cart()
+        self.assertEqual(self.read()['inventory']['total'], 1)
+
+    def test_category_children(self):
+        handler = ProductCategoryHandler()
+        self.assertEqual(handler.read(self.request, slug='coffee')['children'], [])
+        ProductCategory.objects.create(name='Beans', slug='beans', parent=self.category)
+        self.assertEqual(len(handler.read(self.request, slug='coffee')['children']), 1)
+
+    def test_only_one_worker_rebuilds(self):
+        self.read()
+        self.item.price = Decimal('20.00')
+        self.item.save()
+        # Another worker is rebuilding: serve the stale copy without building
+        get_stockroom_cache().add('%s:lock' % caching.product_key(self.product.pk), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.read()['price'], Decimal('30.00'))
+
+    def test_attribute_value_changes_invalidate(self):
+        value = StockItemAttributeValue.objects.create(attribute=StockItemAttribute.objects.create(name='Size', slug='size'), value='M')
+        self.item.attributes.add(value)
+        self.read()
+        value.value = 'L'
+        value.save()
+        self.assertEqual(self.read()['inventory']['stock'][0]['attributes'][0]['value'], 'L')
+        value.delete()
+        self.assertEqual(self.read()['inventory']['stock'][0]['attributes'], [])
+
+    def test_changes_during_a_build_leave_it_stale(self):
+        def build(payload):
+            def call():
+                # Lands after the generations are read
+                caching.invalidate('brand', [self.brand.pk])
+                return payload
+            return call
+        dependencies = lambda: [('brand', self.brand.pk)]
+        self.assertEqual(caching.read_through('raced', dependencies, build('old')), 'old')
+        self.assertEqual(caching.read_through('raced', dependencies, lambda: 'new'), 'new')
+
+import logging
+from django.core.management import call_command
+from stockroom.utils import build_thumbnail_list
+from stockroom.thumbnails import PRODUCT_THUMBNAILS
+
+class ThumbnailTest(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(title='Poster')
+        buf = StringIO()
+        Image.new('RGB', (400, 300), 'red').save(buf, 'PNG')
+        self.image = ProductImage(product=self.product, caption='Front')
+        self.image.image_file.save('poster.png', ContentFile(buf.getvalue()))
+
+    def tearDown(self):
+        for variant in ProductImage.objects.get(pk=self.image.pk).get_variants():
+            default_storage.delete(variant['path'])
+        default_storage.delete(self.image.image_file.name)
+
+    def test_variants_are_rendered_on_save(self):
+        image = ProductImage.objects.get(pk=self.image.pk)
+        variants = image.get_variants()
+        self.assertEqual(len(variants), len(PRODUCT_THUMBNAILS))
+        for variant in variants:
+            self.assertTrue(default_storage.exists(variant['path']))
+            width, height = map(int, variant['size'].split('x'))
+            self.assertEqual(Image.open(default_storage.path(variant['path'])).size, (variant['width'], variant['height']))
+            self.assertTrue(variant['width'] <= width and variant['height'] <= height)
+
+    def test_render_failures_are_logged(self):
+        logged = []
+        handler = logging.Handler()
+        handler.emit = logged.append
+        logging.getLogger('stockroom.thumbnails').addHandler(handler)
+        try:
+            image = ProductImage(product=self.product)
+            image.image_file.save('broken.png', ContentFile('not an image'))
+        finally:
+            logging.getLogger('stockroom.thumbnails').removeHandler(handler)
+        self.assertEqual(len(logged), 1)
+        self.assertEqual(ProductImage.objects.get(pk=image.pk).variants, '')
+        default_storage.delete(image.image_file.name)
+        # The command renders what save couldn't
+        ProductImage.objects.filter(pk=self.image.pk).update(variants='')
+        saved = ProductImage.objects.get(pk=self.image.pk)
+        saved.caption = 'Back'
+        saved.save()
+        self.assertEqual(ProductImage.objects.get(pk=saved.pk).variants, '')
+        call_command('stockroom_thumbnails', processes=1, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(len(ProductImage.objects.get(pk=saved.pk).get_variants()), len(PRODUCT_THUMBNAILS))
+
+    def test_urls_come_from_metadata(self):
+        product = Product.objects.prefetch_related('images').get(pk=self.product.pk)
+        with self.assertNumQueries(0):
+            images = build_thumbnail_list(product)
+        self.assertEqual(sorted(images[0]['sizes'].keys()), sorted('%sx%s' % s for s in PRODUCT_THUMBNAILS))
+
+from stockroom.importer import CatalogImporter, read_csv, read_jsonl
+
+class ImportTest(TestCase):
+    CSV = (
+        'product_sku,title,category,brand,manufacturer,sku,package_title,inventory,price,on_sale,sale_price,attributes\n'
+        'TEE,Tee,Apparel/Shirts,Basics,Acme,TEE-M,Medium,5,10.00,,,size=M;color=Blue\n'
+        'TEE,,,,,TEE-L,Large,0,12.00,yes,9.00,size=L\n'
+        'MUG,,Kitchen,,,MUG-1,,3,4.00,,,\n'
+        'TEE,,,,,TEE-S,Small,1,not-a-price,,,\n'
+    )
+
+    def run_import(self, f, reader=read_csv):
+        rejected = []
+        stats = CatalogImporter(batch_size=2, on_reject=lambda line, reason: rejected.append(line)).run(reader(f))
+        return stats, rejected
+
+    def test_creates_catalog(self):
+        stats, rejected = self.run_import(StringIO(self.CSV))
+        # MUG has no title and the last row no valid price
+        self.assertEqual(sorted(rejected), [4, 5])
+        self.assertEqual((stats['products_created'], stats['stock_created']), (1, 2))
+        product = Product.objects.get(sku='TEE')
+        self.assertEqual(product.category.get_ancestors()[0].name, 'Apparel')
+        self.assertEqual(product.brand.manufacturer.name, 'Acme')
+        self.assertEqual((product.total_inventory, product.in_stock_variants, product.min_price), (5, 1, Decimal('9.00')))
+        self.assertTrue(product.is_active)
+        medium = StockItem.objects.get(sku='TEE-M')
+        self.assertEqual(sorted(medium.attributes.values_list('value', flat=True)), ['Blue', 'M'])
+
+    def test_updates_by_sku(self):
+        self.run_import(StringIO(self.CSV))
+        lines = [
+            '{"product_sku": "TEE", "sku": "TEE-M", "inventory": 0, "price": "11.00", "attributes": {"size": "M"}}',
+            '{"product_sku": "TEE", "sku": "TEE-L", "package_title": "Large", "inventory": 0, "price": "12.00", "on_sale": true, "sale_price": "9.00"}',
+            'not json',
+        ]
+        stats, rejected = self.run_import(StringIO('\n'.join(lines)), read_jsonl)
+        self.assertEqual(rejected, [3])
+        self.assertEqual((stats['stock_created'], stats['stock_updated']), (0, 1))
+        medium = StockItem.objects.get(sku='TEE-M')
+        self.assertEqual((medium.price, medium.package_title), (Decimal('11.00'), 'Medium'))
+        self.assertEqual(list(medium.attributes.values_list('value', flat=True)), ['M'])
+        self.assertEqual(PriceHistory.objects.filter(stock_item=medium).count(), 1)
+        self.assertFalse(Product.objects.get(sku='TEE').is_active)
+
+    def test_attribute_names_sharing_a_slug(self):
+        lines = [
+            '{"product_sku": "TEE", "title": "Tee", "sku": "TEE-M", "price": "10.00", "attributes": {"Size": "M"}}',
+            '{"product_sku": "TEE", "sku": "TEE-L", "price": "10.00", "attributes": {"size ": "L"}}',
+        ]
+        stats, rejected = self.run_import(StringIO('\n'.join(lines)), read_jsonl)
+        self.assertEqual((rejected, stats['stock_created']), ([], 2))
+        self.assertEqual(list(StockItemAttribute.objects.values_list('slug', flat=True)), ['size'])
+        self.assertEqual(StockItem.objects.get(sku='TEE-L').attributes.get().value, 'L')
+
+    def test_moving_stock_refreshes_both_products(self):
+        self.run_import(StringIO(self.CSV))
+        line = '{"product_sku": "CUP", "title": "Cup", "sku": "TEE-M", "inventory": 5, "price": "10.00"}'
+        self.run_import(StringIO(line), read_jsonl)
+        self.assertEqual(StockItem.objects.get(sku='TEE-M').product.sku, 'CUP')
+        tee = Product.objects.get(sku='TEE')
+        self.assertEqual((tee.total_inventory, tee.in_stock_variants, tee.is_active), (0, 0, False))
+        self.assertEqual(Product.objects.get(sku='CUP').total_inventory, 5)
+
+import gzip
+from stockroom.export import export_queryset, write_ndjson
+
+class ExportTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        self.root = ProductCategory.objects.create(name='Apparel', slug='apparel')
+        self.shirts = ProductCategory.objects.create(name='Shirts', slug='shirts', parent=self.root)
+        self.other = ProductCategory.objects.create(name='Kitchen', slug='kitchen')
+        for i, category in enumerate([self.shirts, self.shirts, self.other]):
+            product = Product.objects.create(title='Product %d' % i, category=category)
+            StockItem.objects.create(product=product, inventory=i, price=Decimal('5.00'))
+
+    def test_write_ndjson(self):
+        f = StringIO()
+        self.assertEqual(write_ndjson(export_queryset(self.root), f, chunk_size=1), 2)
+        lines = [json.loads(line) for line in f.getvalue().splitlines()]
+        self.assertEqual([p['title'] for p in lines], ['Product 0', 'Product 1'])
+        f = StringIO()
+        self.assertEqual(write_ndjson(export_queryset(active_only=True), f), 2)
+
+    def test_streaming_endpoint(self):
+        response = self.client.get('/products/export/', {'category': 'kitchen'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        body = gzip.GzipFile(fileobj=StringIO(''.join(response))).read()
+        self.assertEqual([json.loads(line)['title'] for line in body.splitlines()], ['Product 2'])
+        self.assertEqual(self.client.get('/products/export/', {'since': 'yesterday'}).status_code, 400)
+
+class FacetTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        self.size = StockItemAttribute.objects.create(name='Size', slug='size')
+        self.color = StockItemAttribute.objects.create(name='Color', slug='color')
+        values = {}
+        for attribute, value in [(self.size, 'M'), (self.size, 'L'), (self.color, 'blue'), (self.color, 'red')]:
+            values[value] = StockItemAttributeValue.objects.create(attribute=attribute, value=value)
+        # (product, [(size, color) per stock item])
+        catalog = [
+            ('Tee', [('M', 'blue'), ('L', 'red')]),
+            ('Polo', [('M', 'red')]),
+            ('Hoodie', [('L', 'blue')]),
+        ]
+        for title, variants in catalog:
+            product = Product.objects.create(title=title)
+            for size, color in variants:
+                item = StockItem.objects.create(product=product, inventory=1, price=Decimal('5.00'))
+                item.attributes.add(values[size], values[color])
+
+    def titles(self, **params):
+        response = self.client.get('/products/', params)
+        return sorted(p['title'] for p in json.loads(response.content)['results'])
+
+    def test_filters_match_a_single_variant(self):
+        self.assertEqual(self.titles(**{'attr.size': 'M'}), ['Polo', 'Tee'])
+        self.assertEqual(self.titles(**{'attr.size': 'M', 'attr.color': 'blue'}), ['Tee'])
+        self.assertEqual(self.titles(**{'attr.size': 'L', 'attr.color': 'blue,red'}), ['Hoodie', 'Tee'])
+
+    def test_facet_counts(self):
+        with self.assertNumQueries(2):
+            facets = Product.objects.facet_counts({'size': ['M']})
+        # Size ignores its own filter, color counts the size M products
+        self.assertEqual(facets['size']['values'], [{'value': 'L', 'count': 2}, {'value': 'M', 'count': 2}])
+        self.assertEqual(facets['color']['values'], [{'value': 'blue', 'count': 1}, {'value': 'red', 'count': 2}])
+        response = json.loads(self.client.get('/products/', {'facets': 1}).content)
+        self.assertEqual(response['facets']['color']['values'], [{'value': 'blue', 'count': 2}, {'value': 'red', 'count': 2}])
+
+from stockroom import search
+from stockroom.models import ProductSearchToken
+
+class SearchTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        apparel = ProductCategory.objects.create(name='Apparel', slug='apparel')
+        shirts = ProductCategory.objects.create(name='Shirts', slug='shirts', parent=apparel)
+        self.brand = Brand.objects.create(name='Basics')
+        self.tee = Product.objects.create(title='Blue Tee', category=shirts, brand=self.brand)
+        self.polo = Product.objects.create(title='Polo', description='A blue collared shirt', category=shirts)
+        self.mug = Product.objects.create(title='Mug', sku='MUG-1')
+        self.item = StockItem.objects.create(product=self.polo, package_title='Two pack', price=Decimal('5.00'))
+
+    def assertFinds(self, query, expected):
+        self.assertEqual(search.search_products(query), [p.pk for p in expected])
+
+    def test_backends_rank_title_matches_first(self):
+        get_backend = search.get_backend
+        for backend in (search.TokenBackend, search.Fts5Backend):
+            search.get_backend = lambda using=None, backend=backend: backend(connection)
+            try:
+                search.rebuild_index()
+                self.assertFinds('blue', [self.tee, self.polo])
+                self.assertFinds('apparel basics', [self.tee])
+                self.assertFinds('mug 1', [self.mug])
+                self.assertFinds('missing', [])
+            finally:
+                search.get_backend = get_backend
+
+    def test_index_follows_changes(self):
+        self.assertFinds('pack', [self.polo])
+        self.item.package_title = 'Single'
+        self.item.save()
+        self.assertFinds('pack', [])
+        self.brand.name = 'Premium'
+        self.brand.save()
+        self.assertFinds('premium', [self.tee])
+        self.tee.delete()
+        self.assertFinds('premium', [])
+
+    def test_new_category_reindexes_nothing(self):
+        indexed = []
+        index_products = search.index_products
+        search.index_products = indexed.extend
+        try:
+            ProductCategory.objects.create(name='Garden', slug='garden')
+        finally:
+            search.index_products = index_products
+        self.assertEqual(indexed, [])
+
+    def test_moving_a_category_reindexes_its_subtree(self):
+        clothing = ProductCategory.objects.create(name='Clothing', slug='clothing')
+        apparel = ProductCategory.objects.get(slug='apparel')
+        apparel.parent = clothing
+        apparel.save()
+        self.assertFinds('clothing', [self.tee, self.polo])
+        apparel.name = 'Wear'
+        apparel.save()
+        self.assertFinds('apparel', [])
+        self.assertFinds('wear', [self.tee, self.polo])
+
+    def test_endpoint(self):
+        response = json.loads(self.client.get('/products/search/', {'q': 'shirts', 'limit': 1}).content)
+        self.assertEqual([p['id'] for p in response['results']], [self.tee.pk])
+        response = json.loads(self.client.get('/products/search/', {'q': 'shirts', 'cursor': response['next']}).content)
+        self.assertEqual([p['id'] for p in response['results']], [self.polo.pk])
+        self.assertEqual(response['next'], None)
+        self.assertEqual(self.client.get('/products/search/', {'q': ' '}).status_code, 400)
+
+from django.contrib import admin as admin_site
+from django.contrib.messages import get_messages
+from django.contrib.messages.storage import default_storage as message_storage
+from stockroom import admin
+
+class AdminSearchTest(TestCase):
+    def setUp(self):
+        self.tee = Product.objects.create(title='Tshirt', sku='TEE-100')
+        self.mug = Product.objects.create(title='Enamel mug', sku='MUG-1')
+
+    def search(self, query):
+        request = RequestFactory().get('/', {'q': query})
+        request.session = {}
+        request._messages = message_storage(request)
+        model_admin = admin.ProductAdmin(Product, admin_site.site)
+        changelist = model_admin.get_changelist(request)(request, Product, model_admin.list_display,
+            model_admin.list_display_links, model_admin.list_filter, model_admin.date_hierarchy,
+            model_admin.search_fields, model_admin.list_select_related, model_admin.list_per_page,
+            model_admin.list_max_show_all, model_admin.list_editable, model_admin)
+        return sorted(p.title for p in changelist.get_query_set(request)), [m.message for m in get_messages(request)]
+
+    def test_falls_back_to_substrings(self):
+        self.assertEqual(self.search('enamel')[0], ['Enamel mug'])
+        # SKU prefixes, short terms and parts of words
+        self.assertEqual(self.search('TEE-1')[0], ['Tshirt'])
+        self.assertEqual(self.search('ug')[0], ['Enamel mug'])
+        self.assertEqual(self.search('shirt')[0], ['Tshirt'])
+
+    def test_tells_when_results_are_capped(self):
+        limit = admin.ADMIN_SEARCH_LIMIT
+        admin.ADMIN_SEARCH_LIMIT = 1
+        try:
+            titles, messages = self.search('mug tshirt enamel')
+            self.assertEqual(messages, [])
+            titles, messages = self.search('enamel mug')
+            self.assertEqual(len(titles), 1)
+            self.assertTrue('Only the best 1 matches' in messages[0])
+        finally:
+            admin.ADMIN_SEARCH_LIMIT = limit
+
+from stockroom.models import PriceRollup
+from stockroom.prices import price_series, lowest_price_since, prune_price_history
+
+class PriceRollupTest(TestCase):
+    def setUp(self):
+        self.item = StockItem.objects.create(product=Product.objects.create(title='Kettle'), price=Decimal('30.00'))
+        # Monday to Wednesday of one week, then the next Monday
+        self.changes = [
+            (datetime(2026, 3, 2, 9), Decimal('25.00')),
+            (datetime(2026, 3, 2, 17), Decimal('28.00')),
+            (datetime(2026, 3, 4, 12), Decimal('20.00')),
+            (datetime(2026, 3, 9, 12), Decimal('30.00')),
+        ]
+        for on, price in self.changes:
+            PriceHistory.objects.record([PriceHistory(stock_item=self.item, price=price)])
+            PriceHistory.objects.filter(stock_item=self.item, price=price).update(created_on=on)
+        PriceRollup.objects.rebuild()
+
+    def test_rollups(self):
+        monday = PriceRollup.objects.get(stock_item=self.item, bucket='day', start=datetime(2026, 3, 2).date())
+        self.assertEqual((monday.min_price, monday.max_price, monday.last_price, monday.changes),
+            (Decimal('25.00'), Decimal('28.00'), Decimal('28.00'), 2))
+        week = PriceRollup.objects.get(stock_item=self.item, bucket='week', start=datetime(2026, 3, 2).date())
+        self.assertEqual((week.min_price, week.last_price, week.changes), (Decimal('20.00'), Decimal('20.00'), 3))
+
+    def test_recording_updates_rollups(self):
+        self.item.price = Decimal('15.00')
+        self.item.save()
+        today = PriceRollup.objects.get(stock_item=self.item, bucket='day', start=datetime.now().date())
+        self.assertEqual((today.min_price, today.changes), (Decimal('15.00'), 1))
+        self.item.price = Decimal('18.00')
+        self.item.save()
+        today = PriceRollup.objects.get(pk=today.pk)
+        self.assertEqual((today.min_price, today.max_price, today.last_price, today.changes),
+            (Decimal('15.00'), Decimal('18.00'), Decimal('18.00'), 2))
+
+    def test_series(self):
+        start, end = datetime(2026, 3, 2), datetime(2026, 3, 10)
+        self.assertEqual([p['last'] for p in price_series(self.item, start, end, 'raw')], [p for on, p in self.changes])
+        self.assertEqual([p['min'] for p in price_series(self.item, start, end, 'day')],
+            [Decimal('25.00'), Decimal('20.00'), Decimal('30.00')])
+        self.assertEqual([p['min'] for p in price_series(self.item, datetime(2026, 3, 4), end, 'week')],
+            [Decimal('20.00'), Decimal('30.00')])
+
+    def test_lowest_price_since(self):
+        now = datetime(2026, 3, 20)
+        # Tuesday opens at Monday's last price
+        self.assertEqual(lowest_price_since(self.item, datetime(2026, 3, 3), now), Decimal('20.00'))
+        self.assertEqual(lowest_price_since(self.item, datetime(2026, 3, 5), now), Decimal('20.00'))
+        self.assertEqual(lowest_price_since(self.item, datetime(2026, 3, 9, 13), now), Decimal('30.00'))
+        # Monday evening: only the 17:00 change and what followed count
+        self.assertEqual(lowest_price_since(self.item, datetime(2026, 3, 2, 18), now), Decimal('20.00'))
+        # Before Monday's change the price was Wednesday's
+        self.assertEqual(lowest_price_since(self.item, datetime(2026, 3, 9, 10), now), Decimal('20.00'))
+
+    def test_prune_keeps_rollups(self):
+        self.assertEqual(prune_price_history(datetime(2026, 3, 5)), 3)
+        self.assertEqual(PriceHistory.objects.count(), 1)
+        self.assertEqual(len(price_series(self.item, datetime(2026, 3, 2), datetime(2026, 3, 10), 'day')), 3)
+
+import os
+import tempfile
+
+class ReapCartsTest(TestCase):
+    def setUp(self):
+        self.item = StockItem.objects.create(product=Product.objects.create(title='Lamp'), price=Decimal('5.00'), inventory=10)
+        self.old = datetime.now() - timedelta(days=60)
+        self.abandoned = [self.cart(False) for i in range(5)]
+        self.held = self.cart(False)
+        StockReservation.objects.hold(self.held, self.item, 1)
+        self.recent = CartModel.objects.create()
+        self.sold = self.cart(True)
+
+    def cart(self, checked_out):
+        cart = CartModel.objects.create(checked_out=checked_out)
+        CartItem.objects.create(cart=cart, stock_item=self.item, quantity=1)
+        CartModel.objects.filter(pk=cart.pk).update(created_on=self.old, last_updates=self.old)
+        return cart
+
+    def test_recent_activity_keeps_old_carts(self):
+        request = RequestFactory().get('/')
+        request.session = {CART_ID: self.abandoned[0].pk}
+        Cart(request).update_many([(self.item, 2)])
+        # Kept for the change, not the hold
+        StockReservation.objects.release(self.abandoned[0])
+        self.assertEqual(CartModel.objects.reap(datetime.now() - timedelta(days=30)), 4)
+        self.assertTrue(CartModel.objects.filter(pk=self.abandoned[0].pk).exists())
+
+    def test_reap_in_batches(self):
+        self.assertEqual(CartModel.objects.reap(datetime.now() - timedelta(days=30), batch_size=2), 5)
+        self.assertEqual(sorted(CartModel.objects.values_list('pk', flat=True)),
+            sorted([self.held.pk, self.recent.pk, self.sold.pk]))
+        self.assertEqual(CartItem.objects.filter(cart__in=[c.pk for c in self.abandoned]).count(), 0)
+
+    def test_archive_checked_out(self):
+        fd, name = tempfile.mkstemp(suffix='.ndjson')
+        os.close(fd)
+        try:
+            call_command('stockroom_reap_carts', archive=name, stdout=StringIO())
+            lines = [json.loads(line) for line in open(name)]
+        finally:
+            os.remove(name)
+        self.assertEqual([(c['id'], c['items']) for c in lines], [(self.sold.pk, [{'stock_item': self.item.pk, 'quantity': 1}])])
+        self.assertFalse(CartModel.objects.filter(pk=self.sold.pk).exists())
+        self.assertTrue(CartModel.objects.filter(pk=self.held.pk).exists())
+
+from stockroom.benchmarks import seed_catalog, run_benchmarks, compare, measure, scenarios
+
+class BenchmarkTest(TestCase):
+    def test_runs_every_scenario(self):
+        catalog = seed_catalog(products=12, variants=2, depth=2, branching=2, carts=3)
+        self.assertEqual(Product.objects.count(), 12)
+        self.assertEqual(StockItem.objects.count(), 24)
+        results = run_benchmarks(catalog, repeat=1)
+        self.assertTrue('api.products.list' in results and 'cart.checkout_cart' in results)
+        self.assertEqual(results['api.products.detail.warm']['queries'], 0)
+
+    def test_runs_start_from_the_same_stock(self):
+        catalog = seed_catalog(products=6, variants=2, depth=1, branching=2, carts=1)
+        sold = catalog['items'][:5]
+        StockItem.objects.filter(pk__in=sold).update(inventory=2)
+        for name in ('cart.checkout_cart', 'api.cart.update'):
+            run, setup = scenarios(catalog)[name]
+            measure(run, setup, repeat=3)
+        self.assertEqual(list(StockItem.objects.filter(pk__in=sold).values_list('inventory', flat=True)), [1] * 5)
+        self.assertEqual(StockReservation.objects.filter(stock_item__in=sold).values('cart').distinct().count(), 1)
+
+    def test_compare(self):
+        baseline = {'a': {'seconds': 0.1, 'queries': 3, 'memory_kb': 0}}
+        self.assertEqual(compare({'a': {'seconds': 0.12, 'queries': 3, 'memory_kb': 10}}, baseline), [])
+        self.assertEqual(len(compare({'a': {'seconds': 0.2, 'queries': 4, 'memory_kb': 0}}, baseline)), 2)
+
+    def test_measures_memory_below_an_earlier_peak(self):
+        # An earlier, heavier allocation must not hide a later scenario's
+        block = ' ' * (64 << 20)
+        del block
+        kept = []
+        result = measure(lambda state: kept.append(' ' * (4 << 20)), repeat=2)
+        self.assertTrue(result['memory_kb'] >= 3 << 10)
+
+from django.test.utils import override_settings
+from stockroom import instrumentation
+
+@override_settings(MIDDLEWARE_CLASSES=(
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'stockroom.middleware.QueryInstrumentationMiddleware',
+))
+class InstrumentationTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        self.saved = instrumentation.INSTRUMENTATION, instrumentation.QUERY_BUDGETS, instrumentation.QUERY_BUDGET_ACTION
+        instrumentation.INSTRUMENTATION = True
+        for n in range(3):
+            Product.objects.create(title='Item %d' % n)
+
+    def tearDown(self):
+        instrumentation.INSTRUMENTATION, instrumentation.QUERY_BUDGETS, instrumentation.QUERY_BUDGET_ACTION = self.saved
+
+    def test_fingerprint(self):
+        self.assertEqual(instrumentation.fingerprint("SELECT * FROM t WHERE a = 'x' AND b IN (1, 2, 3)"),
+            'SELECT * FROM t WHERE a = ? AND b IN (...)')
+
+    def test_records_handler_queries(self):
+        request = RequestFactory().get('/')
+        request.session = {}
+        ProductHandler().read(request, product_pk=str(Product.objects.all()[0].pk))
+        record = request._stockroom_query_records[0]
+        self.assertEqual(record['name'], 'api.products.read')
+        self.assertTrue(record['queries'] > 0 and record['slowest'])
+        # Nothing is left behind on the connection outside DEBUG
+        self.assertEqual(connection.queries, [])
+
+    def test_duplicates(self):
+        recorder = instrumentation.QueryRecorder('loop')
+        with recorder:
+            for p in Product.objects.all():
+                Product.objects.get(pk=p.pk)
+        self.assertEqual(recorder.record['queries'], 4)
+        self.assertEqual(recorder.record['duplicates'][0]['count'], 3)
+
+    def test_server_timing(self):
+        response = self.client.get('/products/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Server-Timing'].startswith('db;dur='))
+        self.assertTrue('api.products.read;dur=' in response['Server-Timing'])
+
+    def test_budgets(self):
+        instrumentation.QUERY_BUDGETS = {'stockroom-api-products': 0}
+        self.assertEqual(self.client.get('/products/').status_code, 200)
+        instrumentation.QUERY_BUDGET_ACTION = 'raise'
+        request = RequestFactory().get('/')
+        request.session = {}
+        instrumentation.QUERY_BUDGETS = {'cart.add': {'queries': 1}}
+        self.assertRaises(instrumentation.QueryBudgetExceeded, Cart(request).add, StockItem.objects.create(
+            product=Product.objects.all()[0], price=Decimal('1.00'), inventory=1), None, 1)
+
+    def test_off_by_default(self):
+        instrumentation.INSTRUMENTATION = False
+        self.assertFalse(self.client.get('/products/').has_header('Server-Timing'))
+
+from stockroom.models import ProductRelationship
+from django.core.signals import request_finished
+from stockroom.related import graph, load_relationships, related_products, related_for_each
+
+class RelatedProductsTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        get_stockroom_cache().clear()
+        graph.clear()
+        self.p = {}
+        for name in 'abcdef':
+            self.p[name] = Product.objects.create(title=name)
+            StockItem.objects.create(product=self.p[name], price=Decimal('5.00'), inventory=name != 'e' and 3 or 0)
+        Product.objects.filter(pk=self.p['d'].pk).update(is_active=False)
+        for edge in ('ab', 'ad', 'ae', 'bc', 'cf', 'af'):
+            self.relate(edge)
+
+    def relate(self, edge):
+        return ProductRelationship.objects.create(from_product=self.p[edge[0]], to_product=self.p[edge[1]], description=edge)
+
+    def pks(self, names):
+        return [self.p[n].pk for n in names]
+
+    def test_load_relationships(self):
+        with self.assertNumQueries(1):
+            relationships = load_relationships(self.pks('ab'))
+        self.assertEqual([r['product'] for r in relationships[self.p['a'].pk]], self.pks('bdef'))
+        self.assertEqual(relationships[self.p['b'].pk][0]['description'], 'bc')
+
+    def test_hops(self):
+        self.assertEqual(related_products([self.p['a']]), self.pks('bf'))
+        # c is two hops away; f was already one
+        self.assertEqual(related_products([self.p['a']], hops=2), self.pks('bfc'))
+        with self.assertNumQueries(1):
+            self.assertEqual(related_for_each(self.pks('bc'), hops=2), {self.p['b'].pk: self.pks('cf'), self.p['c'].pk: self.pks('f')})
+
+    def test_incremental_refresh(self):
+        related_products([self.p['b']])
+        with deferred_stock_summary():
+            relationship = self.relate('bd')
+        Product.objects.filter(pk=self.p['d'].pk).update(is_active=True)
+        with self.assertNumQueries(1):
+            self.assertEqual(related_products([self.p['b']]), self.pks('cd'))
+        with deferred_stock_summary():
+            relationship.delete()
+        self.assertEqual(related_products([self.p['b']]), self.pks('c'))
+
+    def test_changes_wait_for_the_commit(self):
+        related_products([self.p['b']])
+        Product.objects.filter(pk=self.p['d'].pk).update(is_active=True)
+        generation = caching.current_generation('related', 'graph')
+        try:
+            with deferred_stock_summary():
+                self.relate('bd')
+                self.assertEqual(caching.current_generation('related', 'graph'), generation)
+                self.assertEqual(related_products([self.p['b']]), self.pks('c'))
+                raise ValueError
+        except ValueError:
+            pass
+        # TestCase turns the rollback into a no-op
+        ProductRelationship.objects.filter(description='bd').delete()
+        self.assertEqual(caching.current_generation('related', 'graph'), generation)
+        self.assertEqual(related_products([self.p['b']]), self.pks('c'))
+        # Requests can't tell a commit from a rollback, so they reload
+        self.relate('bd')
+        request_finished.send(sender=None)
+        self.assertEqual(related_products([self.p['b']]), self.pks('cd'))
+
+    def test_changes_from_other_processes(self):
+        related_products([self.p['b']])
+        # Writes that bypass signals are only seen once the graph is invalidated
+        ProductRelationship.objects.filter(description='bc').update(to_product=self.p['a'])
+        self.assertEqual(related_products([self.p['b']]), self.pks('c'))
+        caching.invalidate('related', ['graph'])
+        self.assertEqual(related_products([self.p['b']]), self.pks('a'))
+
+    def test_api_and_cart(self):
+        response = json.loads(self.client.get('/products/%d/related/' % self.p['a'].pk, {'hops': 2}).content)
+        self.assertEqual([r['id'] for r in response['results']], self.pks('bfc'))
+        request = RequestFactory().get('/')
+        request.session = {}
+        cart = Cart(request)
+        cart.add(self.p['a'].stock.get(), None, 1)
+        cart.add(self.p['b'].stock.get(), None, 1)
+        self.assertEqual(cart.related_products(), self.pks('cf'))
+
+from datetime import date
+from stockroom import cart as cart_module
+from stockroom.models import StockItemSales, CategorySales
+from stockroom.sales import best_sellers, best_selling_categories
+
+class SalesTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        tools = ProductCategory.objects.create(name='Tools', slug='tools')
+        self.saws = ProductCategory.objects.create(name='Saws', slug='saws', parent=tools)
+        self.drills = ProductCategory.objects.create(name='Drills', slug='drills', parent=tools)
+        self.tools = ProductCategory.objects.get(pk=tools.pk)
+        self.items = []
+        for title, category in (('Saw', self.saws), ('Drill', self.drills), ('Driver', self.drills), ('Gift card', None)):
+            product = Product.objects.create(title=title, category=category)
+            self.items.append(StockItem.objects.create(product=product, price=Decimal('10.00'), inventory=100))
+
+    def sell(self, *quantities):
+        request = RequestFactory().get('/')
+        request.session = {}
+        cart = Cart(request)
+        cart.update_many(zip(self.items, quantities))
+        self.assertEqual(cart.checkout_cart(), {})
+        return cart.cart
+
+    def test_rollups_at_checkout(self):
+        self.sell(1, 5, 2, 9)
+        self.sell(3, 1, 0, 0)
+        self.assertEqual(StockItemSales.objects.get(stock_item=self.items[0]).quantity, 4)
+        self.assertEqual(CategorySales.objects.get(category=self.drills).quantity, 8)
+        with self.assertNumQueries(1):
+            self.assertEqual(best_sellers(limit=2), [(self.items[3].product_id, 9), (self.items[1].product_id, 6)])
+        self.assertEqual(best_sellers(self.tools, limit=1), [(self.items[1].product_id, 6)])
+        self.assertEqual(best_sellers(self.saws, per='stock_item'), [(self.items[0].pk, 4)])
+        self.assertEqual(best_selling_categories(), [(self.tools.pk, 12)])
+        self.assertEqual(best_selling_categories(self.tools), [(self.drills.pk, 8), (self.saws.pk, 4)])
+
+    def test_window_and_catch_up(self):
+        cart_module.RECORD_SALES_AT_CHECKOUT = False
+        try:
+            old = self.sell(2, 0, 0, 0)
+            self.sell(0, 1, 0, 0)
+        finally:
+            cart_module.RECORD_SALES_AT_CHECKOUT = True
+        CartModel.objects.filter(pk=old.pk).update(checked_out_on=datetime.now() - timedelta(days=40))
+        self.assertEqual(best_sellers(), [])
+        out = StringIO()
+        call_command('stockroom_record_sales', stdout=out)
+        self.assertEqual(out.getvalue(), 'Recorded the sales of 2 carts\n')
+        self.assertEqual(StockItemSales.objects.catch_up(), 0)
+        self.assertEqual(best_sellers(), [(self.items[1].product_id, 1)])
+        self.assertEqual(best_sellers(days=60), [(self.items[0].product_id, 2), (self.items[1].product_id, 1)])
+        self.assertEqual(best_sellers(end=date.today() - timedelta(days=40), days=1), [(self.items[0].product_id, 2)])
+
+    def test_api(self):
+        self.sell(1, 2, 3, 0)
+        response = json.loads(self.client.get('/products/best-sellers/', {'category': 'drills'}).content)
+        self.assertEqual([(r['product']['title'], r['units']) for r in response['results']], [('Driver', 3), ('Drill', 2)])
+        self.assertEqual(self.client.get('/products/best-sellers/', {'days': 0}).status_code, 400)
+
+import threading
+import time
+from stockroom.api import concurrent
+from django.db import connections
+from stockroom.benchmarks import measure_capacity
+
+class ConcurrentReadTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        self.saved = concurrent.READ_WORKERS, concurrent.shared_database
+
+    def tearDown(self):
+        concurrent.READ_WORKERS, concurrent.shared_database = self.saved
+
+    def test_gather(self):
+        def slow(value):
+            def call():
+                time.sleep(0.1)
+                return value, threading.current_thread().name
+            return call
+
+        def fail():
+            raise ValueError
+        concurrent.READ_WORKERS = 0
+        self.assertEqual([v for v, thread in concurrent.gather(slow(1), slow(2))], [1, 2])
+        concurrent.READ_WORKERS = 3
+        concurrent.shared_database = lambda: True
+        started = time.time()
+        results = concurrent.gather(slow(1), slow(2), slow(3))
+        self.assertTrue(time.time() - started < 0.25)
+        self.assertEqual([v for v, thread in results], [1, 2, 3])
+        self.assertEqual(len(set(thread for v, thread in results)), 3)
+        self.assertRaises(ValueError, concurrent.gather, slow(1), fail)
+
+    def test_pool_connections(self):
+        concurrent.READ_WORKERS = 3
+        concurrent.shared_database = lambda: True
+
+        def select():
+            # Pool threads get their own, empty, in-memory database
+            opened = connections['default'].connection is not None
+            connections['default'].cursor().execute('SELECT 1')
+            return opened
+        calls = [lambda: None] + [select] * 6
+        concurrent.gather(*calls)
+        recorder = instrumentation.QueryRecorder('pooled')
+        with recorder:
+            opened = concurrent.gather(*calls)[1:]
+        # Connections are kept from one call to the next
+        self.assertTrue(any(opened))
+        self.assertEqual(recorder.record['queries'], 6)
+
+    def test_product_page(self):
+        graph.clear()
+        parent = ProductCategory.objects.create(name='Kitchen', slug='kitchen')
+        category = ProductCategory.objects.create(name='Coffee', slug='coffee', parent=parent)
+        product = Product.objects.create(title='Pot', category=category)
+        other = Product.objects.create(title='Filter')
+        StockItem.objects.create(product=other, price=Decimal('3.00'), inventory=5)
+        ProductRelationship.objects.create(from_product=product, to_product=other, description='Fits')
+        response = json.loads(self.client.get('/products/%d/page/' % product.pk).content)
+        self.assertEqual(response['product']['title'], 'Pot')
+        self.assertEqual([c['slug'] for c in response['breadcrumbs']], ['kitchen', 'coffee'])
+        self.assertEqual([r['title'] for r in response['related']], ['Filter'])
+        self.assertEqual(self.client.get('/products/%d/page/' % (other.pk + 1)).status_code, 404)
+        # The product payload carries its stock, the stock endpoint only that
+        self.assertEqual(response['product']['inventory']['stock'], [])
+        stock = json.loads(self.client.get('/products/%d/stock/' % other.pk).content)
+        self.assertEqual([(Decimal(s['price']), s['inventory']) for s in stock], [(Decimal('3.00'), 5)])
+
+    def test_measure_capacity(self):
+        result = measure_capacity(lambda state: time.sleep(0.01), clients=4, seconds=0.2)
+        self.assertTrue(result['requests_per_second'] > 100)
+        self.assertTrue(result['p50_ms'] >= 10)
+
+class CategoryCountsTest(TestCase):
+    urls = 'stockroom.urls'
+
+    def setUp(self):
+        get_stockroom_cache().clear()
+        self.home = ProductCategory.objects.create(name='Home', slug='home')
+        self.kitchen = ProductCategory.objects.create(name='Kitchen', slug='kitchen', parent=self.home)
+        self.garden = ProductCategory.objects.create(name='Garden', slug='garden', parent=self.home)
+        self.pot = Product.objects.create(title='Pot', sku='POT', category=self.kitchen)
+        self.pan = Product.objects.create(title='Pan', category=self.kitchen)
+        self.item = StockItem.objects.create(product=self.pot, price=Decimal('20.00'), inventory=2)
+        StockItem.objects.create(product=self.pan, price=Decimal('25.00'), inventory=0)
+        # Listed while sold out
+        pan = Product.objects.get(pk=self.pan.pk)
+        pan.is_active = True
+        pan.save()
+
+    def counts(self, category):
+        c = ProductCategory.objects.get(pk=category.pk)
+        return (c.product_count, c.in_stock_count, c.subtree_product_count, c.subtree_in_stock_count)
+
+    def assertConsistent(self):
+        expected = [self.counts(c) for c in ProductCategory.objects.order_by('pk')]
+        ProductCategory.objects.rebuild_counts()
+        self.assertEqual([self.counts(c) for c in ProductCategory.objects.order_by('pk')], expected)
+
+    def test_counts_follow_stock_and_moves(self):
+        self.assertEqual(self.counts(self.kitchen), (2, 1, 2, 1))
+        self.assertEqual(self.counts(self.home), (0, 0, 2, 1))
+        # Selling out deactivates the pot
+        self.item.inventory = 0
+        self.item.save()
+        self.assertEqual(self.counts(self.home), (0, 0, 1, 0))
+        self.item.inventory = 5
+        self.item.save()
+        pot = Product.objects.get(pk=self.pot.pk)
+        pot.category = self.garden
+        pot.save()
+        self.assertEqual(self.counts(self.kitchen), (1, 0, 1, 0))
+        self.assertEqual(self.counts(self.garden), (1, 1, 1, 1))
+        self.assertEqual(self.counts(self.home), (0, 0, 2, 1))
+        self.assertConsistent()
+
+    def test_category_moves_and_deletes(self):
+        shop = ProductCategory.objects.create(name='Shop', slug='shop')
+        kitchen = ProductCategory.objects.get(pk=self.kitchen.pk)
+        kitchen.parent = shop
+        kitchen.save()
+        self.assertEqual(self.counts(self.home), (0, 0, 0, 0))
+        self.assertEqual(self.counts(shop), (0, 0, 2, 1))
+        Product.objects.get(pk=self.pot.pk).delete()
+        self.assertEqual(self.counts(shop), (0, 0, 1, 0))
+        self.assertConsistent()
+
+    def test_import_moves(self):
+        CatalogImporter().run([(1, {'product_sku': 'POT', 'title': 'Pot', 'category': 'Home/Garden',
+            'sku': 'POT-1', 'price': '20.00', 'inventory': '3'})])
+        self.assertEqual(Product.objects.get(pk=self.pot.pk).category_id, self.garden.pk)
+        self.assertEqual(self.counts(self.kitchen), (1, 0, 1, 0))
+        self.assertConsistent()
+
+    def test_endpoints(self):
+        other = Product.objects.create(title='Rake', category=self.garden)
+        response = json.loads(self.client.get('/categories/home/products/').content)
+        self.assertEqual(sorted(p['title'] for p in response['results']), ['Pan', 'Pot'])
+        response = json.loads(self.client.get('/categories/home/products/', {'in_stock': 1}).content)
+        self.assertEqual([p['title'] for p in response['results']], ['Pot'])
+        ProductCategory.objects.filter(pk=self.garden.pk).update(active=False)
+        with self.assertNumQueries(1):
+            tree = CategoryTreeHandler().read(RequestFactory().get('/'))['results']
+        self.assertEqual([(c['slug'], c['counts']['subtree_products']) for c in tree], [('home', 2), ('kitchen', 2)])
@@ -0,0 +1,104 @@
+"""
+Renders the STOCKROOM_PRODUCT_THUMBNAIL_SIZES variants of product images
+and records them on ProductImage.variants, so building thumbnail URLs is a
+lookup instead of a storage call.
+"""
+import json
+import os
+from cStringIO import StringIO
+from multiprocessing import Pool
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+PRODUCT_THUMBNAILS = getattr(settings, 'STOCKROOM_PRODUCT_THUMBNAIL_SIZES', None) or ()
+
+def variant_name(name, width, height):
+    head, tail = os.path.split(name)
+    filename, ext = os.path.splitext(tail)
+    return os.path.join(head, '%s.%sx%s%s' % (filename, width, height, ext))
+
+def render_thumbnails(name, sizes=None, storage=None):
+    """
+        Renders every size of the image stored under name, keeping its
+        aspect ratio, and returns the variants as a list of dicts with
+        size, width, height, path and url.
+    """
+    storage = storage or default_storage
+    source = storage.open(name, 'rb')
+    try:
+        original = Image.open(source)
+        original.load()
+    finally:
+        source.close()
+    format = original.format or 'JPEG'
+    if format == 'JPEG' and original.mode not in ('RGB', 'L'):
+        original = original.convert('RGB')
+
+    variants = []
+    for width, height in (sizes if sizes is not None else PRODUCT_THUMBNAILS):
+        image = original.copy()
+        image.thumbnail((width, height), Image.ANTIALIAS)
+        buf = StringIO()
+        image.save(buf, format)
+        path = variant_name(name, width, height)
+        if storage.exists(path):
+            storage.delete(path)
+        path = storage.save(path, ContentFile(buf.getvalue()))
+        variants.append({
+            'size' : '%sx%s' % (width, height),
+            'width' : image.size[0],
+            'height' : image.size[1],
+            'path' : path,
+            'url' : storage.url(path),
+        })
+    return variants
+
+def _render_job(job):
+    # Runs in a worker process, so it only touches storage, never the database
+    pk, name = job
+    try:
+        return pk, render_thumbnails(name), None
+    except Exception, e:
+        return pk, None, '%s: %s' % (e.__class__.__name__, e)
+
+def generate_thumbnails(product_image):
+    """
+        Renders and records the variants of one image in this process.
+    """
+    product_image.set_variants(render_thumbnails(product_image.image_file.name))
+    type(product_image).objects.filter(pk=product_image.pk).update(variants=product_image.variants)
+
+def backfill_thumbnails(queryset, processes=None, chunk_size=100):
+    """
+        Renders the variants of every image in queryset on a pool of worker
+        processes. Returns (rendered, errors) where errors is a list of
+        (pk, message).
+    """
+    from models import ProductImage
+    from caching import invalidate
+    jobs = list(queryset.values_list('pk', 'image_file', 'product').order_by('pk'))
+    products = dict((pk, product_id) for pk, name, product_id in jobs)
+    # Workers must not inherit an open database connection
+    connection.close()
+    pool = Pool(processes)
+    rendered, errors = 0, []
+    try:
+        results = pool.imap_unordered(_render_job, [(pk, name) for pk, name, product_id in jobs], chunk_size)
+        for pk, variants, error in results:
+            if error:
+                errors.append((pk, error))
+                continue
+            ProductImage.objects.filter(pk=pk).update(variants=json.dumps(variants))
+            invalidate('product', [products[pk]])
+            rendered += 1
+    finally:
+        pool.close()
+        pool.join()
+    return rendered, errors
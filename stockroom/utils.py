@@ -1,124 +1,146 @@
 from django.conf import settings
 from counter import Counter
+from thumbnails import PRODUCT_THUMBNAILS
 import os
 
-
-PRODUCT_THUMBNAILS = getattr(settings, 'STOCKROOM_PRODUCT_THUMBNAIL_SIZES', None)
-    
-def build_thumbnail_list(gallery_object):
+def build_thumbnail_list(product):
+    """
+        Lists the recorded thumbnail sizes of each of the product's images;
+        no storage calls are made.
+    """
     images = []
-    for i in gallery_object.images.all():
-        head, tail = os.path.split(i.image.url)
-        filename, ext = os.path.splitext(tail)
-        sizes = {}
-        for s in PRODUCT_THUMBNAILS:
-            size = {
-                'width' : s[0],
-                'height' : s[1],
-                'url' : "%s/%s.%sx%s%s" % (head, filename, s[0], s[1], ext)
-            }
-            sizes.update({
-                '%sx%s' % (s[0], s[1]) : size,
-            })
-        
+    for i in product.images.all():
         image = {
             'caption' : i.caption,
-            'sizes' : sizes,
+            'sizes' : i.get_thumbnail_sizes(),
         }
         images.append(image)
     return images
 
-def structure_products(product_object):
-    
-    if getattr(product_object, '__iter__', False):
-        response = []
-        # Collect images and inventory for each object
-        for p in product_object:
-
-            galleries = []
-            for g in p.gallery.all():
-                images = []
-                for i in g.images.all():
-                    image = {
-                        'url' : i.image.url,
-                    }
-                    images.append(i)
-            
-                gallery = {
-                    'color' : g.color,
-                    'images' : images,
-                }
-                galleries.append(gallery)
-        
-            stock = []
-            for s in p.stock.all():
-                stock_item = {
-                    'package_count' : s.package_count,
-                    'price_override': s.price,                
-                }
-                stock.append(stock_item)
-                
-            
-            item = {
-                'id' : p.pk,
-                'title' : p.title,
-                'description' : p.description,
-                'price' : p.get_price(),
-                'sku' : p.sku,
-                'category' : {
-                    'id' : p.category.pk,
-                    'name' : p.category.name,
-                    'slug' : p.category.slug,
-                },
-                'brand' : {
-                    'id' : p.brand.pk,
-                    'name' : p.brand.name,
-                    'manufacturer' : {
-                        'id' : p.brand.manufacturer.pk,
-                        'name' : p.brand.manufacturer.name,
-                    },
-                },
-                'galleries' : galleries,
-                'inventory' : {
-                    'stock' : stock,
-                    'available_colors' : available_colors,
-                    'available_sizes' : available_sizes,
-                },
-            }
+# Relations every structured product needs, loaded a fixed number of
+# queries per chunk instead of per product
+PRODUCT_SELECT_RELATED = ('category', 'brand__manufacturer', 'thumbnail')
+PRODUCT_PREFETCH_RELATED = ('images', 'stock', 'stock__attributes__attribute')
+PRODUCT_CHUNK_SIZE = getattr(settings, 'STOCKROOM_PRODUCT_CHUNK_SIZE', 200)
 
-            response.append(item)
-        
+def prefetch_products(queryset):
+    return queryset.select_related(*PRODUCT_SELECT_RELATED).prefetch_related(*PRODUCT_PREFETCH_RELATED)
 
-    else:
-        galleries = product_object.gallery.all()
-        stock = product_object.stock.all()
-                    
-        response = {
-            'id' : product_object.pk,
-            'title' : product_object.title,
-            'description' : product_object.description,
-            'price' : product_object.get_price(),
-            'sku' : product_object.sku,
-            'category' : {
-                'id' : product_object.category.pk,
-                'name' : product_object.category.name,
-                'slug' : product_object.category.slug,
-            },
-            'brand' : {
-                'id' : product_object.brand.pk,
-                'name' : product_object.brand.name,
-                'manufacturer' : {
-                    'id' : product_object.brand.manufacturer.pk,
-                    'name' : product_object.brand.manufacturer.name,
-                },
-            },
-            'galleries' : galleries,
-            'inventory' : {
-                'stock' : stock,
-            },
+def structure_product(p):
+    images = []
+    for i in p.images.all():
+        images.append({
+            'id' : i.pk,
+            'url' : i.image_file.url,
+            'caption' : i.caption,
+            'sizes' : i.get_thumbnail_sizes(),
+        })
+    
+    stock = []
+    for s in p.stock.all():
+        attributes = []
+        for a in s.attributes.all():
+            attributes.append({
+                'attribute' : a.attribute.slug,
+                'name' : a.attribute.name,
+                'value' : a.value,
+                'unit' : a.unit,
+            })
+        stock.append({
+            'id' : s.pk,
+            'package_title' : s.package_title,
+            'package_count' : s.package_count,
+            'inventory' : s.inventory,
+            'price' : s.price,
+            'on_sale' : s.on_sale,
+            'sale_price' : s.sale_price,
+            'attributes' : attributes,
+        })
+    
+    category = None
+    if p.category_id:
+        category = {
+            'id' : p.category.pk,
+            'name' : p.category.name,
+            'slug' : p.category.slug,
         }
     
-    return response
+    brand = None
+    if p.brand_id:
+        manufacturer = None
+        if p.brand.manufacturer_id:
+            manufacturer = {
+                'id' : p.brand.manufacturer.pk,
+                'name' : p.brand.manufacturer.name,
+            }
+        brand = {
+            'id' : p.brand.pk,
+            'name' : p.brand.name,
+            'manufacturer' : manufacturer,
+        }
+    
+    return {
+        'id' : p.pk,
+        'title' : p.title,
+        'description' : p.description,
+        'price' : p.min_price,
+        'sku' : p.sku,
+        'is_active' : p.is_active,
+        'category' : category,
+        'brand' : brand,
+        'thumbnail' : p.thumbnail_id and p.thumbnail.image_file.url or None,
+        'images' : images,
+        'inventory' : {
+            'total' : p.total_inventory,
+            'stock' : stock,
+        },
+    }
+
+def structure_category(c):
+    return {
+        'id' : c.pk,
+        'name' : c.name,
+        'slug' : c.slug,
+        'active' : c.active,
+        'parent' : c.parent_id,
+        'path' : c.path,
+        'depth' : c.depth,
+        'counts' : {
+            'products' : c.product_count,
+            'in_stock' : c.in_stock_count,
+            'subtree_products' : c.subtree_product_count,
+            'subtree_in_stock' : c.subtree_in_stock_count,
+        },
+    }
+
+def iter_structured_products(queryset, chunk_size=PRODUCT_CHUNK_SIZE):
+    """
+        Yields structured products from queryset in pk order, loading
+        chunk_size products and their relations at a time.
+    """
+    queryset = prefetch_products(queryset).order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        for p in chunk:
+            yield structure_product(p)
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1].pk
+
+def structure_products(product_object):
+    """
+        Structures a single product, or returns a generator over a queryset
+        of products.
+    """
+    if getattr(product_object, '__iter__', False):
+        return iter_structured_products(product_object)
+    return structure_product(product_object)
 
 def structure_gallery(gallery_object):
     